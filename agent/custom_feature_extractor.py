@@ -1,45 +1,105 @@
+'''
+Custom Combined Extractor:
+    Features extractor for Stable Baselines 3's MultiInputPolicy, it encodes each observation key and concatenates them:
+        - lidar_data:      PointNet global features (1024) of the downsampled points (B, 3, K). If the pre-processing already computed them (the 'lidar_features' stage), they are used instead and PointNet isn't built.
+        - rgb_data:        Small CNN (RgbEncoder). Its strided convolutions downsample the image early and the adaptive pooling makes its size independent of the input resolution (set by the 'rgb_image' pre-processing stage, in either layout)
+        - position, target_position, situation: Flattened (SB3 already one-hot encodes the discrete situation)
+
+    Stacked observations (FRAME_STACK > 1, see env/frame_stack.py) have the k frames in their first axis: the lidar's frames go through PointNet as a batch of B * k clouds (k * 1024 features)
+    and the images' frames are concatenated along their channels.
+
+    The observations arrive already batched from SB3 (a whole minibatch in PPO's updates, one row per environment in the rollouts), so every extractor runs once per batch.
+    Without gradients (rollout collection and predict) the forward pass runs under torch.inference_mode.
+'''
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from stable_baselines3.common.torch_layers import BaseFeaturesExtractor
+from stable_baselines3.common.preprocessing import get_flattened_obs_dim, is_image_space_channels_first
 import gymnasium as gym
+import numpy as np
 
 from env.aux.point_net import PointNetfeat
 
+# PointNetfeat returns (features, trans, trans_feat), the extractor only uses the global features
+class PointNetEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.pointfeat = PointNetfeat(global_feat=True)
+
+    def forward(self, lidar_data):
+        # Stacked frames (B, k, 3, K) are encoded as B * k clouds, then the features of each observation are concatenated
+        if lidar_data.dim() == 4:
+            batch_size, k = lidar_data.shape[:2]
+            return self.forward(lidar_data.reshape(batch_size * k, *lidar_data.shape[2:])).reshape(batch_size, -1)
+        features, _, _ = self.pointfeat(lidar_data)
+        return features
+
+# The images stay in uint8 in the environment and in the rollout buffer, they are converted to float once per batch: here for uint8 batches,
+# or by SB3's MultiInputPolicy (normalize_images=True), whose float batches in [0, 1] are used as they are
+class RgbEncoder(nn.Module):
+    def __init__(self, image_space: gym.spaces.Box, features_dim=256, pooled_size=(4, 8)):
+        super().__init__()
+        # Stacked frames (k, H, W, C) or (k, C, H, W) are concatenated along the channels
+        self.stacked = len(image_space.shape) == 4
+        frame_shape = image_space.shape[1:] if self.stacked else image_space.shape
+        self.channels_first = is_image_space_channels_first(gym.spaces.Box(low=0, high=255, shape=frame_shape, dtype=np.uint8))
+        channels = (frame_shape[0] if self.channels_first else frame_shape[-1]) * (image_space.shape[0] if self.stacked else 1)
+        self.cnn = nn.Sequential(
+            nn.Conv2d(channels, 32, kernel_size=8, stride=4),
+            nn.ReLU(),
+            nn.Conv2d(32, 64, kernel_size=4, stride=2),
+            nn.ReLU(),
+            nn.Conv2d(64, 64, kernel_size=3, stride=1),
+            nn.ReLU(),
+            nn.AdaptiveAvgPool2d(pooled_size),
+            nn.Flatten(),
+        )
+        self.linear = nn.Sequential(nn.Linear(64 * pooled_size[0] * pooled_size[1], features_dim), nn.ReLU())
+
+    def forward(self, images):
+        if not self.channels_first:
+            images = images.movedim(-1, -3)
+        if self.stacked:
+            images = images.flatten(1, 2)
+        # SB3 doesn't normalize the stacked images (they aren't an image space for it), they arrive as floats in [0, 255]
+        if images.dtype == torch.uint8 or self.stacked:
+            images = images.float().div_(255.0)
+        return self.linear(self.cnn(images))
+
 class CustomCombinedExtractor(BaseFeaturesExtractor):
-    def __init__(self, observation_space: gym.spaces.Dict):
+    FLATTENED_KEYS = ['position', 'target_position', 'situation']
+
+    # rgb_features_dim: size of the RGB encoder's features
+    def __init__(self, observation_space: gym.spaces.Dict, rgb_features_dim=256):
         # Initialize the base class with a dummy feature dimension
         super().__init__(observation_space, features_dim=1)
 
         extractors = {}
         total_concat_size = 0
-        
-        # Initialize the PointNet features extractor for lidar data
-        if "lidar_data" in observation_space.spaces:
-            self.lidar_pointfeat = PointNetfeat()
-            total_concat_size += 1024  # Assuming PointNetfeat outputs a 1024-dimensional feature vector
 
-        # Add more extractors for other observation types if needed
+        # Lidar: precomputed PointNet features if the pre-processing has them, otherwise PointNet over the points
+        if "lidar_features" in observation_space.spaces:
+            extractors["lidar_features"] = nn.Flatten()
+            total_concat_size += get_flattened_obs_dim(observation_space.spaces["lidar_features"])
+        elif "lidar_data" in observation_space.spaces:
+            extractors["lidar_data"] = PointNetEncoder()
+            lidar_shape = observation_space.spaces["lidar_data"].shape
+            total_concat_size += 1024 * (lidar_shape[0] if len(lidar_shape) == 3 else 1)
+
+        if "rgb_data" in observation_space.spaces:
+            extractors["rgb_data"] = RgbEncoder(observation_space.spaces["rgb_data"], features_dim=rgb_features_dim)
+            total_concat_size += rgb_features_dim
+
+        for key in self.FLATTENED_KEYS:
+            if key in observation_space.spaces:
+                extractors[key] = nn.Flatten()
+                total_concat_size += get_flattened_obs_dim(observation_space.spaces[key])
 
         self.extractors = nn.ModuleDict(extractors)
         self._features_dim = total_concat_size
 
     def forward(self, observations) -> torch.Tensor:
-        encoded_tensor_list = []
-
-        for key, extractor in self.extractors.items():
-            if key == "lidar_data":
-                encoded_tensor_list.append(self.__process_lidar(observations[key]))
-            else:
-                encoded_tensor_list.append(extractor(observations[key]))
-
-        return torch.cat(encoded_tensor_list, dim=1)
-
-    def __process_lidar(self, lidar_data):
-        lidar_data = torch.from_numpy(lidar_data).float()
-        lidar_data = lidar_data.unsqueeze(0)
-        
-        # Extract features using PointNet
-        out, _, _ = self.lidar_pointfeat(lidar_data)
-        
-        return out
\ No newline at end of file
+        # The rollouts are collected under torch.no_grad, so inference mode can also skip the autograd bookkeeping
+        with torch.inference_mode(mode=not torch.is_grad_enabled()):
+            encoded_tensor_list = [extractor(observations[key]) for key, extractor in self.extractors.items()]
+            return torch.cat(encoded_tensor_list, dim=1)
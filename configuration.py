@@ -12,18 +12,42 @@ VERBOSE                 = False
 VEHICLE_SENSORS_FILE    = 'env/train_sensors.json'
 VEHICLE_PHYSICS_FILE    = 'test_vehicle_physics.json'
 VEHICLE_MODEL           = "vehicle.tesla.model3"
+SENSOR_SYNC_TIMEOUT     = 2.0 # Maximum number of seconds to wait for the sensors to deliver the data of a frame
+SENSOR_READY_TIMEOUT    = 5.0 # Maximum number of seconds to wait for the sensors of a new vehicle to produce their first data
 
 # Simulation attributes
 SIM_HOST                = 'localhost'
 SIM_PORT                = 2000
 SIM_TIMEOUT             = 100.0
+SIM_SERVER_TIMEOUT      = 60.0 # Maximum number of seconds to wait for a launched server to answer
+SIM_MAP_LOAD_TIMEOUT    = 30.0 # Maximum number of seconds to wait for a new map to be loaded
 SIM_LOW_QUALITY         = False
 SIM_OFFSCREEN_RENDERING = False
 SIM_DELTA_SECONDS       = 0.05
 SIM_FPS                 = 30
 
+# Map caches
+CACHE_DIR               = 'cache' # Directory where the per-map caches (e.g., the waypoint index) are stored
+WAYPOINT_INDEX_DISTANCE = 1.0     # Distance in meters between the waypoints sampled for the waypoint index
+ROUTE_PLANNER_RESOLUTION = 2.0    # Distance in meters between the points of the route planner's polylines
+
+# Pre-processing
+PREPROCESSING_STAGES    = ['lidar_downsampling', 'rgb_image'] # Stages applied to the observations, in order: 'lidar_downsampling', 'lidar_features' (PointNet features, imports torch) and 'rgb_image', see env/pre_processing.py
+LIDAR_FPS_BACKEND       = 'numpy'   # Farthest point sampling backend: 'numpy' (one cloud at a time) or 'torch' (batches clouds)
+LIDAR_FPS_DTYPE         = 'float32' # Precision of the sampler's distances, 'float64' reproduces the original sampler exactly
+LIDAR_FPS_MAX_ERROR     = None      # If set (in meters), the cloud is downsampled to voxels before the sampling, every dropped point is within this distance of a kept one
+LIDAR_RAW_MAX_POINTS    = 8192      # Size of the zero padded lidar sweeps of the raw observations (CarlaEnv(preprocess_observations=False)), bigger sweeps are strided down to it
+LIDAR_FEATURES_MODEL    = 'eager'   # PointNet of the 'lidar_features' stage: 'eager' (PointNetfeat), 'fused' (BatchNorms folded, TorchScript) or 'int8' (fused with int8 linear layers), see env/aux/point_net_inference.py
+RGB_CROP                = None      # Region of interest (top, bottom, left, right) in pixels of the camera's images kept by the 'rgb_image' stage, None keeps the whole image
+RGB_RESOLUTION          = (90, 160) # (height, width) of the images after the crop (e.g., (84, 84)), None keeps the cropped size
+RGB_GRAYSCALE           = False     # If True, the images have a single (luminance) channel
+RGB_CHANNELS_FIRST      = False     # If True, the images are (channels, height, width) instead of (height, width, channels)
+FRAME_STACK             = 1         # Number of consecutive observations stacked in the keys of FRAME_STACK_KEYS (1 disables the stacking), see env/frame_stack.py
+FRAME_STACK_KEYS        = ['rgb_data', 'lidar_data', 'lidar_features', 'position'] # Keys stacked when FRAME_STACK > 1 (the keys missing from the observation are ignored)
+
 # Environment attributes
 ENV_SCENARIOS_FILE      = 'env/scenarios.json'
+ENV_EPISODES_PER_MAP    = 10   # Number of consecutive episodes the scenario scheduler keeps on the same map (1 means every episode samples a scenario independently)
 ENV_MAX_STEPS           = 3500 # Used to limit the number of steps in the environment and to calculate the reward for finishing an episode successfully
 ENV_REWARDS_LAMBDAS     = {
                             'orientation': 0.5,
@@ -35,4 +59,7 @@ ENV_REWARDS_LAMBDAS     = {
                             'light_pole_transgression': -3,
                             'stop_sign_transgression': -3,
                             'time_limit': -1,
+                            'route_progress': 0.0, # Per meter of progress along the scenario's route (e.g., 0.1), 0 disables the route terms
+                            'cross_track': 0.0,    # Per meter of distance to the scenario's route (e.g., -0.2)
                          }
+ENV_REWARD_PLUGINS      = [] # Modules that register extra reward terms (see env/reward.py), e.g., ['my_package.my_reward_terms']
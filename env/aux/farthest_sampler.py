@@ -1,22 +1,163 @@
+'''
+Farthest Point Sampler:
+  Picks k points of a point cloud, each one the farthest from the ones already picked, so the sample keeps the shape of the cloud.
+
+  - The workspace (the points' coordinates and their distances to the sample) is preallocated and grown only when a bigger cloud arrives, so a call doesn't allocate per iteration
+  - backend='numpy' samples one cloud at a time, backend='torch' samples a batch of clouds (e.g., one per environment) in the same loop with torch CPU operations
+  - max_error (in meters) enables the approximate mode: the cloud is first downsampled to one point per voxel (voxel size max_error / sqrt(dim)), so every dropped point is within max_error of a kept one
+  - With init_idx=1 and dtype=np.float64, the exact modes (both backends) return the same points as the original single cloud loop
+
+  The distances are computed in dtype (float32 by default, twice as fast on big clouds). The coordinates of float32 clouds (e.g., CARLA's lidar) are exact in the workspace, only the squared distances are rounded,
+  so float32 can only pick a different point when two candidates are (almost) tied, which happens on quantized clouds.
+  Run examples/benchmark_farthest_sampler.py to compare the latency and coverage of each mode.
+'''
 import numpy as np
 
 class FarthestSampler:
-  def __init__(self, dim=3):
+  def __init__(self, dim=3, backend='numpy', max_error=None, dtype=np.float32):
+    if backend not in ('numpy', 'torch'):
+      raise ValueError(f"Unknown farthest point sampling backend {backend}, it must be 'numpy' or 'torch'")
     self.dim = dim
+    self.backend = backend
+    self.max_error = max_error
+    self.dtype = np.dtype(dtype)
+    self.__points = np.empty((dim, 0), dtype=self.dtype)
+    self.__distances = np.empty(0, dtype=self.dtype)
+    self.__scratch = np.empty(0, dtype=self.dtype)
+    self.__tmp = np.empty(0, dtype=self.dtype)
+    self.__torch_workspace = None
 
   def calc_distances(self, p0, points):
     return ((p0 - points) ** 2).sum(axis=0)
 
-  def sample(self, pts, k):
-    farthest_pts = np.zeros((self.dim, k))
+  # pts: (dim, N) -> the sampled points (dim, k) and their indices in pts
+  def sample(self, pts, k, init_idx=1):
+    if self.backend == 'torch':
+      farthest_pts, farthest_pts_idx = self.sample_batch(pts[None], k, init_idx=init_idx)
+      return farthest_pts[0], farthest_pts_idx[0]
+    return self.__sample_cloud(pts, k, init_idx)
+
+  def __sample_cloud(self, pts, k, init_idx):
+    candidates = self.__voxel_candidates(pts, init_idx)
+    idx = self.__sample_numpy(pts if candidates is None else pts[:, candidates], k, init_idx if candidates is None else 0)
+    farthest_pts_idx = idx if candidates is None else candidates[idx]
+    return pts[:, farthest_pts_idx].astype(np.float64), farthest_pts_idx
+
+  # pts: (B, dim, N) -> the sampled points (B, dim, k) and their indices (B, k). lengths (B,) are the number of valid points of each cloud (the rest is padding), each one must be at least 1.
+  # The start index is clipped to each cloud's length.
+  def sample_batch(self, pts, k, init_idx=1, lengths=None):
+    batch_size, _, n = pts.shape
+    lengths = np.full(batch_size, n) if lengths is None else np.asarray(lengths)
+    init_idx = np.minimum(init_idx, lengths - 1)
+    if self.backend == 'numpy':
+      results = [self.__sample_cloud(pts[b, :, :lengths[b]], k, int(init_idx[b])) for b in range(batch_size)]
+      return np.stack([points for points, _ in results]), np.stack([idx for _, idx in results])
+
+    # In approximate mode each cloud is downsampled on its own, then the clouds are packed (and padded) again
+    if self.max_error is not None:
+      candidates = [self.__voxel_candidates(pts[b, :, :lengths[b]], int(init_idx[b])) for b in range(batch_size)]
+      lengths = np.array([len(c) for c in candidates])
+      packed = np.zeros((batch_size, self.dim, lengths.max()), dtype=pts.dtype)
+      for b, c in enumerate(candidates):
+        packed[b, :, :len(c)] = pts[b][:, c]
+      idx = self.__sample_torch(packed, k, np.zeros(batch_size, dtype=np.int64), lengths)
+      farthest_pts_idx = np.stack([candidates[b][idx[b]] for b in range(batch_size)])
+    else:
+      farthest_pts_idx = self.__sample_torch(pts, k, init_idx, lengths)
+    farthest_pts = np.take_along_axis(pts, farthest_pts_idx[:, None, :], axis=2).astype(np.float64)
+    return farthest_pts, farthest_pts_idx
+
+  # ====================================== Exact FPS ======================================
+  def __reserve(self, n):
+    if self.__distances.shape[0] < n:
+      self.__points = np.empty((self.dim, n), dtype=self.dtype)
+      self.__distances = np.empty(n, dtype=self.dtype)
+      self.__scratch = np.empty(n, dtype=self.dtype)
+      self.__tmp = np.empty(n, dtype=self.dtype)
+
+  def __sample_numpy(self, pts, k, init_idx):
+    n = pts.shape[1]
+    self.__reserve(n)
+    points, distances, scratch, tmp = self.__points[:, :n], self.__distances[:n], self.__scratch[:n], self.__tmp[:n]
+    points[...] = pts
     farthest_pts_idx = np.zeros(k, dtype=int)
-    init_idx = 1
-    farthest_pts[:, 0] = pts[:, init_idx]
+
     farthest_pts_idx[0] = init_idx
-    distances = self.calc_distances(farthest_pts[:, 0:1], pts)
+    self.__distances_to(points, init_idx, distances, tmp)
     for i in range(1, k):
-      idx = np.argmax(distances)
-      farthest_pts[:, i] = pts[:, idx]
+      idx = int(np.argmax(distances))
       farthest_pts_idx[i] = idx
-      distances = np.minimum(distances, self.calc_distances(farthest_pts[:, i:i+1], pts))
-    return farthest_pts, farthest_pts_idx
\ No newline at end of file
+      self.__distances_to(points, idx, scratch, tmp)
+      np.minimum(distances, scratch, out=distances)
+    return farthest_pts_idx
+
+  # Squared distances from the point idx to every point, summed in the same order as calc_distances
+  def __distances_to(self, points, idx, out, tmp):
+    p0 = points[:, idx].copy()
+    np.subtract(points[0], p0[0], out=out)
+    np.square(out, out=out)
+    for d in range(1, self.dim):
+      np.subtract(points[d], p0[d], out=tmp)
+      np.square(tmp, out=tmp)
+      np.add(out, tmp, out=out)
+
+  def __sample_torch(self, pts, k, init_idx, lengths):
+    import torch
+
+    batch_size, _, n = pts.shape
+    torch_dtype = torch.float64 if self.dtype == np.float64 else torch.float32
+    workspace = self.__torch_workspace
+    if workspace is None or workspace['points'].shape[0] < batch_size or workspace['points'].shape[2] < n:
+      workspace = {
+        'points': torch.empty((batch_size, self.dim, n), dtype=torch_dtype),
+        'distances': torch.empty((batch_size, n), dtype=torch_dtype),
+        'scratch': torch.empty((batch_size, n), dtype=torch_dtype),
+        'tmp': torch.empty((batch_size, n), dtype=torch_dtype),
+      }
+      self.__torch_workspace = workspace
+    points = workspace['points'][:batch_size, :, :n]
+    distances = workspace['distances'][:batch_size, :n]
+    scratch = workspace['scratch'][:batch_size, :n]
+    tmp = workspace['tmp'][:batch_size, :n]
+    points.copy_(torch.from_numpy(np.ascontiguousarray(pts)))
+
+    # Padding points get a negative distance, so they are never picked
+    padding = torch.arange(n)[None, :] >= torch.from_numpy(np.asarray(lengths))[:, None]
+    rows = torch.arange(batch_size)
+    farthest_pts_idx = torch.zeros((batch_size, k), dtype=torch.int64)
+
+    idx = torch.from_numpy(np.asarray(init_idx, dtype=np.int64))
+    farthest_pts_idx[:, 0] = idx
+    self.__torch_distances_to(points, rows, idx, distances, tmp)
+    distances.masked_fill_(padding, -1)
+    for i in range(1, k):
+      idx = torch.max(distances, dim=1).indices
+      farthest_pts_idx[:, i] = idx
+      self.__torch_distances_to(points, rows, idx, scratch, tmp)
+      torch.minimum(distances, scratch, out=distances)
+    return farthest_pts_idx.numpy()
+
+  def __torch_distances_to(self, points, rows, idx, out, tmp):
+    import torch
+
+    p0 = points[rows, :, idx]
+    torch.sub(points[:, 0, :], p0[:, 0:1], out=out)
+    out.square_()
+    for d in range(1, self.dim):
+      torch.sub(points[:, d, :], p0[:, d:d+1], out=tmp)
+      out.add_(tmp.square_())
+
+  # ====================================== Approximate FPS ======================================
+  # Indices of one point per voxel (the first one, and the initial point is always kept as the first candidate), or None in exact mode
+  def __voxel_candidates(self, pts, init_idx):
+    if self.max_error is None or pts.shape[1] == 0:
+      return None
+    voxel_size = self.max_error / np.sqrt(self.dim)
+    voxels = np.floor(pts / voxel_size).astype(np.int64)
+    voxels -= voxels.min(axis=1, keepdims=True)
+    keys = np.zeros(pts.shape[1], dtype=np.int64)
+    for d in range(self.dim):
+      keys = keys * (int(voxels[d].max()) + 1) + voxels[d]
+    _, first = np.unique(keys, return_index=True)
+    first = first[first != init_idx]
+    return np.concatenate(([init_idx], np.sort(first)))
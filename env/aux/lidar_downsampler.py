@@ -0,0 +1,65 @@
+'''
+Lidar Downsampler:
+    Reduces the lidar's sweeps (with any number of points) to a fixed number of points. The method is chosen by the "downsampling" entry of the lidar in the sensors' JSON file, e.g.:
+        "downsampling": {"method": "fps"}
+        "downsampling": {"method": "voxel", "voxel_size": 0.5}
+
+    Methods:
+        - stride: Evenly spaced points of the sweep (in the order the lidar delivered them)
+        - random: Random points without repetition (seed sets the generator's seed)
+        - voxel:  One point per voxel of voxel_size meters, then evenly spaced voxels if there are still too many
+        - fps:    Farthest point sampling (the default), configured by the LIDAR_FPS_* constants of the configuration file (max_error in the JSON overrides LIDAR_FPS_MAX_ERROR)
+
+    A sweep with fewer points than requested repeats some of its points (fps and stride repeat them like the original sampler did).
+'''
+import numpy as np
+from env.aux.farthest_sampler import FarthestSampler
+import configuration as config
+
+METHODS = ['stride', 'random', 'voxel', 'fps']
+
+class LidarDownsampler:
+    def __init__(self, method='fps', voxel_size=0.5, seed=None, max_error=config.LIDAR_FPS_MAX_ERROR):
+        if method not in METHODS:
+            raise ValueError(f"Unknown lidar downsampling method {method}, it must be one of {METHODS}")
+        self.method = method
+        self.voxel_size = voxel_size
+        self.__rng = np.random.default_rng(seed)
+        self.sampler = FarthestSampler(backend=config.LIDAR_FPS_BACKEND, max_error=max_error, dtype=config.LIDAR_FPS_DTYPE) if method == 'fps' else None
+
+    # Creates the downsampler described by the lidar's entry of the sensors' JSON file
+    @staticmethod
+    def from_sensor_dict(sensor_dict):
+        downsampling = dict(sensor_dict.get('downsampling', {}))
+        method = downsampling.pop('method', 'fps')
+        return LidarDownsampler(method, **downsampling)
+
+    # points: (N, 3, P) with lengths (N,) valid points each (the rest is padding, at least 1 valid point) -> (N, 3, k)
+    def sample_batch(self, points, k, lengths=None):
+        lengths = np.full(points.shape[0], points.shape[2]) if lengths is None else np.asarray(lengths)
+        if self.method == 'fps':
+            samples, _ = self.sampler.sample_batch(points, k, lengths=lengths)
+            return samples
+
+        samples = np.empty((points.shape[0], points.shape[1], k), dtype=points.dtype)
+        for b in range(points.shape[0]):
+            cloud = points[b, :, :lengths[b]]
+            samples[b] = cloud[:, self.__indices(cloud, k)]
+        return samples
+
+    def __indices(self, cloud, k):
+        n = cloud.shape[1]
+        if self.method == 'stride':
+            return np.linspace(0, n - 1, k, dtype=int)
+        if self.method == 'random':
+            return self.__rng.choice(n, k, replace=n < k)
+
+        # voxel: the first point of each voxel (in the sweep's order), then evenly spaced voxels
+        voxels = np.floor(cloud / self.voxel_size).astype(np.int64)
+        voxels -= voxels.min(axis=1, keepdims=True)
+        keys = np.zeros(n, dtype=np.int64)
+        for d in range(cloud.shape[0]):
+            keys = keys * (int(voxels[d].max()) + 1) + voxels[d]
+        _, first = np.unique(keys, return_index=True)
+        first = np.sort(first)
+        return first[np.linspace(0, len(first) - 1, k, dtype=int)]
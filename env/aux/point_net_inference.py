@@ -0,0 +1,58 @@
+'''
+PointNet Inference Export:
+    Builds a CPU inference version of a (trained) PointNetfeat for the rollout workers:
+        - fuse_batch_norm: Folds every BatchNorm into the conv/linear layer before it (with the BatchNorm's running statistics), the BatchNorms become identities
+        - quantize: Dynamic int8 quantization of the linear layers (the weights are stored in int8, the activations are quantized on the fly)
+        - export_point_net: Both of the above, then traces the global features with TorchScript and freezes the traced model
+
+    The exported model takes the same input (B, 3, K) as PointNetfeat, for any B and K, and only returns the global features (B, 1024).
+    The original model is never modified. Run examples/benchmark_point_net.py to compare the latency and the accuracy of each version.
+'''
+import copy
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+from env.aux.point_net import PointNetfeat
+
+# (layer, BatchNorm) names of each module, in PointNet every BatchNorm follows the layer with the same number
+FUSED_LAYERS = {
+    'STN3d': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('fc1', 'bn4'), ('fc2', 'bn5')],
+    'STNkd': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('fc1', 'bn4'), ('fc2', 'bn5')],
+    'PointNetfeat': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+}
+
+# Only the global features of PointNetfeat (a traced model can't return its trans_feat, which is None without the feature transform)
+class GlobalFeatures(nn.Module):
+    def __init__(self, pointfeat):
+        super().__init__()
+        self.pointfeat = pointfeat
+
+    def forward(self, x):
+        features, _, _ = self.pointfeat(x)
+        return features
+
+# Copy of the model in eval mode with the BatchNorms folded into the previous layers
+def fuse_batch_norm(model):
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        for layer_name, bn_name in FUSED_LAYERS.get(type(module).__name__, []):
+            layer, bn = getattr(module, layer_name), getattr(module, bn_name)
+            fuse = fuse_linear_bn_eval if isinstance(layer, nn.Linear) else fuse_conv_bn_eval
+            setattr(module, layer_name, fuse(layer, bn))
+            setattr(module, bn_name, nn.Identity())
+    return model
+
+# Copy of the model with int8 weights in its linear layers
+def quantize(model):
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+# Fused (and optionally quantized) TorchScript version of the model, traced with a (batch_size, 3, num_points) input
+def export_point_net(model=None, quantized=False, batch_size=2, num_points=500):
+    model = fuse_batch_norm(PointNetfeat(global_feat=True) if model is None else model)
+    if quantized:
+        model = quantize(model)
+
+    with torch.inference_mode(False), torch.no_grad():
+        traced = torch.jit.trace(GlobalFeatures(model).eval(), torch.rand(batch_size, 3, num_points))
+    return torch.jit.freeze(traced.eval())
@@ -28,6 +28,7 @@ Action Space:
 
 '''
 
+import os
 import numpy as np
 import json
 import time
@@ -47,15 +48,19 @@ from src.world import World
 from src.server import CarlaServer
 from src.vehicle import Vehicle
 from src.display import Display
+from src.readiness import Readiness
 import configuration as config
-from env.reward import calculate_reward
+from env.reward import RewardComputer
+from env.offline_reward import TrajectoryLogger, export_map_data
 import env.observation_action_space
 from env.pre_processing import PreProcessing
+from env.frame_stack import FrameStack
+from env.scenario_scheduler import ScenarioScheduler
 
 # Name: 'carla-rl-gym-v0'
 class CarlaEnv(gym.Env):
     metadata = {"render_modes": ["human"], "render_fps": config.SIM_FPS}
-    def __init__(self, continuous=True, scenarios=[], time_limit=60, initialize_server=True, random_weather=False, random_traffic=False, synchronous_mode=True, show_sensor_data=False, has_traffic=True, verbose=True):
+    def __init__(self, continuous=True, scenarios=[], time_limit=60, initialize_server=True, random_weather=False, random_traffic=False, synchronous_mode=True, show_sensor_data=False, has_traffic=True, soft_reset=False, episodes_per_map=config.ENV_EPISODES_PER_MAP, verbose=True, trajectory_log_dir=None, preprocess_observations=True):
         super().__init__()
         # Read the environment settings
         self.__is_continuous = continuous
@@ -64,7 +69,9 @@ class CarlaEnv(gym.Env):
         self.__synchronous_mode = synchronous_mode
         self.__show_sensor_data = show_sensor_data
         self.__has_traffic = has_traffic
+        self.__soft_reset = soft_reset
         self.__verbose = verbose
+        self.__preprocess_observations = preprocess_observations
         self.__automatic_server_initialization = initialize_server
 
         # 1. Start the server
@@ -76,13 +83,30 @@ class CarlaEnv(gym.Env):
 
         # 3. Read the flag and get the appropriate situations
         self.__get_situations(scenarios)
+        self.__scheduler = ScenarioScheduler(self.situations_dict, episodes_per_map=episodes_per_map)
         # 4. Create the vehicle
-        self.__vehicle = Vehicle(self.__world.get_world())
+        self.__vehicle = Vehicle(self.__world.get_world(), self.__world.get_client())
 
-        # 5. Observation space:
-        self.observation_space = env.observation_action_space.observation_space
+        # 5. Observation space: (without pre-processing, the observation keeps the raw lidar sweep and a vectorized wrapper processes the observations of every environment at once)
+        self.pre_processing = PreProcessing() if self.__preprocess_observations else None
+        if self.__preprocess_observations:
+            self.observation_space = self.pre_processing.get_observation_space(env.observation_action_space.raw_observation_space)
+        else:
+            self.observation_space = env.observation_action_space.raw_observation_space
         self.__observation = None
-        self.pre_processing = PreProcessing()
+        # The lidar's sweeps are padded to a fixed size unless the pre-processing downsamples them
+        self.__pad_lidar_sweeps = not (self.__preprocess_observations and self.pre_processing.has_stage('lidar_downsampling'))
+        # The camera's frame is only copied if no pre-processing writes it into its own buffer (the frame is a view of the camera's ring buffer)
+        self.__copy_rgb_frames = not (self.__preprocess_observations and self.pre_processing.has_stage('rgb_image'))
+        # The last observations are stacked after the pre-processing (without pre-processing, VecPreProcessing stacks them)
+        self.__frame_stack = FrameStack(self.observation_space) if self.__preprocess_observations and config.FRAME_STACK > 1 else None
+        if self.__frame_stack is not None:
+            self.observation_space = self.__frame_stack.observation_space
+
+        # Reward (each environment has its own reward state)
+        self.__reward_computer = RewardComputer()
+        # Optional trajectory log, the rewards can be recomputed offline from it (see env/offline_reward.py)
+        self.__trajectory_logger = TrajectoryLogger(trajectory_log_dir) if trajectory_log_dir is not None else None
 
         # 6: Action space
         if self.__is_continuous:
@@ -129,12 +153,18 @@ class CarlaEnv(gym.Env):
         # 3. Place the spectator
         self.place_spectator_above_vehicle()
         
-        # 4. Get the initial state (Get the observation data)
-        time.sleep(0.5)
-        self.__update_observation()
+        # 4. Get the initial state (Wait until every sensor delivered the data of the first frame)
+        frame = self.__world.tick() if self.__synchronous_mode else self.__world.wait_for_tick()
+        self.__vehicle.update_state()
+        if self.__frame_stack is not None:
+            self.__frame_stack.reset()
+        self.__update_observation(frame)
         
-        # 5. Start the timer
+        # 5. Start the timer and clear the reward's episode state
         self.__start_timer()
+        self.__reward_computer.reset()
+        if self.__trajectory_logger is not None:
+            self.__start_trajectory_log()
         print("Episode started!")
         
         self.number_of_steps = 0
@@ -150,23 +180,28 @@ class CarlaEnv(gym.Env):
 
     def step(self, action):
         # 0. Tick the world if in synchronous mode
+        frame = None
         if self.__synchronous_mode:
             try:
-                self.__world.tick()
+                frame = self.__world.tick()
             except KeyboardInterrupt:
                 self.clean_scenario()
                 print("Episode interrupted!")
                 exit(0)
+        # 0.5 Cache the vehicle's state of this frame (the reward and the observation read it instead of making RPCs)
+        self.__vehicle.update_state()
         self.number_of_steps += 1
         # 1. Control the vehicle
         self.__control_vehicle(np.array(action))
         # 1.5 Tick the display if it is active
         if self.__show_sensor_data:
             self.display.play_window_tick()
-        # 2. Update the observation
-        self.__update_observation()
+        # 2. Update the observation (In synchronous mode it waits for the sensors' data of the current frame)
+        self.__update_observation(frame)
         # 3. Calculate the reward
-        reward, terminated = calculate_reward(self.__vehicle, self.__world, self.__map, self.__active_scenario_dict, self.number_of_steps, self.__time_limit_reached)
+        reward, terminated = self.__reward_computer.calculate_reward(self.__vehicle, self.__world, self.__map, self.__active_scenario_dict, self.number_of_steps, self.__time_limit_reached)
+        if self.__trajectory_logger is not None:
+            self.__trajectory_logger.log_step(self.__vehicle, self.__world, self.__time_limit_reached)
         # 5. Check if the episode is truncated
         try:
             self.__truncated = self.__timer_truncated()
@@ -175,12 +210,17 @@ class CarlaEnv(gym.Env):
             print("Episode interrupted!")
             exit(0)
         if self.__truncated or terminated:
-            self.clean_scenario()
-        # 5. Return the observation, the reward, the terminated flag and the scenario information
-        return self.__observation, reward, terminated, self.__truncated, self.__active_scenario_dict
+            # In soft reset mode the ego vehicle is kept alive, so it can be reused if the next scenario is on the same map
+            self.clean_scenario(keep_ego=self.__soft_reset)
+        # 5. Return the observation, the reward, the terminated flag and the scenario information (along with each reward term's value and time)
+        info = {**self.__active_scenario_dict, 'reward_terms': self.__reward_computer.get_last_terms(), 'reward_inputs_time': self.__reward_computer.get_last_input_times()}
+        return self.__observation, reward, terminated, self.__truncated, info
 
     # Closes everything, more precisely, destroys the vehicle, along with its sensors, destroys every npc and then destroys the world
     def close(self):
+        # 0. Write the last episode's trajectory
+        if self.__trajectory_logger is not None:
+            self.__trajectory_logger.end_episode()
         # 1. Destroy the vehicle
         self.__vehicle.destroy_vehicle()
         # 2. Destroy pedestrians and traffic vehicles
@@ -194,8 +234,12 @@ class CarlaEnv(gym.Env):
 
 
     # ===================================================== OBSERVATION/ACTION METHODS =====================================================
-    def __update_observation(self):        
-        observation_space = self.__vehicle.get_observation_data()
+    def __update_observation(self, frame=None):
+        # In asynchronous mode the sensors' data is synchronized with the frame of the vehicle's state
+        state = self.__vehicle.get_state()
+        if frame is None and state is not None:
+            frame = state.frame
+        observation_space = self.__vehicle.get_observation_data(frame)
         rgb_image = observation_space[0]
         lidar_point_cloud = observation_space[1]
         current_position = observation_space[2]
@@ -203,14 +247,26 @@ class CarlaEnv(gym.Env):
         situation = self.__situations_map[self.__active_scenario_dict['situation']]
 
         observation = {
-            'rgb_data': np.uint8(rgb_image),
-            'lidar_data': np.float32(lidar_point_cloud),
+            'rgb_data': np.uint8(rgb_image) if self.__copy_rgb_frames else rgb_image,
+            'lidar_data': self.__pad_lidar(lidar_point_cloud) if self.__pad_lidar_sweeps else lidar_point_cloud,
             'position': np.float32(current_position),
             'target_position': np.float32(target_position),
             'situation': situation
         }
         
-        self.__observation = self.pre_processing.preprocess_data(observation)
+        self.__observation = self.pre_processing.preprocess_data(observation) if self.__preprocess_observations else observation
+        if self.__frame_stack is not None:
+            self.__observation = self.__frame_stack.push(self.__observation)
+
+    # The raw observations have a fixed size: the sweep is padded with zeros (or strided down if it is bigger), the padding is masked by VecPreProcessing
+    def __pad_lidar(self, lidar_point_cloud):
+        padded = np.zeros(env.observation_action_space.observation_shapes['raw_lidar_data'], dtype=np.float32)
+        if lidar_point_cloud is None:
+            return padded
+        if len(lidar_point_cloud) > len(padded):
+            lidar_point_cloud = lidar_point_cloud[np.linspace(0, len(lidar_point_cloud) - 1, len(padded), dtype=int)]
+        padded[:len(lidar_point_cloud)] = lidar_point_cloud
+        return padded
 
     # ===================================================== SCENARIO METHODS =====================================================
     def load_scenario(self, scenario_name, seed=None):
@@ -224,6 +280,11 @@ class CarlaEnv(gym.Env):
         self.__seed = seed
         self.__active_scenario_dict = scenario_dict
          
+        # The ego vehicle (and its sensors) can only be reused if the next scenario is on the same map
+        reuse_ego = self.__soft_reset and self.__vehicle.get_vehicle() is not None and scenario_dict['map_name'] == self.__world.get_active_map_name()
+        if not reuse_ego:
+            self.__vehicle.destroy_vehicle()
+
         # World
         # This is a fix to a weird bug that happens when the first town is the same as the default map (comment and run a couple of times to see the bug)
         if self.__first_episode and self.__active_scenario_dict['map_name'] == self.__world.get_active_map_name():
@@ -232,7 +293,8 @@ class CarlaEnv(gym.Env):
         
         self.__load_world(scenario_dict['map_name'])
         self.__map = self.__world.update_traffic_map()
-        time.sleep(2.0)
+        # Precompute the stop lines of the new world (the infraction checks of every step use them)
+        self.__world.get_infraction_index()
         if self.__verbose:
             print("World loaded!")
         
@@ -242,12 +304,19 @@ class CarlaEnv(gym.Env):
             print(self.__world.get_active_weather(), " weather preset loaded!")
         
         # Ego vehicle
-        self.__spawn_vehicle(scenario_dict)
-        if self.__show_sensor_data:   
-            self.display = Display('Ego Vehicle Sensor feed', self.__vehicle)
-            self.display.play_window_tick()
-        if self.__verbose:
-            print("Vehicle spawned!")
+        if reuse_ego:
+            self.__teleport_vehicle(scenario_dict)
+            if self.__verbose:
+                print("Vehicle reused!")
+        else:
+            self.__spawn_vehicle(scenario_dict)
+            # Wait until every sensor of the new vehicle produced data (in synchronous mode the sensors only produce data when the world ticks)
+            Readiness.wait_for_sensors(self.__vehicle, tick=self.__world.tick if self.__synchronous_mode else None)
+            if self.__show_sensor_data:   
+                self.display = Display('Ego Vehicle Sensor feed', self.__vehicle)
+                self.display.play_window_tick()
+            if self.__verbose:
+                print("Vehicle spawned!")
         
         # Traffic
         if self.__has_traffic:
@@ -257,8 +326,10 @@ class CarlaEnv(gym.Env):
                 print("Traffic spawned!")
         self.__toggle_lights()
 
-    def clean_scenario(self):
-        self.__vehicle.destroy_vehicle()
+    # If keep_ego is True, the ego vehicle and its sensors aren't destroyed (soft reset)
+    def clean_scenario(self, keep_ego=False):
+        if not keep_ego:
+            self.__vehicle.destroy_vehicle()
         self.__world.destroy_vehicles()
         self.__world.destroy_pedestrians()
         if self.__verbose:
@@ -276,6 +347,18 @@ class CarlaEnv(gym.Env):
         rotation = (s_dict['initial_rotation']['pitch'], s_dict['initial_rotation']['yaw'], s_dict['initial_rotation']['roll'])
         self.__vehicle.spawn_vehicle(location, rotation)
     
+    # Soft reset: moves the existing ego vehicle to the scenario's initial pose and waits for one tick so the new pose takes effect
+    def __teleport_vehicle(self, s_dict):
+        location = (s_dict['initial_position']['x'], s_dict['initial_position']['y'], s_dict['initial_position']['z'])
+        rotation = (s_dict['initial_rotation']['pitch'], s_dict['initial_rotation']['yaw'], s_dict['initial_rotation']['roll'])
+        self.__vehicle.teleport(location, rotation)
+        if self.__synchronous_mode:
+            self.__world.tick()
+        else:
+            self.__world.wait_for_tick()
+        # The teleport itself might trigger the collision or lane invasion sensors
+        self.__vehicle.reset_sensor_latches()
+    
     def __toggle_lights(self):
         if "night" in self.__world.get_active_weather().lower() or "noon" in self.__world.get_active_weather().lower():
             self.__world.toggle_lights(lights_on=True)
@@ -319,12 +402,17 @@ class CarlaEnv(gym.Env):
             np.random.seed(seed)
         return np.random.choice(self.situations_list)
 
+    # The scheduler keeps consecutive episodes on the same map to avoid reloading the world, while keeping the target distribution of the scenarios
     def __chose_situation(self, seed):
         if isinstance(seed, str):
             print("Seed needs to be an integer! Loading a random scenario...")
-            return self.__choose_random_situation()
-        else:
-            return self.__choose_random_situation(seed)
+        elif seed is not None:
+            self.__scheduler.seed(seed)
+        return self.__scheduler.next_scenario()
+    
+    # Number of episodes, visits and mean dwell of each map
+    def get_scheduler_statistics(self):
+        return self.__scheduler.get_statistics()
     
     # ===================================================== SITUATIONS PARSING =====================================================
     # Filter the current situations based on the flag
@@ -354,7 +442,15 @@ class CarlaEnv(gym.Env):
     
     def __start_timer(self):
         self.start_time = time.time()
-        
+
+    # Starts the trajectory of the new episode. The map's data is exported (once) next to the trajectories, so the rewards can be recomputed without the simulator.
+    def __start_trajectory_log(self):
+        map_name = self.__world.get_active_map_name()
+        map_data_path = os.path.join(self.__trajectory_logger.get_directory(), f'map_data_{map_name}.npz')
+        if not os.path.exists(map_data_path):
+            export_map_data(self.__world, self.situations_dict, map_data_path)
+        self.__trajectory_logger.start_episode(self.__active_scenario_name, map_name)
+
     # ===================================================== DEBUG METHODS =====================================================
     def place_spectator_above_vehicle(self):
         self.__world.place_spectator_above_location(self.__vehicle.get_location())    
@@ -367,25 +463,25 @@ class CarlaEnv(gym.Env):
                                        color=carla.Color(r=255, g=0, b=0), life_time=120.0,
                                        persistent_lines=True)
             
+    # Route from the scenario's initial position to its target position as a (K, 3) polyline (memoized by the route planner)
+    def get_scenario_route(self):
+        return self.__world.get_route_planner().plan_scenario(self.__active_scenario_dict)
+
     def output_waypoints_to_target(self, spacing=5):
         current_location = self.__vehicle.get_location()
-        map_ = self.__map
         target_location = carla.Location(x=self.__active_scenario_dict['target_position']['x'], y=self.__active_scenario_dict['target_position']['y'], z=self.__active_scenario_dict['target_position']['z'])
 
-        # Find the closest waypoint to the current location
-        current_waypoint = map_.get_waypoint(current_location)
-
-        # Find the closest waypoint to the target location
-        target_waypoint = map_.get_waypoint(target_location)
+        # Plan the route with A* over the map's topology
+        route = self.__world.get_route_planner().plan(current_location, target_location, start_yaw=self.__vehicle.get_transform().rotation.yaw)
+        if route is None:
+            return
 
-        # Generate waypoints along the route with the specified spacing
-        waypoints = []
-        while current_waypoint.transform.location.distance(target_waypoint.transform.location) > spacing:
-            waypoints.append(current_waypoint.transform.location)
-            current_waypoint = current_waypoint.next(spacing)[0]
+        # Keep a point every spacing meters along the route
+        distances = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(route, axis=0), axis=1))))
+        waypoints = route[np.unique(np.searchsorted(distances, np.arange(0.0, distances[-1], spacing)))]
 
         # Draw the waypoints
         for w in waypoints:
-            self.__world.get_world().debug.draw_string(w, 'O', draw_shadow=False,
+            self.__world.get_world().debug.draw_string(carla.Location(x=float(w[0]), y=float(w[1]), z=float(w[2])), 'O', draw_shadow=False,
                                                     color=carla.Color(r=255, g=0, b=0), life_time=10.0,
                                                     persistent_lines=True)
\ No newline at end of file
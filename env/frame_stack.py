@@ -0,0 +1,122 @@
+'''
+Frame Stacking Module:
+    Stacks the last FRAME_STACK observations of the keys in FRAME_STACK_KEYS (e.g., the camera, the lidar's points and the GNSS position), so the policy can see the motion.
+    It's applied after the pre-processing, by CarlaEnv (or by VecPreProcessing when the environments leave the pre-processing to it). Each stacked key has a new first axis: (k, *shape), oldest frame first.
+
+    - Each key has a circular buffer of references to its last k frames, so a step only copies the new frame (the pre-processing reuses its buffers), never the whole stack
+    - CarlaEnv returns LazyFrames: they share their frames with the neighbouring observations and are only stacked into an array when they are converted (np.asarray, or when a vectorized environment copies them)
+      A replay buffer that keeps the LazyFrames therefore stores each frame once instead of k times
+    - At the start of an episode the buffer is filled with its first frame
+'''
+import numpy as np
+from gymnasium import spaces
+
+import configuration as config
+
+# The frames of an observation, stacked only when converted to an array
+class LazyFrames:
+    __slots__ = ('frames',)
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def __array__(self, dtype=None, copy=None):
+        stacked = np.stack(self.frames)
+        return stacked if dtype is None else stacked.astype(dtype, copy=False)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    @property
+    def shape(self):
+        return (len(self.frames), *self.frames[0].shape)
+
+    @property
+    def dtype(self):
+        return self.frames[0].dtype
+
+# Circular buffer of references to the last k frames of one key of one environment
+class FrameRing:
+    def __init__(self, k):
+        self.k = k
+        self.__frames = [None] * k
+        self.__head = 0  # Index of the oldest frame
+        self.__empty = True
+
+    def clear(self):
+        self.__empty = True
+
+    def push(self, frame):
+        if self.__empty:
+            self.__frames = [frame] * self.k
+            self.__head = 0
+            self.__empty = False
+        else:
+            self.__frames[self.__head] = frame
+            self.__head = (self.__head + 1) % self.k
+        return self.get()
+
+    def get(self):
+        return tuple(self.__frames[(self.__head + i) % self.k] for i in range(self.k))
+
+    # The stack that pushing the frame would give, without pushing it (e.g., for the terminal observation of an episode)
+    def peek(self, frame):
+        if self.__empty:
+            return (frame,) * self.k
+        return self.get()[1:] + (frame,)
+
+class FrameStack:
+    def __init__(self, observation_space, k=None, keys=None, num_envs=1):
+        self.k = config.FRAME_STACK if k is None else k
+        keys = config.FRAME_STACK_KEYS if keys is None else keys
+        self.keys = [key for key in keys if key in observation_space.spaces]
+        self.observation_space = FrameStack.stacked_space(observation_space, self.k, self.keys)
+        self.__rings = [{key: FrameRing(self.k) for key in self.keys} for _ in range(num_envs)]
+
+    @staticmethod
+    def stacked_space(observation_space, k, keys):
+        observation_spaces = dict(observation_space.spaces)
+        for key in keys:
+            space = observation_spaces[key]
+            observation_spaces[key] = spaces.Box(low=np.repeat(space.low[None], k, axis=0), high=np.repeat(space.high[None], k, axis=0), dtype=space.dtype)
+        return spaces.Dict(observation_spaces)
+
+    # Forgets the frames of the environments (all of them by default), their next observation starts a new stack
+    def reset(self, indices=None):
+        for idx in range(len(self.__rings)) if indices is None else indices:
+            for ring in self.__rings[idx].values():
+                ring.clear()
+
+    # Observation of one environment -> the same observation with LazyFrames in the stacked keys
+    def push(self, observation_data, env_idx=0):
+        stacked = dict(observation_data)
+        for key in self.keys:
+            stacked[key] = LazyFrames(self.__rings[env_idx][key].push(np.array(observation_data[key])))
+        return stacked
+
+    # Observations of N environments {key: (N, ...)} -> {key: (N, k, ...)}. The environments in dones start a new stack with their observation,
+    # their terminal observations (in the infos, like stable-baselines3's vectorized environments) are stacked with the frames of the episode that ended.
+    def push_batch(self, observation_data, dones=None, infos=None):
+        num_envs = len(self.__rings)
+        if dones is not None:
+            for idx in np.flatnonzero(dones):
+                if infos is not None and 'terminal_observation' in infos[idx]:
+                    terminal = dict(infos[idx]['terminal_observation'])
+                    for key in self.keys:
+                        terminal[key] = np.stack(self.__rings[idx][key].peek(terminal[key]))
+                    infos[idx]['terminal_observation'] = terminal
+            self.reset(np.flatnonzero(dones))
+
+        # Each call returns new arrays: the caller (e.g., SB3's _last_obs) still holds the previous observations while the next step runs
+        stacked = dict(observation_data)
+        for key in self.keys:
+            frames = np.asarray(observation_data[key])
+            out = np.empty((num_envs, self.k, *frames.shape[1:]), dtype=frames.dtype)
+            for idx in range(num_envs):
+                for i, frame in enumerate(self.__rings[idx][key].push(np.array(frames[idx]))):
+                    out[idx, i] = frame
+            stacked[key] = out
+        return stacked
@@ -1,10 +1,12 @@
 from gymnasium import spaces
 import numpy as np
+import configuration as config
 
 # Change this according to your needs.
 observation_shapes = {
     'rgb_data': (360, 640, 3),
     'lidar_data': (3, 500), 
+    'raw_lidar_data': (config.LIDAR_RAW_MAX_POINTS, 4), # Zero padded lidar sweep before the pre-processing (x, y, z, intensity)
     'position': (3,),
     'target_position': (3,),
     'num_of_stuations': 4
@@ -25,6 +27,12 @@ observation_space = spaces.Dict({
     'situation': spaces.Discrete(observation_shapes['num_of_stuations'])
 })
 
+# Observation space of an environment that leaves the pre-processing to a vectorized wrapper (CarlaEnv(preprocess_observations=False), see env/vec_pre_processing.py)
+raw_observation_space = spaces.Dict({
+    **observation_space.spaces,
+    'lidar_data': spaces.Box(low=-np.inf, high=np.inf, shape=observation_shapes['raw_lidar_data'], dtype=np.float32),
+})
+
 # For continuous actions
 continuous_action_space = spaces.Box(low=np.array([-1.0, -1.0]), high=np.array([1.0, 1.0]), dtype=np.float32)
 
@@ -0,0 +1,298 @@
+'''
+Offline Reward Module:
+    It recomputes the terms of env/reward.py from logged trajectories without the simulator, so reward shaping experiments (e.g., sweeping ENV_REWARDS_LAMBDAS or relabeling a replay buffer) take seconds instead of new CARLA runs.
+
+    - TrajectoryLogger: Logs the ego's state of every step (pose, speed, collision/lane invasion flags, time limit flag and the traffic lights' states), one .npz file per episode
+    - export_map_data: Exports the data of the current map that the terms need (lane samples, stop lines and the scenarios' targets and routes), once per town
+    - recompute_rewards: Recomputes every built-in term for whole datasets, vectorized across steps and episodes, and returns one column per term
+
+    The terms match the online ones, except for the route terms: offline, each step is projected on the whole route instead of a window around the last match (they only differ on routes that overlap themselves).
+    The terms registered by plugins (ENV_REWARD_PLUGINS) aren't recomputed.
+'''
+
+import os
+import glob
+import numpy as np
+
+import configuration as config
+from src.waypoint_index import WaypointIndex, FIELDS
+from src.infraction_index import point_segment_distances
+
+STEP_COLUMNS = ['x', 'y', 'z', 'yaw', 'speed', 'frame', 'collision', 'lane_invasion', 'time_limit_reached']
+SEGMENT_FIELDS = ['p0', 'p1', 'center', 'direction', 'road_id', 'lane_id', 'owner']
+OFFLINE_TERMS = ['orientation', 'distance', 'speed', 'destination', 'collision', 'light_pole_transgression', 'stop_sign_transgression',
+                 'time_limit', 'time_driving', 'route_progress', 'cross_track']
+
+# ====================================== Trajectory Logger ======================================
+class TrajectoryLogger:
+    def __init__(self, directory):
+        self.__directory = directory
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__episode_count = 0
+        self.__steps = None
+
+    def get_directory(self):
+        return self.__directory
+
+    def start_episode(self, scenario_name, map_name):
+        self.end_episode()
+        self.__scenario_name = scenario_name
+        self.__map_name = map_name
+        self.__steps = {column: [] for column in STEP_COLUMNS}
+        self.__light_states = []
+
+    # Called after the reward of each step, so it logs the same state the reward used
+    def log_step(self, vehicle, world, time_limit_reached):
+        if self.__steps is None:
+            return
+
+        location = vehicle.get_location()
+        state = vehicle.get_state()
+        frame = state.frame if state is not None else -1
+        self.__steps['x'].append(location.x)
+        self.__steps['y'].append(location.y)
+        self.__steps['z'].append(location.z)
+        self.__steps['yaw'].append(vehicle.get_transform().rotation.yaw)
+        self.__steps['speed'].append(vehicle.get_speed())
+        self.__steps['frame'].append(frame)
+        self.__steps['collision'].append(vehicle.collision_occurred())
+        self.__steps['lane_invasion'].append(vehicle.lane_invasion_occurred())
+        self.__steps['time_limit_reached'].append(time_limit_reached)
+        self.__light_states.append(world.get_infraction_index().refresh_light_states(None if frame < 0 else frame).astype(np.int8))
+
+    # Writes the episode (if it has any step) to its own file
+    def end_episode(self):
+        if self.__steps is None:
+            return
+        steps, self.__steps = self.__steps, None
+        if len(steps['x']) == 0:
+            return
+
+        path = os.path.join(self.__directory, f'episode_{os.getpid()}_{self.__episode_count:06d}.npz')
+        self.__episode_count += 1
+        np.savez_compressed(path, scenario_name=self.__scenario_name, map_name=self.__map_name, light_states=np.stack(self.__light_states),
+                            **{column: np.array(values) for column, values in steps.items()})
+
+# Concatenates the logged episodes of a directory. Besides the step columns, it returns the episode of each step, the step number (from 1, like the environment's) and the scenario and map of each episode.
+def load_trajectories(directory):
+    paths = sorted(glob.glob(os.path.join(directory, 'episode_*.npz')))
+    if not paths:
+        raise FileNotFoundError(f"There are no logged episodes in {directory}")
+
+    columns = {column: [] for column in STEP_COLUMNS}
+    light_states, episodes, steps, scenario_names, map_names = [], [], [], [], []
+    for episode, path in enumerate(paths):
+        with np.load(path) as data:
+            length = len(data['x'])
+            for column in STEP_COLUMNS:
+                columns[column].append(data[column])
+            light_states.append(data['light_states'])
+            scenario_names.append(str(data['scenario_name']))
+            map_names.append(str(data['map_name']))
+        episodes.append(np.full(length, episode))
+        steps.append(np.arange(1, length + 1))
+
+    # Episodes on different maps may have a different number of traffic lights, so their states are padded with -1
+    max_lights = max(states.shape[1] for states in light_states)
+    light_states = [np.pad(states, ((0, 0), (0, max_lights - states.shape[1])), constant_values=-1) for states in light_states]
+
+    trajectories = {column: np.concatenate(values) for column, values in columns.items()}
+    trajectories['light_states'] = np.concatenate(light_states)
+    trajectories['episode'] = np.concatenate(episodes)
+    trajectories['step'] = np.concatenate(steps)
+    trajectories['scenario_names'] = np.array(scenario_names)
+    trajectories['map_names'] = np.array(map_names)
+    return trajectories
+
+# ====================================== Map Data ======================================
+# Exports the data of the world's current map: lane samples, stop lines and the targets and routes of the map's scenarios
+# The logged light states are carla.TrafficLightState values. The map data stores the value of Red, so the recomputation doesn't need the carla module (the files exported before it was stored use carla's value).
+RED_LIGHT_STATE = 0
+
+def export_map_data(world, scenarios_dict, path):
+    import carla
+    map_name = world.get_active_map_name()
+    waypoint_index = world.get_waypoint_index()
+    infraction_index = world.get_infraction_index()
+    route_planner = world.get_route_planner()
+
+    data = {f'lane_{field}': waypoint_index.get(field) for field in FIELDS}
+    for prefix, segments in [('stop_sign', infraction_index.get_stop_signs()), ('stop_line', infraction_index.get_stop_lines())]:
+        for field in SEGMENT_FIELDS:
+            data[f'{prefix}_{field}'] = getattr(segments, field)
+
+    names = [name for name, scenario in scenarios_dict.items() if scenario['map_name'] == map_name]
+    routes = []
+    for name in names:
+        route = route_planner.plan_scenario(scenarios_dict[name])
+        routes.append(np.zeros((0, 3)) if route is None else route)
+    data['scenario_names'] = np.array(names)
+    data['scenario_targets'] = np.array([[scenarios_dict[name]['target_position'][axis] for axis in 'xyz'] for name in names]).reshape(-1, 3)
+    data['route_points'] = np.concatenate(routes) if routes else np.zeros((0, 3))
+    data['route_offsets'] = np.concatenate([[0], np.cumsum([len(route) for route in routes])])
+    data['red_light_state'] = int(carla.TrafficLightState.Red)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez_compressed(path, map_name=map_name, **data)
+
+class MapData:
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.map_name = str(data['map_name'])
+            self.waypoint_index = WaypointIndex({field: data[f'lane_{field}'] for field in FIELDS})
+            self.stop_signs = {field: data[f'stop_sign_{field}'] for field in SEGMENT_FIELDS}
+            self.stop_lines = {field: data[f'stop_line_{field}'] for field in SEGMENT_FIELDS}
+            names = [str(name) for name in data['scenario_names']]
+            targets = data['scenario_targets']
+            points, offsets = data['route_points'], data['route_offsets']
+            self.red_light_state = int(data['red_light_state']) if 'red_light_state' in data else RED_LIGHT_STATE
+
+        self.targets = {name: targets[idx] for idx, name in enumerate(names)}
+        self.routes = {name: points[offsets[idx]:offsets[idx + 1]] for idx, name in enumerate(names)}
+
+# Loads every exported map of a directory ({map_name: MapData})
+def load_map_data(directory):
+    map_data = {}
+    for path in sorted(glob.glob(os.path.join(directory, 'map_data_*.npz'))):
+        data = MapData(path)
+        map_data[data.map_name] = data
+    return map_data
+
+# ====================================== Recomputation ======================================
+# Recomputes every built-in term for all the steps. Returns {term: values} plus the weighted 'reward' (with the given lambdas) and the 'terminated' flags.
+def recompute_rewards(trajectories, map_data, lambdas=None, chunk_size=4096):
+    lambdas = dict(config.ENV_REWARDS_LAMBDAS if lambdas is None else lambdas)
+    n = len(trajectories['x'])
+    terms = {name: np.zeros(n) for name in OFFLINE_TERMS}
+    terminated = np.zeros(n, dtype=bool)
+
+    episode_maps = trajectories['map_names'][trajectories['episode']]
+    for map_name in np.unique(trajectories['map_names']):
+        if map_name not in map_data:
+            print(f"Warning: There is no exported data of {map_name}, its steps are skipped.")
+            continue
+        steps = np.nonzero(episode_maps == map_name)[0]
+        _recompute_map(trajectories, steps, map_data[map_name], terms, terminated, chunk_size)
+
+    terms['reward'] = weighted_rewards(terms, [lambdas])[0]
+    terms['terminated'] = terminated
+    return terms
+
+# Weighted sum of the terms for each set of lambdas -> (number of sets, number of steps). It's a single matrix product, so sweeping lambdas is cheap.
+def weighted_rewards(terms, lambdas_list):
+    names = [name for name in OFFLINE_TERMS if any(lambdas.get(name, 0) != 0 for lambdas in lambdas_list)]
+    if not names:
+        return np.zeros((len(lambdas_list), len(terms[OFFLINE_TERMS[0]])))
+    weights = np.array([[lambdas.get(name, 0) for name in names] for lambdas in lambdas_list])
+    return weights @ np.stack([terms[name] for name in names])
+
+def _recompute_map(trajectories, steps, data, terms, terminated, chunk_size):
+    xyz = np.stack([trajectories['x'][steps], trajectories['y'][steps], trajectories['z'][steps]], axis=1)
+    yaw = trajectories['yaw'][steps]
+    speed = trajectories['speed'][steps]
+    episode = trajectories['episode'][steps]
+    step_number = trajectories['step'][steps]
+    scenario = trajectories['scenario_names'][episode]
+
+    # Lane terms
+    lane_idx, _ = data.waypoint_index.query(xyz)
+    lateral_offset, heading_error = data.waypoint_index.lane_offsets(xyz[:, :2], lane_idx, yaw)
+    road_id = data.waypoint_index.get('road_id', lane_idx)
+    lane_id = data.waypoint_index.get('lane_id', lane_idx)
+    terms['orientation'][steps] = np.cos(heading_error * np.pi / 180.)
+    terms['distance'][steps] = np.abs(lateral_offset)
+    terms['speed'][steps] = np.where(speed > 50, speed - 50, 0.0)
+
+    # Termination terms
+    targets = np.array([data.targets.get(name, (np.nan, np.nan, np.nan)) for name in scenario])
+    reached = np.linalg.norm(xyz - targets, axis=1) < 2.0
+    collided = trajectories['collision'][steps].astype(bool) | trajectories['lane_invasion'][steps].astype(bool)
+    terms['destination'][steps] = np.where(reached, np.maximum(step_number * (1 / config.ENV_MAX_STEPS) + 1, 0.35), 0.0)
+    terms['collision'][steps] = collided
+    terminated[steps] = reached | collided
+    terms['time_limit'][steps] = trajectories['time_limit_reached'][steps]
+    terms['time_driving'][steps] = ~(reached | collided) & (speed > 1.0)
+
+    # Red lights: on a red light's stop line of the same road and direction of travel, while moving
+    stop_lines = data.stop_lines
+    light_states = trajectories['light_states'][steps]
+    red = data.red_light_state
+    on_red_line = np.zeros(len(steps), dtype=bool)
+    if len(stop_lines['p0']) > 0:
+        owners = stop_lines['owner']
+        if owners.max() >= light_states.shape[1]:
+            print(f"Warning: The logged light states of {data.map_name} don't match its exported traffic lights.")
+        owners = np.minimum(owners, light_states.shape[1] - 1)
+        for start in range(0, len(steps), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            distances = point_segment_distances(xyz[chunk, :2], stop_lines['p0'], stop_lines['p1'])
+            same_lane = (road_id[chunk, None] == stop_lines['road_id'][None]) & (np.sign(lane_id[chunk, None]) == np.sign(stop_lines['lane_id'][None]))
+            is_red = light_states[chunk][:, owners] == red
+            on_red_line[chunk] = np.any((distances < 2.0) & same_lane & is_red, axis=1)
+    terms['light_pole_transgression'][steps] = on_red_line & (speed > 0.1)
+
+    # Stop signs: the vehicle is inside a stop sign's area while there is a stop line on its road within 20 meters in front of it
+    # When it leaves the area, it is penalized if it never stopped inside it
+    stop_signs = data.stop_signs
+    ahead = np.zeros(len(steps), dtype=bool)
+    if len(stop_signs['p0']) > 0:
+        for start in range(0, len(steps), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            distances = point_segment_distances(xyz[chunk, :2], stop_signs['p0'], stop_signs['p1'])
+            along = np.einsum('nmj,mj->nm', xyz[chunk, None, :2] - stop_signs['center'][None], stop_signs['direction'])
+            same_road = road_id[chunk, None] == stop_signs['road_id'][None]
+            ahead[chunk] = np.any((distances <= 20.0) & (along <= 0.0) & same_road, axis=1)
+    terms['stop_sign_transgression'][steps] = _stop_sign_penalties(ahead, speed, episode)
+
+    # Route terms, one episode at a time (each one has its own route)
+    for episode_id in np.unique(episode):
+        episode_steps = np.nonzero(episode == episode_id)[0]
+        route = data.routes.get(trajectories['scenario_names'][episode_id])
+        if route is None or len(route) < 2:
+            continue
+        progress, cross_track = _project_on_route(xyz[episode_steps, :2], route[:, :2], chunk_size)
+        terms['route_progress'][steps[episode_steps]] = np.diff(progress, prepend=progress[0])
+        terms['cross_track'][steps[episode_steps]] = np.abs(cross_track)
+
+# Penalty (1) at the first step after each run of steps inside a stop sign's area without stopping. The runs end with their episode (without a penalty).
+def _stop_sign_penalties(ahead, speed, episode):
+    penalties = np.zeros(len(ahead))
+    if not ahead.any():
+        return penalties
+
+    new_episode = np.concatenate(([True], episode[1:] != episode[:-1]))
+    run_start = ahead & (new_episode | ~np.concatenate(([False], ahead[:-1])))
+    starts = np.nonzero(run_start)[0]
+    run_ids = np.cumsum(run_start) - 1
+    stopped = np.zeros(len(starts), dtype=bool)
+    np.logical_or.at(stopped, run_ids[ahead], speed[ahead] < 1.0)
+
+    # The step after a run's last step must be outside the area and in the same episode
+    after = np.nonzero(ahead & ~np.concatenate((ahead[1:], [False])))[0] + 1
+    valid = after < len(ahead)
+    valid[valid] = ~new_episode[after[valid]]
+    penalties[after[valid & ~stopped]] = 1
+    return penalties
+
+# Progress along the route and signed cross track error (positive to the right) of each point, projected on the whole route
+def _project_on_route(points, route, chunk_size):
+    p0 = route[:-1]
+    segments = route[1:] - route[:-1]
+    lengths = np.linalg.norm(segments, axis=1)
+    lengths_squared = np.maximum(lengths ** 2, 1e-12)
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+
+    progress = np.zeros(len(points))
+    cross_track = np.zeros(len(points))
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        deltas = chunk[:, None, :] - p0[None]
+        t = np.clip(np.einsum('nmj,mj->nm', deltas, segments) / lengths_squared, 0.0, 1.0)
+        offsets = deltas - t[:, :, None] * segments[None]
+        best = np.argmin(np.linalg.norm(offsets, axis=2), axis=1)
+        rows = np.arange(len(chunk))
+        progress[start:start + len(chunk)] = cumulative[best] + t[rows, best] * lengths[best]
+        direction = segments[best] / np.maximum(lengths[best], 1e-12)[:, None]
+        offset = offsets[rows, best]
+        cross_track[start:start + len(chunk)] = -direction[:, 1] * offset[:, 0] + direction[:, 0] * offset[:, 1]
+    return progress, cross_track
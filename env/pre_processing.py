@@ -1,30 +1,224 @@
 '''
 Pre-processing Module:
     - This module is used to preprocess the observation data before feeding it to the policy network
+    - The pre-processing is a list of stages, declared in configuration.PREPROCESSING_STAGES and applied in that order. Each stage is only instantiated the first time it's used, and torch is only imported by the stages that need it:
+        - lidar_downsampling: Downsamples the lidar's sweeps with the method of the "downsampling" entry of the lidar in the sensors' JSON file (see env/aux/lidar_downsampler.py)
+        - lidar_features:     Adds the PointNet global features of the downsampled lidar ('lidar_features', 1024 values). It imports torch, LIDAR_FEATURES_MODEL chooses the eager, fused or int8 PointNet.
+        - rgb_image:          Crops the camera's images to configuration.RGB_CROP, resizes them to RGB_RESOLUTION and optionally converts them to grayscale (RGB_GRAYSCALE) and to channels first (RGB_CHANNELS_FIRST).
+                              They remain uint8 (a single environment's images are written into preallocated buffers), so the policy's memory and compute don't depend on the camera's resolution
+    - Each stage also updates the observation space, so the environment's observation space always matches its stages
+    - preprocess_data processes the observation of a single environment, preprocess_batch processes the stacked observations of a vectorized environment in one call (see env/vec_pre_processing.py)
 '''
+import json
 import numpy as np
-from env.aux.farthest_sampler import FarthestSampler
-from env.aux.point_net import PointNetfeat
-import torch
+from gymnasium import spaces
 
+from env.observation_action_space import observation_shapes
+import configuration as config
+
+# ====================================== Stages ======================================
+class LidarDownsamplingStage:
+    def __init__(self, sensors_dict):
+        from env.aux.lidar_downsampler import LidarDownsampler
+        # The downsampler (and its sampler's workspace) is kept between steps, so it is created once
+        self.downsampler = LidarDownsampler.from_sensor_dict(sensors_dict.get('lidar', {}))
+        self.num_points = observation_shapes['lidar_data'][1]
+
+    @staticmethod
+    def update_observation_space(observation_spaces):
+        observation_spaces['lidar_data'] = spaces.Box(low=-np.inf, high=np.inf, shape=observation_shapes['lidar_data'], dtype=np.float32)
+
+    def process(self, observation_data):
+        # The sweep has every point the lidar delivered in the frame (an empty sweep is sampled as a single point at the origin)
+        lidar_data = observation_data['lidar_data']
+        if lidar_data is None or len(lidar_data) == 0:
+            lidar_data = np.zeros((1, 4), dtype=np.float32)
+        observation_data['lidar_data'] = self.process_lidar_batch(lidar_data[None])[0]
+
+    def process_batch(self, observation_data, lidar_mask=None):
+        observation_data['lidar_data'] = self.process_lidar_batch(observation_data['lidar_data'], lidar_mask)
+
+    # Downsamples the lidar data of N environments (N, P, 4) -> (N, 3, num_points), so the number of points remains constant without affecting the quality of the data
+    # The clouds may have a different number of valid points: mask (N, P) tells which ones are valid (e.g., from PreProcessing.padding_mask). The invalid points are never sampled.
+    def process_lidar_batch(self, lidar_data, mask=None):
+        lidar_data = np.asarray(lidar_data)
+        points = lidar_data[:, :, :3].transpose([0, 2, 1])
+        if mask is None:
+            return np.float32(self.downsampler.sample_batch(points, self.num_points))
+
+        # Move the valid points of each cloud to its front (keeping their order, so the sampling is the same as without the invalid points)
+        mask = np.asarray(mask, dtype=bool)
+        order = np.argsort(~mask, axis=1, kind='stable')
+        points = np.take_along_axis(points, order[:, None, :], axis=2)
+        # A cloud without valid points is sampled from its first (padding) point, so its sample is that point repeated
+        lengths = np.maximum(mask.sum(axis=1), 1)
+        return np.float32(self.downsampler.sample_batch(points, self.num_points, lengths=lengths))
+
+LIDAR_FEATURES_MODELS = ['eager', 'fused', 'int8']
+
+class LidarFeaturesStage:
+    NUM_FEATURES = 1024
+
+    def __init__(self, sensors_dict):
+        import torch
+        from env.aux.point_net import PointNetfeat
+        self.torch = torch
+        if config.LIDAR_FEATURES_MODEL not in LIDAR_FEATURES_MODELS:
+            raise ValueError(f"Unknown lidar features model {config.LIDAR_FEATURES_MODEL}, it must be one of {LIDAR_FEATURES_MODELS}")
+        from env.aux.point_net_inference import GlobalFeatures, export_point_net
+        pointfeat = PointNetfeat(global_feat=True).eval()
+        if config.LIDAR_FEATURES_MODEL == 'eager':
+            self.pointfeat = GlobalFeatures(pointfeat).eval()
+        else:
+            self.pointfeat = export_point_net(pointfeat, quantized=config.LIDAR_FEATURES_MODEL == 'int8', num_points=observation_shapes['lidar_data'][1])
+
+    @staticmethod
+    def update_observation_space(observation_spaces):
+        observation_spaces['lidar_features'] = spaces.Box(low=-np.inf, high=np.inf, shape=(LidarFeaturesStage.NUM_FEATURES,), dtype=np.float32)
+
+    def process(self, observation_data):
+        observation_data['lidar_features'] = self.__features(observation_data['lidar_data'][None])[0]
+
+    def process_batch(self, observation_data, lidar_mask=None):
+        observation_data['lidar_features'] = self.__features(observation_data['lidar_data'])
+
+    def __features(self, lidar_data):
+        with self.torch.inference_mode():
+            features = self.pointfeat(self.torch.from_numpy(np.ascontiguousarray(lidar_data, dtype=np.float32)))
+        return features.numpy()
+
+class RgbImageStage:
+    NUM_OUTPUT_BUFFERS = 2
+
+    def __init__(self, sensors_dict):
+        import cv2
+        self.cv2 = cv2
+        self.shape = RgbImageStage.output_shape()
+        self.height, self.width = RgbImageStage.__resolution()
+        self.__crop = RgbImageStage.__crop_slices()
+        self.__scratch = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        # Preallocated outputs of the single environment path, used in turns (the observation of the previous step stays valid while the next one is written)
+        self.__outputs = np.empty((self.NUM_OUTPUT_BUFFERS, *self.shape), dtype=np.uint8)
+        self.__output_index = 0
+
+    # Rows and columns of the region of interest (RGB_CROP is (top, bottom, left, right), None keeps the whole image)
+    @staticmethod
+    def __crop_slices():
+        if config.RGB_CROP is None:
+            return (slice(None), slice(None))
+        top, bottom, left, right = config.RGB_CROP
+        return (slice(top, bottom), slice(left, right))
+
+    # Size of the images after the crop and the resize (RGB_RESOLUTION None keeps the cropped size)
+    @staticmethod
+    def __resolution():
+        if config.RGB_RESOLUTION is not None:
+            return tuple(config.RGB_RESOLUTION)
+        rows, columns = RgbImageStage.__crop_slices()
+        height, width = observation_shapes['rgb_data'][:2]
+        return len(range(height)[rows]), len(range(width)[columns])
+
+    @staticmethod
+    def output_shape():
+        height, width = RgbImageStage.__resolution()
+        channels = 1 if config.RGB_GRAYSCALE else 3
+        return (channels, height, width) if config.RGB_CHANNELS_FIRST else (height, width, channels)
+
+    @staticmethod
+    def update_observation_space(observation_spaces):
+        observation_spaces['rgb_data'] = spaces.Box(low=0, high=255, shape=RgbImageStage.output_shape(), dtype=np.uint8)
+
+    def process(self, observation_data):
+        self.__output_index = (self.__output_index + 1) % self.NUM_OUTPUT_BUFFERS
+        out = self.__outputs[self.__output_index]
+        self.__process_into(observation_data['rgb_data'], out)
+        observation_data['rgb_data'] = out
+
+    # The batches get a new array each call: the caller (e.g., SB3's _last_obs) still holds the previous observations, and the terminal observations are processed in the same step
+    def process_batch(self, observation_data, lidar_mask=None):
+        images = observation_data['rgb_data']
+        out = np.empty((len(images), *self.shape), dtype=np.uint8)
+        for i in range(len(images)):
+            self.__process_into(images[i], out[i])
+        observation_data['rgb_data'] = out
+
+    # Crop (a view), resize and convert the image (HWC RGB) directly into out
+    def __process_into(self, image, out):
+        image = image[self.__crop]
+        if config.RGB_GRAYSCALE:
+            # (1, H, W) and (H, W, 1) have the same memory layout, so the conversion writes into out as (H, W)
+            self.cv2.cvtColor(self.__resize(image, self.__scratch), self.cv2.COLOR_RGB2GRAY, dst=out.reshape(self.height, self.width))
+        elif config.RGB_CHANNELS_FIRST:
+            np.copyto(out, self.__resize(image, self.__scratch).transpose(2, 0, 1))
+        else:
+            resized = self.__resize(image, out)
+            if resized is not out:
+                np.copyto(out, resized)
+
+    # INTER_AREA averages the pixels of each output pixel, so downscaling doesn't alias
+    def __resize(self, image, dst):
+        if image.shape[:2] == (self.height, self.width):
+            return image
+        return self.cv2.resize(image, (self.width, self.height), dst=dst, interpolation=self.cv2.INTER_AREA)
+
+PREPROCESSING_STAGES = {
+    'lidar_downsampling': LidarDownsamplingStage,
+    'lidar_features': LidarFeaturesStage,
+    'rgb_image': RgbImageStage,
+}
+
+# ====================================== Pre-processing ======================================
 class PreProcessing:
-    def __init__(self) -> None:
-        self.sampler = FarthestSampler()
-        self.pointfeat = PointNetfeat(global_feat=True)
-        self.pointfeat = self.pointfeat.eval()
-    
+    # sensors_dict: the vehicle's sensors (by default, the JSON file of the configuration), the stages read their sensor's entry
+    def __init__(self, stages=None, sensors_dict=None) -> None:
+        self.__stage_names = list(config.PREPROCESSING_STAGES if stages is None else stages)
+        for name in self.__stage_names:
+            if name not in PREPROCESSING_STAGES:
+                raise ValueError(f"Unknown pre-processing stage {name}, it must be one of {list(PREPROCESSING_STAGES)}")
+        self.__sensors_dict = sensors_dict
+        self.__stages = {}
+
+    def get_stage_names(self):
+        return self.__stage_names
+
+    def has_stage(self, name):
+        return name in self.__stage_names
+
+    # Instantiates the stage the first time it's requested
+    def get_stage(self, name):
+        if name not in self.__stages:
+            self.__stages[name] = PREPROCESSING_STAGES[name](self.__get_sensors_dict())
+        return self.__stages[name]
+
+    def __get_sensors_dict(self):
+        if self.__sensors_dict is None:
+            with open(config.VEHICLE_SENSORS_FILE) as f:
+                self.__sensors_dict = json.load(f)
+        return self.__sensors_dict
+
+    # Observation space of the processed observations, given the space of the observations before the pre-processing
+    def get_observation_space(self, observation_space):
+        observation_spaces = dict(observation_space.spaces)
+        for name in self.__stage_names:
+            PREPROCESSING_STAGES[name].update_observation_space(observation_spaces)
+        return spaces.Dict(observation_spaces)
+
     def preprocess_data(self, observation_data):
-        observation_data['lidar_data'] = self.__process_lidar(observation_data['lidar_data'])
+        for name in self.__stage_names:
+            self.get_stage(name).process(observation_data)
+        return observation_data
+
+    # Same as preprocess_data for the stacked observations of N environments, e.g., {'lidar_data': (N, P, 4), ...}
+    def preprocess_batch(self, observation_data, lidar_mask=None):
+        for name in self.__stage_names:
+            self.get_stage(name).process_batch(observation_data, lidar_mask)
         return observation_data
 
-    # This method extracts the features from the lidar data before feeding it to the policy network
-    def __process_lidar(self, lidar_data):
-        lidar_data = lidar_data[:, :-1]
-        lidar_data = lidar_data.transpose([1, 0])
-        
-        # Sample the lidar data so the number of points remains constant without affecting the quality of the data
-        sampler = FarthestSampler()
-        lidar_data, _ = sampler.sample(lidar_data, 500)
-        
-        return np.float32(lidar_data)
-        
\ No newline at end of file
+    # Downsamples the lidar data of N environments (N, P, 4) -> (N, 3, num_points), see LidarDownsamplingStage
+    def process_lidar_batch(self, lidar_data, mask=None):
+        return self.get_stage('lidar_downsampling').process_lidar_batch(lidar_data, mask)
+
+    # The raw observations pad the lidar's sweeps with zeros up to a fixed number of points (see CarlaEnv(preprocess_observations=False)), a real point is never exactly at the sensor's origin
+    @staticmethod
+    def padding_mask(lidar_data):
+        return np.any(np.asarray(lidar_data)[:, :, :3] != 0, axis=2)
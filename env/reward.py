@@ -1,141 +1,276 @@
+'''
+Reward Module:
+    The RewardComputer calculates the reward of each step. Each environment owns its own instance, so the episode's state (stop sign area, route tracker, ...) is never shared between environments of the same process (e.g., a DummyVecEnv).
+
+    The reward is a weighted sum of terms kept in a registry. Each term declares the inputs it needs (e.g., the vehicle's snapshot, its lane, the landmarks or the sensors), and:
+        - Only the terms with a non-zero lambda (configuration.ENV_REWARDS_LAMBDAS) are evaluated
+        - Each input is fetched at most once per step, and only if a evaluated term needs it
+        - The terms that end the episode (terminates=True) always run, even if their lambda is zero
+        - The value and wall time of every evaluated term (and the fetch time of every input) are recorded, the environment returns them in the info dictionary
+
+    New terms can be added without changing the environment: register them with the reward_term decorator in a module listed in configuration.ENV_REWARD_PLUGINS and give them a lambda, e.g.:
+        @reward_term('lateral_acceleration', inputs=['snapshot'])
+        def lateral_acceleration_reward(context):
+            ...
+'''
+
+import time
+import importlib
+
 from src.vehicle import Vehicle
 from src.world import World
+from src.route_planner import RouteTracker
 import configuration as config
 import carla
 import numpy as np
 
-terminated = False
-inside_stop_area = False
-has_stopped = False
-
-# ======================================== Main Reward Function ==========================================================
-# If you change this function's signature, you must change the signature of the function in the environment.py file!!
-def calculate_reward(vehicle: Vehicle, world: World, map: carla.Map, scenario_dict, num_steps: int, time_limit_reached: bool) -> float:
-    global terminated
-    vehicle_location = vehicle.get_location()
-    waypoint = map.get_waypoint(vehicle_location, project_to_road=True, lane_type=carla.LaneType.Driving)
-    reward_lambdas = config.ENV_REWARDS_LAMBDAS
-    terminated = False
-    
-    return reward_lambdas['orientation'] * __get_orientation_reward(waypoint, vehicle) + \
-           reward_lambdas['distance'] * __get_distance_reward(waypoint, vehicle_location) + \
-           reward_lambdas['speed'] * __get_speed_reward(vehicle) + \
-           reward_lambdas['destination'] * __get_destination_reward(vehicle_location, scenario_dict, num_steps) + \
-           reward_lambdas['collision'] * __get_collision_reward(vehicle) + \
-           reward_lambdas['light_pole_transgression'] * __get_light_pole_trangression_reward(map, vehicle, world) + \
-           reward_lambdas['stop_sign_transgression'] * __get_stop_sign_reward(vehicle, map) + \
-           reward_lambdas['time_limit'] * __get_time_limit_reward(time_limit_reached) + \
-           reward_lambdas['time_driving'] * __get_time_driving_reward(vehicle), terminated
-
-# ============================================= Reward Functions ==========================================================
-# This reward is based on the orientation of the vehicle according to the waypoint of where the vehicle is
-# R_orientation = \lambda * cos(\theta), where \theta is the angle between the vehicle and the waypoint
-def __get_orientation_reward(waypoint, vehicle):
-    vh_yaw = __correct_yaw(vehicle.get_vehicle().get_transform().rotation.yaw)
-    wp_yaw = __correct_yaw(waypoint.transform.rotation.yaw)
+# ======================================== Registry ==========================================================
+REWARD_TERMS = {}   # {name: RewardTerm}
+REWARD_INPUTS = {}  # {name: function(context) -> value}
 
-    return np.cos((vh_yaw - wp_yaw)*np.pi/180.)
+class RewardTerm:
+    def __init__(self, name, function, inputs, terminates):
+        self.name = name
+        self.function = function        # function(context) -> float
+        self.inputs = tuple(inputs)     # Names of the inputs it needs
+        self.terminates = terminates    # If True, it may end the episode (context.terminated), so it always runs
 
-# This reward is based on the distance between the vehicle and the waypoint
-def __get_distance_reward(waypoint, vehicle_location):
-    x_wp = waypoint.transform.location.x
-    y_wp = waypoint.transform.location.y
+def reward_term(name, inputs=(), terminates=False):
+    def decorator(function):
+        REWARD_TERMS[name] = RewardTerm(name, function, inputs, terminates)
+        return function
+    return decorator
 
-    x_vehicle = vehicle_location.x
-    y_vehicle = vehicle_location.y
+def reward_input(name):
+    def decorator(function):
+        REWARD_INPUTS[name] = function
+        return function
+    return decorator
 
-    return np.linalg.norm([x_wp - x_vehicle, y_wp - y_vehicle])
+# ======================================== Step Context ==========================================================
+# The inputs of a step are fetched on demand and cached, so each one is fetched at most once per step
+class StepContext:
+    def __init__(self, vehicle: Vehicle, world: World, scenario_dict, num_steps: int, time_limit_reached: bool, episode: dict):
+        self.vehicle = vehicle
+        self.world = world
+        self.scenario_dict = scenario_dict
+        self.num_steps = num_steps
+        self.time_limit_reached = time_limit_reached
+        self.episode = episode          # State kept during the episode (cleared by RewardComputer.reset)
+        self.terminated = False
+        self.input_times = {}
+        self.__inputs = {}
 
-def __get_speed_reward(vehicle, speed_limit=50):
-    vehicle_speed = vehicle.get_speed()
-    return vehicle_speed - speed_limit if vehicle_speed > speed_limit else 0.0
+    def get(self, name):
+        if name not in self.__inputs:
+            start = time.perf_counter()
+            self.__inputs[name] = REWARD_INPUTS[name](self)
+            self.input_times[name] = time.perf_counter() - start
+        return self.__inputs[name]
+
+# ======================================== Inputs ==========================================================
+# The vehicle's kinematic state (from its cached snapshot of the tick)
+@reward_input('snapshot')
+def snapshot_input(context):
+    vehicle_state = context.vehicle.get_state()
+    return {
+        'location': context.vehicle.get_location(),
+        'transform': context.vehicle.get_transform(),
+        'speed': context.vehicle.get_speed(),
+        'frame': vehicle_state.frame if vehicle_state is not None else None,
+    }
+
+# The nearest driving lane (from the map's waypoint index)
+@reward_input('waypoint')
+def waypoint_input(context):
+    snapshot = context.get('snapshot')
+    location = snapshot['location']
+    waypoint_index = context.world.get_waypoint_index()
+    lane_idx, _ = waypoint_index.nearest(location, lane_type=carla.LaneType.Driving)
+    lateral_offset, heading_error = waypoint_index.lane_offsets([[location.x, location.y]], [lane_idx], [snapshot['transform'].rotation.yaw])
+    return {
+        'road_id': waypoint_index.get('road_id', lane_idx),
+        'lane_id': waypoint_index.get('lane_id', lane_idx),
+        'lateral_offset': lateral_offset[0],
+        'heading_error': heading_error[0],
+    }
 
+# The stop lines of the stop signs and traffic lights (from the world's infraction index)
+@reward_input('landmarks')
+def landmarks_input(context):
+    return context.world.get_infraction_index()
+
+@reward_input('sensors')
+def sensors_input(context):
+    return {
+        'collision': context.vehicle.collision_occurred(),
+        'lane_invasion': context.vehicle.lane_invasion_occurred(),
+    }
+
+# Progress along the scenario's route since the last step and the signed cross track error (in meters)
+# The route is planned once per episode (the planner memoizes it) and the tracker only searches a window around the last matched segment
+@reward_input('route')
+def route_input(context):
+    if 'route_tracker' not in context.episode:
+        route = context.world.get_route_planner().plan_scenario(context.scenario_dict)
+        context.episode['route_tracker'] = RouteTracker(route) if route is not None and len(route) > 1 else None
+    route_tracker = context.episode['route_tracker']
+    if route_tracker is None:
+        return {'progress': 0.0, 'cross_track': 0.0}
+
+    location = context.get('snapshot')['location']
+    progress, cross_track = route_tracker.progress_delta(location.x, location.y)
+    return {'progress': progress, 'cross_track': cross_track}
+
+# ============================================= Reward Terms ==========================================================
+# Terms are evaluated in this order, after the terms that end the episode
 # This reward is based on if the vehicle reached the destination. the reward will be based on the number of steps taken to reach the destination. The less steps, the higher the reward, but reaching the destination is the highest reward
-def __get_destination_reward(current_position, scenario_dict, num_steps, threshold=2.0): 
-    global terminated
-    current_position = np.array([current_position.x, current_position.y, current_position.z])
-    target_position = (scenario_dict['target_position']['x'], scenario_dict['target_position']['y'], scenario_dict['target_position']['z'])
-    
+@reward_term('destination', inputs=['snapshot'], terminates=True)
+def destination_reward(context, threshold=2.0):
+    location = context.get('snapshot')['location']
+    current_position = np.array([location.x, location.y, location.z])
+    target_position = (context.scenario_dict['target_position']['x'], context.scenario_dict['target_position']['y'], context.scenario_dict['target_position']['z'])
+
     if np.linalg.norm(current_position - target_position) < threshold:
-        terminated = True
-        return max(num_steps * (1 / config.ENV_MAX_STEPS) + 1, 0.35)
+        context.terminated = True
+        return max(context.num_steps * (1 / config.ENV_MAX_STEPS) + 1, 0.35)
     else:
         return 0
 
 # Collision with other vehicles or pedestrians and even lane invasions
-def __get_collision_reward(vehicle):
-    global terminated
-    if vehicle.collision_occurred() or vehicle.lane_invasion_occurred():
-        terminated = True
+@reward_term('collision', inputs=['sensors'], terminates=True)
+def collision_reward(context):
+    sensors = context.get('sensors')
+    if sensors['collision'] or sensors['lane_invasion']:
+        context.terminated = True
         return 1
     else:
         return 0
 
-def __get_light_pole_trangression_reward(map, vehicle, world):
-    # Get the current waypoint of the vehicle
-    current_waypoint = map.get_waypoint(vehicle.get_location(), project_to_road=True)
+# This reward is based on the orientation of the vehicle according to the waypoint of where the vehicle is
+# R_orientation = \lambda * cos(\theta), where \theta is the angle between the vehicle and the waypoint
+@reward_term('orientation', inputs=['waypoint'])
+def orientation_reward(context):
+    return np.cos(context.get('waypoint')['heading_error']*np.pi/180.)
 
-    # Get the traffic lights affecting the current waypoint
-    traffic_lights = world.get_world().get_traffic_lights_from_waypoint(current_waypoint, distance=10.0)
+# This reward is based on the distance between the vehicle and the center of its lane (i.e., the waypoint projected on the lane)
+@reward_term('distance', inputs=['waypoint'])
+def distance_reward(context):
+    return abs(context.get('waypoint')['lateral_offset'])
 
-    for traffic_light in traffic_lights:
-        # Check if the traffic light is red
-        if traffic_light.get_state() == carla.TrafficLightState.Red:
-            # Get the stop waypoints for the traffic light
-            stop_waypoints = traffic_light.get_stop_waypoints()
+@reward_term('speed', inputs=['snapshot'])
+def speed_reward(context, speed_limit=50):
+    vehicle_speed = context.get('snapshot')['speed']
+    return vehicle_speed - speed_limit if vehicle_speed > speed_limit else 0.0
 
-            # Check if the vehicle has passed the stop line
-            for stop_waypoint in stop_waypoints:
-                if current_waypoint.transform.location.distance(stop_waypoint.transform.location) < 2.0 and vehicle.get_speed() > 0.1:
-                    return 1
+# The vehicle is on the stop line of a red traffic light of its road and moving
+@reward_term('light_pole_transgression', inputs=['snapshot', 'waypoint', 'landmarks'])
+def light_pole_transgression_reward(context):
+    snapshot = context.get('snapshot')
+    waypoint = context.get('waypoint')
+    if snapshot['speed'] > 0.1 and context.get('landmarks').on_red_light_stop_line(snapshot['location'], waypoint['road_id'], waypoint['lane_id'], threshold=2.0, frame=snapshot['frame']):
+        return 1
 
     return 0
 
-def __get_stop_sign_reward(vehicle, map):
-    global inside_stop_area, has_stopped, terminated        
+@reward_term('stop_sign_transgression', inputs=['snapshot', 'waypoint', 'landmarks'])
+def stop_sign_reward(context):
     distance = 20.0  # meters (adjust as needed)
-    
-    current_location = vehicle.get_location()
-    current_waypoint = map.get_waypoint(current_location, project_to_road=True)
-    
-    # Get all the stop sign landmarks within a certain distance from the vehicle and on the same road
-    stop_signs_on_same_road = []
-    for landmark in current_waypoint.get_landmarks_of_type(distance, carla.LandmarkType.StopSign):
-        landmark_waypoint = map.get_waypoint(landmark.transform.location, project_to_road=True)
-        if landmark_waypoint.road_id == current_waypoint.road_id:
-            stop_signs_on_same_road.append(landmark)
-
-    if len(stop_signs_on_same_road) == 0:
+    snapshot = context.get('snapshot')
+    inside_stop_area = context.episode.get('inside_stop_area', False)
+    has_stopped = context.episode.get('has_stopped', False)
+
+    # Check if there is a stop sign's line within a certain distance in front of the vehicle and on the same road
+    stop_sign_ahead = context.get('landmarks').stop_sign_ahead(snapshot['location'], context.get('waypoint')['road_id'], distance)
+
+    if not stop_sign_ahead:
+        context.episode['inside_stop_area'] = False
+        context.episode['has_stopped'] = False
         if inside_stop_area and has_stopped:
             print("Vehicle has stopped at the stop sign.")
-            has_stopped = False
-            inside_stop_area = False
             return 0
         elif inside_stop_area and not has_stopped:
             print("Vehicle has not stopped at the stop sign.")
-            has_stopped = False
-            inside_stop_area = False
             return 1
-        else:            
+        else:
             return 0
-    else:
-        inside_stop_area = True
 
-    # The vehicle entered the stop sign area
-    for stop_sign in stop_signs_on_same_road:
-        # Check if the vehicle has stopped
-        if vehicle.get_speed() < 1.0:
-            has_stopped = True
+    # The vehicle is inside the stop sign area, check if it has stopped (it is only judged when it leaves the area)
+    context.episode['inside_stop_area'] = True
+    if snapshot['speed'] < 1.0:
+        context.episode['has_stopped'] = True
+    return 0
 
 # TODO: I think it's not working properly
-def __get_time_limit_reward(time_limit_reached):
-    return 1 if time_limit_reached else 0
+@reward_term('time_limit')
+def time_limit_reward(context):
+    return 1 if context.time_limit_reached else 0
+
+@reward_term('time_driving', inputs=['snapshot'])
+def time_driving_reward(context):
+    return 1 if not context.terminated and context.get('snapshot')['speed'] > 1.0 else 0
+
+# Progress along the scenario's route (in meters since the last step)
+@reward_term('route_progress', inputs=['route'])
+def route_progress_reward(context):
+    return context.get('route')['progress']
+
+# Absolute cross track error to the scenario's route (in meters)
+@reward_term('cross_track', inputs=['route'])
+def cross_track_reward(context):
+    return abs(context.get('route')['cross_track'])
+
+# ======================================== Reward Computer ==========================================================
+class RewardComputer:
+    def __init__(self, reward_lambdas=None, plugins=None):
+        # The plugin modules register their terms when they are imported
+        for module in (config.ENV_REWARD_PLUGINS if plugins is None else plugins):
+            importlib.import_module(module)
+
+        self.__lambdas = dict(config.ENV_REWARDS_LAMBDAS if reward_lambdas is None else reward_lambdas)
+        for name in self.__lambdas:
+            if name not in REWARD_TERMS:
+                print(f"Warning: There is no reward term named {name}, its lambda is ignored.")
+
+        # Terms that end the episode first (the others may depend on context.terminated), then the ones with a non-zero lambda
+        self.__terms = [term for term in REWARD_TERMS.values() if term.terminates] + \
+                       [term for term in REWARD_TERMS.values() if not term.terminates and self.__lambdas.get(term.name, 0) != 0]
+        self.__last_terms = {}
+        self.__last_input_times = {}
+        self.reset()
+
+    # Clears the episode's state, it must be called at the beginning of every episode
+    def reset(self):
+        self.__episode = {}
+
+    def get_lambdas(self):
+        return self.__lambdas
+
+    # {term: {'value', 'weighted', 'time'}} of the last step, the time (in seconds) doesn't include fetching the inputs
+    def get_last_terms(self):
+        return self.__last_terms
+
+    # {input: fetch time in seconds} of the last step
+    def get_last_input_times(self):
+        return self.__last_input_times
+
+    # If you change this method's signature, you must change the call in the environment.py file!!
+    def calculate_reward(self, vehicle: Vehicle, world: World, map: carla.Map, scenario_dict, num_steps: int, time_limit_reached: bool) -> float:
+        context = StepContext(vehicle, world, scenario_dict, num_steps, time_limit_reached, self.__episode)
+
+        reward = 0.0
+        terms = {}
+        for term in self.__terms:
+            for name in term.inputs:
+                context.get(name)
+            start = time.perf_counter()
+            value = float(term.function(context))
+            elapsed = time.perf_counter() - start
 
-def __get_time_driving_reward(vehicle):
-    global terminated
-    return 1 if not terminated and vehicle.get_speed() > 1.0 else 0
+            weighted = float(self.__lambdas.get(term.name, 0) * value)
+            reward += weighted
+            terms[term.name] = {'value': value, 'weighted': weighted, 'time': elapsed}
 
-# ==================================== Helper Functions ================================================================
-# This function is used to correct the yaw angle to be between 0 and 360 degrees
-def __correct_yaw(x):
-    return(((x%360) + 360) % 360)
+        self.__last_terms = terms
+        self.__last_input_times = context.input_times
+        return reward, context.terminated
@@ -0,0 +1,91 @@
+'''
+Scenario Scheduler Module:
+    It chooses the scenario of each episode while keeping the number of map changes (each one costs a client.load_world) low.
+
+    The scenarios are grouped by map. The scheduler stays on a map for a fixed number of episodes (a dwell) and samples the scenarios of that map from their conditional distribution.
+    The map of each dwell is sampled proportionally to the total weight of its scenarios, so every scenario is still chosen with its target probability in expectation:
+        P(scenario) = P(map) * P(scenario | map) = (W_map / W) * (w_scenario / W_map) = w_scenario / W
+
+    The target weight of a scenario is its "weight" entry in the scenarios JSON (1 if it isn't specified, i.e., uniform sampling).
+    With episodes_per_map=1 it behaves exactly like sampling every episode independently.
+'''
+
+import numpy as np
+
+class ScenarioScheduler:
+    def __init__(self, scenarios_dict, episodes_per_map=10, seed=None):
+        self.__episodes_per_map = max(1, int(episodes_per_map))
+
+        # Group the scenarios by map
+        self.__map_scenarios = {}
+        for name, scenario in scenarios_dict.items():
+            self.__map_scenarios.setdefault(scenario['map_name'], []).append(name)
+        self.__map_names = list(self.__map_scenarios)
+
+        # Target distribution: P(map) and P(scenario | map)
+        map_weights = []
+        self.__scenario_probabilities = {}
+        for map_name, names in self.__map_scenarios.items():
+            weights = np.array([float(scenarios_dict[name].get('weight', 1.0)) for name in names])
+            map_weights.append(weights.sum())
+            self.__scenario_probabilities[map_name] = weights / weights.sum()
+        map_weights = np.array(map_weights)
+        self.__map_probabilities = map_weights / map_weights.sum()
+
+        self.seed(seed)
+        self.__reset_statistics()
+
+    # Restarts the schedule with a new random generator (a new dwell starts in the next episode)
+    def seed(self, seed=None):
+        self.__rng = np.random.default_rng(seed)
+        self.__active_map = None
+        self.__remaining_episodes = 0
+
+    def next_scenario(self):
+        # Start a new dwell
+        if self.__remaining_episodes <= 0:
+            map_name = self.__map_names[self.__rng.choice(len(self.__map_names), p=self.__map_probabilities)]
+            if map_name != self.__active_map:
+                self.__map_visits[map_name] += 1
+                if self.__active_map is not None:
+                    self.__map_switches += 1
+            self.__active_map = map_name
+            self.__remaining_episodes = self.__episodes_per_map
+
+        names = self.__map_scenarios[self.__active_map]
+        scenario_name = names[self.__rng.choice(len(names), p=self.__scenario_probabilities[self.__active_map])]
+
+        self.__remaining_episodes -= 1
+        self.__map_episodes[self.__active_map] += 1
+        self.__scenario_episodes[scenario_name] = self.__scenario_episodes.get(scenario_name, 0) + 1
+
+        return scenario_name
+
+    def get_active_map(self):
+        return self.__active_map
+
+    # Per map dwell statistics. A visit is a run of consecutive episodes on the same map (i.e., a single load_world).
+    def get_statistics(self):
+        maps = {}
+        for map_name in self.__map_names:
+            episodes = self.__map_episodes[map_name]
+            visits = self.__map_visits[map_name]
+            maps[map_name] = {
+                'episodes': episodes,
+                'visits': visits,
+                'mean_dwell': episodes / visits if visits > 0 else 0.0,
+                'target_probability': float(self.__map_probabilities[self.__map_names.index(map_name)]),
+            }
+
+        return {
+            'episodes': sum(self.__map_episodes.values()),
+            'map_switches': self.__map_switches,
+            'maps': maps,
+            'scenarios': dict(self.__scenario_episodes),
+        }
+
+    def __reset_statistics(self):
+        self.__map_episodes = {map_name: 0 for map_name in self.__map_names}
+        self.__map_visits = {map_name: 0 for map_name in self.__map_names}
+        self.__scenario_episodes = {}
+        self.__map_switches = 0
@@ -0,0 +1,59 @@
+'''
+Vectorized Pre-processing Module:
+    VecPreProcessing is a stable-baselines3 VecEnvWrapper that pre-processes the observations of every environment in one call, instead of each environment processing its own observation in its step.
+
+    The environments must be created with preprocess_observations=False, so they return the raw (zero padded) lidar sweeps (N, P, 4). The wrapper samples them into (N, 3, K) with a single PreProcessing.preprocess_batch call, which
+    with LIDAR_FPS_BACKEND = 'torch' runs the farthest point sampling of all the environments in the same loop.
+    With FRAME_STACK > 1 it also stacks the last observations of each environment (see env/frame_stack.py), the terminal observations are stacked with the frames of their episode.
+    Every call returns new arrays, since stable-baselines3 keeps the previous observations (_last_obs) until the next step has returned.
+
+    E.g.:
+        venv = DummyVecEnv([lambda: CarlaEnv(preprocess_observations=False) for _ in range(4)])
+        venv = VecPreProcessing(venv)
+'''
+
+import numpy as np
+from stable_baselines3.common.vec_env import VecEnvWrapper
+
+from env.pre_processing import PreProcessing
+from env.frame_stack import FrameStack
+import configuration as config
+
+class VecPreProcessing(VecEnvWrapper):
+    # mask_padding: if True, the zeros the raw observations are padded with are never sampled
+    def __init__(self, venv, pre_processing=None, mask_padding=True):
+        self.pre_processing = pre_processing if pre_processing is not None else PreProcessing()
+        observation_space = self.pre_processing.get_observation_space(venv.observation_space)
+        # The last observations of each environment are stacked after the pre-processing (FRAME_STACK > 1)
+        self.frame_stack = FrameStack(observation_space, num_envs=venv.num_envs) if config.FRAME_STACK > 1 else None
+        if self.frame_stack is not None:
+            observation_space = self.frame_stack.observation_space
+        super().__init__(venv, observation_space=observation_space)
+        self.__mask_padding = mask_padding
+
+    def reset(self):
+        observations = self.__preprocess(self.venv.reset())
+        if self.frame_stack is not None:
+            self.frame_stack.reset()
+            observations = self.frame_stack.push_batch(observations)
+        return observations
+
+    def step_wait(self):
+        observations, rewards, dones, infos = self.venv.step_wait()
+
+        # The terminal observations of the environments that were reset in this step are processed together too
+        terminal = [idx for idx, info in enumerate(infos) if 'terminal_observation' in info]
+        if terminal:
+            stacked = {key: np.stack([infos[idx]['terminal_observation'][key] for idx in terminal]) for key in infos[terminal[0]]['terminal_observation']}
+            stacked = self.__preprocess(stacked)
+            for row, idx in enumerate(terminal):
+                infos[idx]['terminal_observation'] = {key: value[row] for key, value in stacked.items()}
+
+        observations = self.__preprocess(observations)
+        if self.frame_stack is not None:
+            observations = self.frame_stack.push_batch(observations, dones, infos)
+        return observations, rewards, dones, infos
+
+    def __preprocess(self, observations):
+        mask = PreProcessing.padding_mask(observations['lidar_data']) if self.__mask_padding else None
+        return self.pre_processing.preprocess_batch(observations, lidar_mask=mask)
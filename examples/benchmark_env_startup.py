@@ -0,0 +1,73 @@
+'''
+benchmark_env_startup.py
+
+- This script measures how long gym.make('carla-rl-gym-v0') takes (importing the environment plus building it) for different pre-processing stages.
+- It doesn't need the simulator: every run replaces the carla module with a stub (every attribute and call returns a mock), so only the client side's startup is measured.
+- Each run is a new interpreter (like a new SubprocVecEnv worker), so the imports aren't cached between runs.
+'''
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import json
+import subprocess
+
+REPEATS = 3
+
+# Runs in a new interpreter: prints the import and construction times and whether torch was imported
+CHILD = r"""
+import os, sys, json, time
+from unittest import mock
+sys.path.insert(0, os.getcwd())
+carla = mock.MagicMock()
+carla.Client.return_value.get_available_maps.return_value = ['/Game/Carla/Maps/Town01']
+carla.Client.return_value.get_world.return_value.get_map.return_value.name = 'Carla/Maps/Town01'
+sys.modules['carla'] = carla
+
+import configuration
+configuration.PREPROCESSING_STAGES = json.loads(sys.argv[1])
+eager = sys.argv[2] == 'eager'
+
+start = time.perf_counter()
+import gymnasium as gym
+import env.environment
+import_time = time.perf_counter() - start
+
+start = time.perf_counter()
+carla_env = gym.make('carla-rl-gym-v0', initialize_server=False, has_traffic=False)
+# Eager: build every stage in the constructor, like the pre-processing used to (e.g., the PointNet model in every environment)
+if eager:
+    for name in configuration.PREPROCESSING_STAGES:
+        carla_env.unwrapped.pre_processing.get_stage(name)
+make_time = time.perf_counter() - start
+
+print(json.dumps({'import': import_time, 'make': make_time, 'torch': 'torch' in sys.modules}))
+"""
+
+def run(stages, mode):
+    results = []
+    for _ in range(REPEATS):
+        output = subprocess.run([sys.executable, '-c', CHILD, json.dumps(stages), mode], capture_output=True, text=True,
+                                cwd=os.path.join(os.path.dirname(__file__), '..'))
+        if output.returncode != 0:
+            print(output.stderr)
+            return None
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return results
+
+def main():
+    configurations = [
+        (['lidar_downsampling'], 'lazy'),
+        (['lidar_downsampling', 'lidar_features'], 'lazy'),
+        (['lidar_downsampling', 'lidar_features'], 'eager'),
+    ]
+    for stages, mode in configurations:
+        results = run(stages, mode)
+        if results is None:
+            continue
+        import_time = min(result['import'] for result in results)
+        make_time = min(result['make'] for result in results)
+        print(f"{'+'.join(stages):<35} {mode:<6} import {import_time * 1000:8.1f} ms  make {make_time * 1000:8.1f} ms  total {(import_time + make_time) * 1000:8.1f} ms  torch imported: {results[0]['torch']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+benchmark_farthest_sampler.py
+
+- This script measures the latency of the farthest point sampler (500 output points) for clouds of 500, 2k and 20k points, with every backend and mode.
+- It also checks that the exact modes return the same points as the original single cloud loop, and reports the coverage radius (the largest distance from a point of the cloud to the sample) of the approximate mode.
+- It doesn't need the simulator.
+'''
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import numpy as np
+
+from env.aux.farthest_sampler import FarthestSampler
+
+NUM_SAMPLES = 500
+NUM_POINTS = [500, 2000, 20000]
+BATCH_SIZE = 8
+
+# The original implementation, used as the reference of the exact modes
+def reference_sample(pts, k, init_idx=1):
+    farthest_pts_idx = np.zeros(k, dtype=int)
+    farthest_pts_idx[0] = init_idx
+    distances = ((pts[:, init_idx:init_idx+1].astype(np.float64) - pts) ** 2).sum(axis=0)
+    for i in range(1, k):
+        idx = np.argmax(distances)
+        farthest_pts_idx[i] = idx
+        distances = np.minimum(distances, ((pts[:, idx:idx+1].astype(np.float64) - pts) ** 2).sum(axis=0))
+    return farthest_pts_idx
+
+# A lidar-like cloud: points on a ground plane and on a few walls around the vehicle, in float32 like CARLA's
+def random_cloud(n, rng):
+    angles = rng.uniform(-np.pi, np.pi, n)
+    ranges = rng.uniform(2.0, 50.0, n)
+    heights = np.where(rng.random(n) < 0.5, -1.5, rng.uniform(-1.5, 3.0, n))
+    return np.stack([ranges * np.cos(angles), ranges * np.sin(angles), heights]).astype(np.float32)
+
+def coverage(pts, idx):
+    sample = pts[:, idx]
+    radius = 0.0
+    for start in range(0, pts.shape[1], 4096):
+        chunk = pts[:, start:start + 4096]
+        radius = max(radius, np.sqrt(((chunk[:, :, None] - sample[:, None, :]) ** 2).sum(axis=0).min(axis=1)).max())
+    return radius
+
+def timeit(function, repeats):
+    function()  # Warm up (and grow the workspace)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1000
+
+def main():
+    rng = np.random.default_rng(0)
+    modes = [
+        ('numpy float32', dict(backend='numpy')),
+        ('numpy float64', dict(backend='numpy', dtype=np.float64)),
+        ('torch float32', dict(backend='torch')),
+        ('torch float64', dict(backend='torch', dtype=np.float64)),
+        ('numpy approx 0.5 m', dict(backend='numpy', max_error=0.5)),
+        ('numpy approx 1.0 m', dict(backend='numpy', max_error=1.0)),
+    ]
+
+    for n in NUM_POINTS:
+        pts = random_cloud(n, rng)
+        batch = np.stack([random_cloud(n, rng) for _ in range(BATCH_SIZE)])
+        repeats = 3 if n >= 20000 else 10
+        reference_idx = reference_sample(pts, NUM_SAMPLES)
+        print(f"\n{n} points -> {NUM_SAMPLES}")
+        print(f"  {'original loop':<22} {timeit(lambda: reference_sample(pts, NUM_SAMPLES), repeats):8.2f} ms/cloud  coverage {coverage(pts, reference_idx):.3f} m")
+
+        for name, kwargs in modes:
+            sampler = FarthestSampler(**kwargs)
+            _, idx = sampler.sample(pts, NUM_SAMPLES)
+            latency = timeit(lambda: sampler.sample(pts, NUM_SAMPLES), repeats)
+            same = 'same as the original' if np.array_equal(idx, reference_idx) else 'differs from the original'
+            print(f"  {name:<22} {latency:8.2f} ms/cloud  coverage {coverage(pts, idx):.3f} m  ({same})")
+
+        # The torch backend samples the clouds of every environment in the same loop
+        sampler = FarthestSampler(backend='torch')
+        latency = timeit(lambda: sampler.sample_batch(batch, NUM_SAMPLES), repeats)
+        print(f"  {f'torch batch of {BATCH_SIZE}':<22} {latency / BATCH_SIZE:8.2f} ms/cloud")
+
+if __name__ == '__main__':
+    main()
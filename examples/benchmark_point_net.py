@@ -0,0 +1,84 @@
+'''
+benchmark_point_net.py
+
+- This script measures the CPU latency of PointNet's global features (500 points per cloud) for a single cloud and for a batch, with the eager model and the exported ones (fused BatchNorms, fused + int8 linear layers).
+- It also reports the accuracy delta of each exported model against the eager float model: the largest absolute error and the relative error of the features, and the cosine similarity.
+- The weights can be loaded from a state dict (python benchmark_point_net.py weights.pt), otherwise a random model is used, with its BatchNorm statistics collected on random lidar-like clouds so the folding isn't trivial.
+- It doesn't need the simulator.
+'''
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import warnings
+import torch
+
+from env.aux.point_net import PointNetfeat
+from env.aux.point_net_inference import GlobalFeatures, fuse_batch_norm, quantize, export_point_net
+
+NUM_POINTS = 500
+BATCH_SIZES = [1, 16]
+REPEATS = 20
+
+# A lidar-like batch: points on a ground plane and on a few walls around the vehicle
+def random_clouds(batch_size, generator):
+    angles = (torch.rand(batch_size, NUM_POINTS, generator=generator) * 2 - 1) * torch.pi
+    ranges = 2.0 + torch.rand(batch_size, NUM_POINTS, generator=generator) * 48.0
+    heights = torch.where(torch.rand(batch_size, NUM_POINTS, generator=generator) < 0.5, -1.5, -1.5 + torch.rand(batch_size, NUM_POINTS, generator=generator) * 4.5)
+    return torch.stack([ranges * torch.cos(angles), ranges * torch.sin(angles), heights], dim=1)
+
+def load_model(generator):
+    model = PointNetfeat(global_feat=True)
+    if len(sys.argv) > 1:
+        model.load_state_dict(torch.load(sys.argv[1], map_location='cpu'))
+    else:
+        model.train()
+        with torch.no_grad():
+            for _ in range(10):
+                model(random_clouds(32, generator))
+    return model.eval()
+
+def timeit(function, x):
+    with torch.inference_mode():
+        function(x)  # Warm up (and let TorchScript optimize the graph)
+        function(x)
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            function(x)
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+def accuracy(reference, features):
+    error = (features - reference).abs()
+    relative = error.norm(dim=1) / reference.norm(dim=1)
+    cosine = torch.nn.functional.cosine_similarity(features, reference, dim=1)
+    return f"max abs error {error.max().item():.2e}  relative error {relative.mean().item():.2e}  cosine {cosine.min().item():.6f}"
+
+def main():
+    warnings.filterwarnings('ignore')
+    generator = torch.Generator().manual_seed(0)
+    model = load_model(generator)
+    models = [
+        ('eager', GlobalFeatures(model).eval()),
+        ('fused', GlobalFeatures(fuse_batch_norm(model)).eval()),
+        ('eager int8', GlobalFeatures(quantize(model)).eval()),
+        ('fused TorchScript', export_point_net(model)),
+        ('fused int8 TorchScript', export_point_net(model, quantized=True)),
+    ]
+
+    clouds = random_clouds(64, generator)
+    with torch.inference_mode():
+        reference = models[0][1](clouds)
+        print(f"Accuracy against the eager float model ({clouds.shape[0]} clouds)")
+        for name, function in models[1:]:
+            print(f"  {name:<24} {accuracy(reference, function(clouds))}")
+
+    print(f"\nLatency ({torch.get_num_threads()} threads)")
+    for batch_size in BATCH_SIZES:
+        x = random_clouds(batch_size, generator)
+        for name, function in models:
+            latency = timeit(function, x)
+            print(f"  {name:<24} batch {batch_size:<3} {latency:8.2f} ms  {latency / batch_size:8.2f} ms/cloud")
+
+if __name__ == '__main__':
+    main()
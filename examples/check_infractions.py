@@ -16,23 +16,25 @@ from src.keyboard_control import KeyboardControl
 import carla
 import random
 
-def check_stop_sign(vehicle, world):
+has_stopped = False
+inside_stop_area = False
+
+# The stop lines come from the world's infraction index and the vehicle's road and lane from the waypoint index (no per tick RPCs)
+def get_vehicle_lane(vehicle, world):
+    waypoint_index = world.get_waypoint_index()
+    lane_idx, _ = waypoint_index.nearest(vehicle.get_location(), lane_type=carla.LaneType.Driving)
+    return waypoint_index.get('road_id', lane_idx), waypoint_index.get('lane_id', lane_idx)
+
+def check_stop_sign(vehicle, world, road_id):
     global has_stopped
     global inside_stop_area
     
     distance = 30.0  # meters (adjust as needed)
     
-    current_location = vehicle.get_location()
-    current_waypoint = world.get_map().get_waypoint(current_location, project_to_road=True)
-    
-    # Get all the stop sign landmarks within a certain distance from the vehicle and on the same road
-    stop_signs_on_same_road = []
-    for landmark in current_waypoint.get_landmarks_of_type(distance, carla.LandmarkType.StopSign):
-        landmark_waypoint = world.get_map().get_waypoint(landmark.transform.location, project_to_road=True)
-        if landmark_waypoint.road_id == current_waypoint.road_id:
-            stop_signs_on_same_road.append(landmark)
+    # Check if there is a stop sign's line within a certain distance in front of the vehicle and on the same road
+    stop_sign_ahead = world.get_infraction_index().stop_sign_ahead(vehicle.get_location(), road_id, distance)
 
-    if len(stop_signs_on_same_road) == 0:
+    if not stop_sign_ahead:
         if inside_stop_area and has_stopped:
             print("Vehicle has stopped at the stop sign.")
             has_stopped = False
@@ -47,28 +49,14 @@ def check_stop_sign(vehicle, world):
         inside_stop_area = True
 
     # The vehicle entered the stop sign area
-    for stop_sign in stop_signs_on_same_road:
-        # Check if the vehicle has stopped
-        if vehicle.get_speed() < 1.0:  # Adjust this threshold for stopped speed
-            has_stopped = True
-
-def has_passed_red_light(vehicle, world):
-    # Get the current waypoint of the vehicle
-    current_waypoint = world.get_map().get_waypoint(vehicle.get_location(), project_to_road=True)
-
-    # Get the traffic lights affecting the current waypoint
-    traffic_lights = world.get_traffic_lights_from_waypoint(current_waypoint, distance=10.0)
-
-    for traffic_light in traffic_lights:
-        # Check if the traffic light is red
-        if traffic_light.get_state() == carla.TrafficLightState.Red:
-            # Get the stop waypoints for the traffic light
-            stop_waypoints = traffic_light.get_stop_waypoints()
-
-            # Check if the vehicle has passed the stop line
-            for stop_waypoint in stop_waypoints:
-                if current_waypoint.transform.location.distance(stop_waypoint.transform.location) < 2.0:
-                    print("Vehicle has passed the red light!!")
+    # Check if the vehicle has stopped
+    if vehicle.get_speed() < 1.0:  # Adjust this threshold for stopped speed
+        has_stopped = True
+
+def has_passed_red_light(vehicle, world, road_id, lane_id, frame):
+    # Check if the vehicle is on the stop line of a red traffic light
+    if world.get_infraction_index().on_red_light_stop_line(vehicle.get_location(), road_id, lane_id, threshold=2.0, frame=frame):
+        print("Vehicle has passed the red light!!")
 
         
 def main():
@@ -0,0 +1,41 @@
+'''
+recompute_rewards.py
+
+- This script recomputes the rewards of the trajectories logged by the environment (CarlaEnv(trajectory_log_dir=...)) without the simulator, and sweeps one of the lambdas.
+- Usage: python examples/recompute_rewards.py <trajectory_log_dir> [term] [values...]
+'''
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import time
+import numpy as np
+
+import configuration
+from env.offline_reward import load_trajectories, load_map_data, recompute_rewards, weighted_rewards
+
+def main(directory, term='speed', values=(-1.0, -0.5, -0.1, 0.0)):
+    start = time.perf_counter()
+    trajectories = load_trajectories(directory)
+    map_data = load_map_data(directory)
+    print(f"Loaded {len(trajectories['x'])} steps of {len(trajectories['scenario_names'])} episodes in {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    terms = recompute_rewards(trajectories, map_data)
+    print(f"Recomputed the reward terms in {time.perf_counter() - start:.2f} s")
+
+    # Sweep the lambda of a term, every set of lambdas is a single matrix product
+    lambdas_list = [{**configuration.ENV_REWARDS_LAMBDAS, term: value} for value in values]
+    rewards = weighted_rewards(terms, lambdas_list)
+    episodes = trajectories['episode']
+    for value, reward in zip(values, rewards):
+        returns = np.bincount(episodes, weights=reward)
+        print(f"{term} = {value:g}: mean return {returns.mean():.3f} (std {returns.std():.3f})")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    term = sys.argv[2] if len(sys.argv) > 2 else 'speed'
+    values = [float(value) for value in sys.argv[3:]] or (-1.0, -0.5, -0.1, 0.0)
+    main(sys.argv[1], term, values)
@@ -18,6 +18,7 @@ def main():
     model = PPO(
         policy="MultiInputPolicy",
         env=env,
+        policy_kwargs=policy_kwargs,
         n_steps=1024,
         batch_size=64,
         n_epochs=4,
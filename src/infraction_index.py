@@ -0,0 +1,152 @@
+'''
+Infraction Index Module:
+    It precomputes the stop lines of the map's stop signs and traffic lights, so the per-step infraction checks are local numpy operations instead of landmark and traffic light RPCs.
+
+    Each stop line is a segment across its lane (lane_width wide, centered on the lane's stop waypoint). The segments are bucketed by road_id, so a check only looks at the stop lines of the vehicle's road.
+    The traffic lights' states are refreshed at most once per frame (carla.TrafficLight.get_state reads the client's copy of the world's snapshot, it isn't an RPC).
+
+    Traffic lights are actors, so the index must be built again whenever the world is (re)loaded.
+'''
+
+import numpy as np
+
+# ====================================== Geometry ======================================
+# Distances between every point (N, 2) and every segment (M, 2) -> (N, M)
+def point_segment_distances(points, p0, p1):
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    segments = p1 - p0
+    lengths = np.maximum(np.einsum('ij,ij->i', segments, segments), 1e-12)
+    deltas = points[:, None, :] - p0[None, :, :]
+    t = np.clip(np.einsum('nmj,mj->nm', deltas, segments) / lengths, 0.0, 1.0)
+    closest = p0[None, :, :] + t[:, :, None] * segments[None, :, :]
+    return np.linalg.norm(points[:, None, :] - closest, axis=2)
+
+# ====================================== Segment Set ======================================
+# Stop line segments sorted by road_id. Each segment has its lane's direction of travel, so it is known on which side of the line a point is.
+class SegmentSet:
+    def __init__(self, waypoints, owners=None):
+        n = len(waypoints)
+        self.center = np.zeros((n, 2))
+        self.direction = np.zeros((n, 2))
+        self.p0 = np.zeros((n, 2))
+        self.p1 = np.zeros((n, 2))
+        self.road_id = np.zeros(n, dtype=np.int64)
+        self.lane_id = np.zeros(n, dtype=np.int64)
+        self.owner = np.zeros(n, dtype=np.int64) if owners is None else np.asarray(owners, dtype=np.int64)
+
+        for idx, waypoint in enumerate(waypoints):
+            yaw = np.radians(waypoint.transform.rotation.yaw)
+            direction = np.array([np.cos(yaw), np.sin(yaw)])
+            normal = np.array([-direction[1], direction[0]])
+            center = np.array([waypoint.transform.location.x, waypoint.transform.location.y])
+            self.center[idx] = center
+            self.direction[idx] = direction
+            self.p0[idx] = center - normal * waypoint.lane_width / 2.0
+            self.p1[idx] = center + normal * waypoint.lane_width / 2.0
+            self.road_id[idx] = waypoint.road_id
+            self.lane_id[idx] = waypoint.lane_id
+
+        # Sort by road so each road's segments are a contiguous slice
+        order = np.argsort(self.road_id, kind='stable')
+        for name in ['center', 'direction', 'p0', 'p1', 'road_id', 'lane_id', 'owner']:
+            setattr(self, name, getattr(self, name)[order])
+        roads, starts, counts = np.unique(self.road_id, return_index=True, return_counts=True)
+        self.__buckets = {int(road): slice(int(start), int(start + count)) for road, start, count in zip(roads, starts, counts)}
+
+    def __len__(self):
+        return len(self.road_id)
+
+    # Slice of the segments of a road (an empty slice if it has none)
+    def road_slice(self, road_id):
+        return self.__buckets.get(int(road_id), slice(0, 0))
+
+    # Distances from a point to the segments of a slice, and the point's signed position along each segment's lane (negative before the line)
+    def distances(self, point, segments):
+        point = np.asarray(point, dtype=np.float64)[:2]
+        distances = point_segment_distances(point[None], self.p0[segments], self.p1[segments])[0]
+        along = np.einsum('ij,ij->i', point[None] - self.center[segments], self.direction[segments])
+        return distances, along
+
+# ====================================== Infraction Index ======================================
+class InfractionIndex:
+    def __init__(self, world, carla_map):
+        # carla is only imported to build the index, so the geometry helpers (e.g., for env/offline_reward.py) don't need it
+        import carla
+        self.__world = world
+        self.__red_light_state = int(carla.TrafficLightState.Red)
+
+        # Stop signs: one segment per driving lane affected by the landmark
+        stop_waypoints = []
+        for landmark in carla_map.get_all_landmarks_of_type(carla.LandmarkType.StopSign):
+            stop_waypoints.extend(self.__landmark_waypoints(carla_map, landmark))
+        self.__stop_signs = SegmentSet(stop_waypoints)
+
+        # Traffic lights: one segment per stop waypoint, owned by the index of its traffic light
+        # The lights are sorted by location, so their order (e.g., in logged light states) is the same every time the map is loaded
+        traffic_lights = world.get_actors().filter('traffic.traffic_light*')
+        self.__traffic_lights = sorted(traffic_lights, key=lambda light: (round(light.get_location().x, 1), round(light.get_location().y, 1)))
+        light_waypoints, owners = [], []
+        for light_idx, traffic_light in enumerate(self.__traffic_lights):
+            for waypoint in traffic_light.get_stop_waypoints():
+                light_waypoints.append(waypoint)
+                owners.append(light_idx)
+        self.__stop_lines = SegmentSet(light_waypoints, owners)
+
+        self.__light_states = np.zeros(len(self.__traffic_lights), dtype=np.int64)
+        self.__light_states_frame = None
+
+    # The driving lanes affected by a stop sign at the landmark's s (or the lane nearest to the sign if the landmark doesn't say)
+    @staticmethod
+    def __landmark_waypoints(carla_map, landmark):
+        import carla
+        waypoints = []
+        for lane_id in range(landmark.from_lane, landmark.to_lane + 1):
+            if lane_id == 0:
+                continue
+            waypoint = carla_map.get_waypoint_xodr(landmark.road_id, lane_id, landmark.s)
+            if waypoint is not None and waypoint.lane_type == carla.LaneType.Driving:
+                waypoints.append(waypoint)
+        if not waypoints:
+            waypoints.append(carla_map.get_waypoint(landmark.transform.location, project_to_road=True))
+        return waypoints
+
+    def get_stop_signs(self):
+        return self.__stop_signs
+
+    def get_stop_lines(self):
+        return self.__stop_lines
+
+    def get_traffic_lights(self):
+        return self.__traffic_lights
+
+    # Reads the state of every traffic light once per frame (frame=None always refreshes)
+    def refresh_light_states(self, frame=None):
+        if frame is not None and frame == self.__light_states_frame:
+            return self.__light_states
+        for idx, traffic_light in enumerate(self.__traffic_lights):
+            self.__light_states[idx] = int(traffic_light.get_state())
+        self.__light_states_frame = frame
+        return self.__light_states
+
+    # True if there is a stop sign's line on the road within the distance in front of the location (i.e., the line wasn't crossed yet)
+    def stop_sign_ahead(self, location, road_id, distance=20.0):
+        segments = self.__stop_signs.road_slice(road_id)
+        if segments.stop == segments.start:
+            return False
+        distances, along = self.__stop_signs.distances((location.x, location.y), segments)
+        return bool(np.any((distances <= distance) & (along <= 0.0)))
+
+    # True if the location is on (within the threshold of) the stop line of a red traffic light on its road and direction of travel
+    def on_red_light_stop_line(self, location, road_id, lane_id, threshold=2.0, frame=None):
+        segments = self.__stop_lines.road_slice(road_id)
+        if segments.stop == segments.start:
+            return False
+        distances, _ = self.__stop_lines.distances((location.x, location.y), segments)
+        candidates = (distances < threshold) & (np.sign(self.__stop_lines.lane_id[segments]) == np.sign(lane_id))
+        if not candidates.any():
+            return False
+
+        # The lights' states are only needed (and refreshed) when the vehicle is on a stop line
+        states = self.refresh_light_states(frame)
+        owners = self.__stop_lines.owner[segments][candidates]
+        return bool(np.any(states[owners] == self.__red_light_state))
@@ -3,7 +3,8 @@ MapControl:
     - Module that controls the current map of the simulation, and allows its customization
 '''
 import carla
-import time
+
+from src.readiness import Readiness
 
 class MapControl:
     def __init__(self, world, client):
@@ -24,17 +25,20 @@ class MapControl:
         for idx, m in enumerate(self.__available_maps):
             print(f'{idx}: {m}')
     
+    # Returns True if a world was loaded
     def set_active_map(self, map_name, reload_map=False):
         # Check if the map is already loaded
         if self.__map_dict[map_name] == self.__active_map and not reload_map:
-            return
+            return False
         
         self.__active_map = self.__map_dict[map_name]
         if map_name in ["Town15", "Town11", "Town12", "Town13"]:
             map_name += f"/{map_name}"
         self.__client.load_world('/Game/Carla/Maps/' + map_name)
-        time.sleep(3)
+        # Wait until the world ticks with the new map instead of sleeping for a fixed time
+        Readiness.wait_for_map(self.__world, map_name)
         self.__map = self.__world.get_map()
+        return True
 
     # Serves for debugging purposes
     def change_map(self):
@@ -0,0 +1,77 @@
+'''
+Readiness Module:
+    It replaces fixed wall-clock sleeps with waits on real conditions:
+        - Server: the RPC port accepts connections and the server answers get_server_version
+        - Map: the world ticks and the loaded map is the requested one
+        - Sensors: every sensor of the vehicle has produced data
+
+    Every wait has a timeout (a TimeoutError is raised when it expires) and returns the measured waiting time in seconds.
+'''
+
+import socket
+import time
+import carla
+
+import configuration as config
+
+class Readiness:
+    # Polls the condition until it returns True. Exceptions raised by the condition count as "not ready yet".
+    @staticmethod
+    def wait_until(condition, timeout, description, poll_interval=0.1):
+        start = time.perf_counter()
+        last_error = None
+        while True:
+            try:
+                if condition():
+                    break
+            except Exception as e:
+                last_error = e
+
+            elapsed = time.perf_counter() - start
+            if elapsed > timeout:
+                raise TimeoutError(f"{description} was not ready after {timeout} seconds" + (f" (last error: {last_error})" if last_error else ""))
+            time.sleep(poll_interval)
+
+        elapsed = time.perf_counter() - start
+        if config.VERBOSE:
+            print(f"{description} ready after {elapsed:.2f} seconds")
+        return elapsed
+
+    # The server is ready when its RPC port accepts connections and it answers get_server_version
+    @staticmethod
+    def wait_for_server(host=config.SIM_HOST, port=config.SIM_PORT, timeout=config.SIM_SERVER_TIMEOUT):
+        def server_ready():
+            with socket.create_connection((host, port), timeout=1.0):
+                pass
+            client = carla.Client(host, port)
+            client.set_timeout(2.0)
+            client.get_server_version()
+            return True
+
+        return Readiness.wait_until(server_ready, timeout, 'Carla server', poll_interval=0.5)
+
+    # The map is ready when the world ticks again and its map is the requested one
+    @staticmethod
+    def wait_for_map(world, map_name, timeout=config.SIM_MAP_LOAD_TIMEOUT):
+        synchronous_mode = world.get_settings().synchronous_mode
+
+        def map_ready():
+            if synchronous_mode:
+                world.tick()
+            else:
+                world.wait_for_tick(timeout)
+            return world.get_map().name.split('/')[-1] == map_name.split('/')[-1]
+
+        return Readiness.wait_until(map_ready, timeout, f'Map {map_name}')
+
+    # The sensors are ready when all of them produced data. In synchronous mode a tick function must be given, since the sensors only produce data when the world ticks.
+    @staticmethod
+    def wait_for_sensors(vehicle, tick=None, timeout=config.SENSOR_READY_TIMEOUT):
+        def sensors_ready():
+            if vehicle.sensors_ready():
+                return True
+            if tick is not None:
+                tick()
+            return vehicle.sensors_ready()
+
+        return Readiness.wait_until(sensors_ready, timeout, 'Sensors', poll_interval=0.01)
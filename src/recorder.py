@@ -0,0 +1,202 @@
+'''
+Recorder Module:
+    It provides an asynchronous writer that saves the sensors' data to disk without blocking the sensors' callback threads.
+
+    The callbacks only copy the data into a bounded queue, while a pool of encoders (threads or processes) writes it to disk in one of the following formats:
+        - png:  One PNG image per frame
+        - jpeg: One JPEG image per frame
+        - npy:  Chunks of raw frames concatenated in a single .npy file, along with an index file ([frame, timestamp, first row, number of rows] per frame)
+        - npz:  Chunks of raw frames in a single compressed .npz file
+
+    When the queue is full, the drop policy decides what happens to new data:
+        - drop_newest: The new data is discarded (the sensor's thread never waits)
+        - block:       The sensor's thread waits until there is space in the queue
+
+    It is configured through the "recording" entry of each sensor in the sensors' JSON file, e.g.:
+        "recording": {"enabled": true, "format": "npz", "queue_size": 64, "num_workers": 2, "backend": "thread", "drop_policy": "drop_newest", "chunk_size": 32}
+'''
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+import cv2
+
+RECORDING_FORMATS = ['png', 'jpeg', 'npy', 'npz']
+IMAGE_FORMATS = ['png', 'jpeg']
+DROP_POLICIES = ['drop_newest', 'block']
+BACKENDS = ['thread', 'process']
+
+# ====================================== Encoders ======================================
+# These run inside the pool's workers, so they must be module level functions (they are pickled by the process backend)
+def write_image(path, image, params):
+    cv2.imwrite(path, image, params)
+
+def write_npy_chunk(path, frames, timestamps, arrays):
+    rows = np.array([len(a) for a in arrays])
+    starts = np.concatenate(([0], np.cumsum(rows)[:-1]))
+    index = np.stack([frames, timestamps, starts, rows], axis=1).astype(np.float64)
+
+    np.save(path, np.concatenate(arrays, axis=0))
+    np.save(path.replace('.npy', '_index.npy'), index)
+
+def write_npz_chunk(path, frames, timestamps, arrays):
+    data = {f'data_{idx}': array for idx, array in enumerate(arrays)}
+    np.savez_compressed(path, frames=np.array(frames), timestamps=np.array(timestamps), **data)
+
+# ====================================== Sensor Recorder ======================================
+class SensorRecorder:
+    def __init__(self, directory, format='png', queue_size=64, num_workers=2, backend='thread', drop_policy='drop_newest', chunk_size=32, jpeg_quality=90, png_compression=1):
+        if format not in RECORDING_FORMATS:
+            raise ValueError(f"Unknown recording format {format}. Available formats: {RECORDING_FORMATS}")
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {drop_policy}. Available policies: {DROP_POLICIES}")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}. Available backends: {BACKENDS}")
+
+        self.__directory = directory
+        self.__format = format
+        self.__drop_policy = drop_policy
+        self.__chunk_size = max(1, int(chunk_size))
+        self.__queue_size = max(1, int(queue_size))
+        if format == 'png':
+            self.__image_params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+        else:
+            self.__image_params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+        os.makedirs(self.__directory, exist_ok=True)
+
+        # The semaphore bounds the number of items waiting for (or being written by) the encoders
+        self.__slots = threading.Semaphore(self.__queue_size)
+        executor_class = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+        self.__executor = executor_class(max_workers=max(1, int(num_workers)))
+
+        # Frames waiting to fill a chunk (npy and npz formats)
+        self.__chunk = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+        # Backpressure metrics
+        self.__submitted = 0
+        self.__written = 0
+        self.__dropped = 0
+        self.__errors = 0
+        self.__pending = 0
+        self.__max_pending = 0
+        self.__blocked_time = 0.0
+        self.__write_time = 0.0
+
+    # Creates the recorder described in the sensor's JSON entry, or returns None if recording is disabled
+    @staticmethod
+    def from_sensor_dict(sensor_dict, default_directory, force=False):
+        recording = sensor_dict.get('recording', {})
+        if not (force or recording.get('enabled', False)):
+            return None
+
+        return SensorRecorder(directory=recording.get('directory', default_directory),
+                              format=recording.get('format', 'png'),
+                              queue_size=recording.get('queue_size', 64),
+                              num_workers=recording.get('num_workers', 2),
+                              backend=recording.get('backend', 'thread'),
+                              drop_policy=recording.get('drop_policy', 'drop_newest'),
+                              chunk_size=recording.get('chunk_size', 32),
+                              jpeg_quality=recording.get('jpeg_quality', 90),
+                              png_compression=recording.get('png_compression', 1))
+
+    # True if the recorder expects images (BGR or grayscale) instead of raw sensor data
+    def records_images(self):
+        return self.__format in IMAGE_FORMATS
+
+    # Called from the sensor's callback thread. The data is copied, so the caller can reuse its buffer right away.
+    def record(self, frame, timestamp, data):
+        if self.__closed:
+            return
+
+        data = np.array(data, copy=True)
+        if self.records_images():
+            extension = 'png' if self.__format == 'png' else 'jpg'
+            path = os.path.join(self.__directory, f'{timestamp}.{extension}')
+            self.__submit(write_image, path, data, self.__image_params)
+            return
+
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__chunk.append((frame, timestamp, data))
+            if len(self.__chunk) < self.__chunk_size:
+                return
+            chunk, self.__chunk = self.__chunk, []
+        self.__submit_chunk(chunk)
+
+    def __submit_chunk(self, chunk, final=False):
+        frames = [c[0] for c in chunk]
+        timestamps = [c[1] for c in chunk]
+        arrays = [c[2] for c in chunk]
+        path = os.path.join(self.__directory, f'{frames[0]}_{frames[-1]}.{self.__format}')
+        encoder = write_npy_chunk if self.__format == 'npy' else write_npz_chunk
+        self.__submit(encoder, path, frames, timestamps, arrays, final=final)
+
+    # The closed check and the executor's submit are done under the lock, so a callback racing with close() never submits to a shut down executor (only close's final chunk is submitted after closing)
+    def __submit(self, encoder, *args, final=False):
+        # The final chunk (from close) always waits for a slot, it's never dropped
+        if self.__drop_policy == 'block' or final:
+            start = time.perf_counter()
+            self.__slots.acquire()
+            waited = time.perf_counter() - start
+        elif self.__slots.acquire(blocking=False):
+            waited = 0.0
+        else:
+            with self.__lock:
+                self.__dropped += 1
+            return
+
+        with self.__lock:
+            if self.__closed and not final:
+                self.__slots.release()
+                return
+            self.__submitted += 1
+            self.__pending += 1
+            self.__max_pending = max(self.__max_pending, self.__pending)
+            self.__blocked_time += waited
+            submit_time = time.perf_counter()
+            future = self.__executor.submit(encoder, *args)
+        # Outside the lock: the callback runs right away if the write is already done, and it takes the lock
+        future.add_done_callback(lambda f: self.__on_written(f, submit_time))
+
+    def __on_written(self, future, submit_time):
+        with self.__lock:
+            self.__pending -= 1
+            self.__write_time += time.perf_counter() - submit_time
+            if future.exception() is not None:
+                self.__errors += 1
+                print(f"Error: Failed to record sensor data in {self.__directory}: {future.exception()}")
+            else:
+                self.__written += 1
+        self.__slots.release()
+
+    # submitted/written/dropped/errors are counted in queue items (a frame for images, a chunk for npy and npz)
+    def get_metrics(self):
+        with self.__lock:
+            return {
+                'submitted': self.__submitted,
+                'written': self.__written,
+                'dropped': self.__dropped,
+                'errors': self.__errors,
+                'pending': self.__pending,
+                'max_pending': self.__max_pending,
+                'queue_size': self.__queue_size,
+                'blocked_time': self.__blocked_time,
+                'mean_latency': self.__write_time / max(1, self.__written + self.__errors),
+            }
+
+    # Writes the incomplete chunk (if any) and waits for every pending write
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            chunk, self.__chunk = self.__chunk, []
+        if chunk:
+            self.__submit_chunk(chunk, final=True)
+        self.__executor.shutdown(wait=True)
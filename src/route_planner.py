@@ -0,0 +1,286 @@
+'''
+Route Planner Module:
+    It plans routes between two locations of a map with A* over a graph built from map.get_topology().
+
+    Each edge of the graph is a lane segment of the topology (densely sampled into a polyline) or a lane change between parallel driving lanes.
+    The graph only depends on the map, so it is built once per town and cached to disk as a .npz file (in configuration.CACHE_DIR).
+
+    A route is returned as a dense numpy polyline with shape (K, 3) (x, y, z) and the routes are memoized, so planning the same scenario again costs nothing.
+'''
+
+import os
+import heapq
+import numpy as np
+import carla
+
+import configuration as config
+from src.waypoint_index import map_cache_key
+
+CACHE_VERSION = 1
+LANE_CHANGE_COST = 5.0 # Extra cost (in meters) of changing lanes, so the routes prefer to stay in their lane
+ROUTE_CACHE_SIZE = 256
+
+class RoutePlanner:
+    def __init__(self, nodes, edge_src, edge_dst, edge_cost, edge_is_lane_change, points, yaws, edge_offsets):
+        self.__nodes = np.asarray(nodes, dtype=np.float64)                 # (N, 3) location of each node
+        self.__edge_src = np.asarray(edge_src, dtype=np.int64)
+        self.__edge_dst = np.asarray(edge_dst, dtype=np.int64)
+        self.__edge_cost = np.asarray(edge_cost, dtype=np.float64)
+        self.__edge_is_lane_change = np.asarray(edge_is_lane_change, dtype=bool)
+        self.__points = np.asarray(points, dtype=np.float64)               # (P, 3) concatenated polylines of every edge
+        self.__yaws = np.asarray(yaws, dtype=np.float64)                   # (P,) lane direction of each point, in degrees
+        self.__edge_offsets = np.asarray(edge_offsets, dtype=np.int64)     # Edge e owns points[edge_offsets[e]:edge_offsets[e + 1]]
+
+        # Adjacency lists for A*
+        self.__adjacency = [[] for _ in range(len(self.__nodes))]
+        for edge in range(len(self.__edge_src)):
+            self.__adjacency[self.__edge_src[edge]].append(edge)
+
+        # Points that can be used to localize a location (lane segments only) and the edge of each of them
+        point_edges = np.repeat(np.arange(len(self.__edge_src)), np.diff(self.__edge_offsets))
+        self.__point_edges = point_edges
+        self.__lane_points = np.nonzero(~self.__edge_is_lane_change[point_edges])[0]
+
+        self.__routes = {}
+
+    # ====================================== Construction ======================================
+    # Loads the graph of the map from the cache directory, or builds (and caches) it if it doesn't exist
+    @staticmethod
+    def load_or_build(carla_map, resolution=config.ROUTE_PLANNER_RESOLUTION, cache_dir=config.CACHE_DIR):
+        path = os.path.join(cache_dir, f'route_graph_{map_cache_key(carla_map)}_{resolution:g}m_v{CACHE_VERSION}.npz')
+        if os.path.exists(path):
+            try:
+                return RoutePlanner.load(path)
+            except Exception as e:
+                print(f"Warning: Failed to load the route graph {path} ({e}). Building it again.")
+
+        planner = RoutePlanner.build(carla_map, resolution)
+        try:
+            planner.save(path)
+        except OSError as e:
+            print(f"Warning: Failed to cache the route graph in {path}: {e}")
+        return planner
+
+    @staticmethod
+    def build(carla_map, resolution=config.ROUTE_PLANNER_RESOLUTION):
+        node_ids = {}
+        nodes = []
+        def node_of(waypoint):
+            location = waypoint.transform.location
+            key = (round(location.x, 1), round(location.y, 1), round(location.z, 1))
+            if key not in node_ids:
+                node_ids[key] = len(nodes)
+                nodes.append((location.x, location.y, location.z))
+            return node_ids[key]
+
+        edge_src, edge_dst, edge_cost, edge_is_lane_change, polylines = [], [], [], [], []
+
+        # Lane segments: the entry waypoint, the waypoints every resolution meters and the exit waypoint
+        entries = []
+        for entry, exit in carla_map.get_topology():
+            polyline = [entry]
+            exit_location = exit.transform.location
+            waypoint = entry
+            while True:
+                next_waypoints = waypoint.next(resolution)
+                if not next_waypoints:
+                    break
+                waypoint = next_waypoints[0]
+                # The segment ends at its exit, or where the lane ends if the exit was skipped
+                if waypoint.transform.location.distance(exit_location) < resolution / 2.0:
+                    break
+                if waypoint.road_id != entry.road_id or waypoint.lane_id != entry.lane_id:
+                    break
+                polyline.append(waypoint)
+            polyline.append(exit)
+
+            points = RoutePlanner.__waypoints_to_array(polyline)
+            edge_src.append(node_of(entry))
+            edge_dst.append(node_of(exit))
+            edge_cost.append(float(np.sum(np.linalg.norm(np.diff(points[:, :3], axis=0), axis=1))))
+            edge_is_lane_change.append(False)
+            polylines.append(points)
+            entries.append(entry)
+
+        # Lane changes: from the entry of a segment to the rest of the parallel segment (same direction of travel) on its left or right
+        lane_points = np.concatenate(polylines)
+        lane_offsets = np.concatenate([[0], np.cumsum([len(p) for p in polylines])])
+        lane_point_edges = np.repeat(np.arange(len(polylines)), np.diff(lane_offsets))
+        for edge, entry in enumerate(entries):
+            if entry.is_junction:
+                continue
+            for neighbour, allowed in [(entry.get_left_lane(), carla.LaneChange.Left), (entry.get_right_lane(), carla.LaneChange.Right)]:
+                if neighbour is None or neighbour.lane_type != carla.LaneType.Driving or not (entry.lane_change & allowed):
+                    continue
+                if np.sign(neighbour.lane_id) != np.sign(entry.lane_id):
+                    continue
+                location = neighbour.transform.location
+                distances = np.linalg.norm(lane_points[:, :2] - np.array([location.x, location.y]), axis=1)
+                point = int(np.argmin(distances))
+                target_edge = int(lane_point_edges[point])
+                if target_edge == edge:
+                    continue
+                points = np.concatenate([polylines[edge][:1], lane_points[point:lane_offsets[target_edge + 1]]])
+                edge_src.append(edge_src[edge])
+                edge_dst.append(edge_dst[target_edge])
+                edge_cost.append(float(np.sum(np.linalg.norm(np.diff(points[:, :3], axis=0), axis=1))) + LANE_CHANGE_COST)
+                edge_is_lane_change.append(True)
+                polylines.append(points)
+
+        edge_offsets = np.concatenate([[0], np.cumsum([len(p) for p in polylines])])
+        points = np.concatenate(polylines)
+        if config.VERBOSE:
+            print(f"Built the route graph of {carla_map.name} with {len(nodes)} nodes and {len(edge_src)} edges")
+        return RoutePlanner(nodes, edge_src, edge_dst, edge_cost, edge_is_lane_change, points[:, :3], points[:, 3], edge_offsets)
+
+    # (K, 4) array with x, y, z and yaw of each waypoint
+    @staticmethod
+    def __waypoints_to_array(waypoints):
+        return np.array([(w.transform.location.x, w.transform.location.y, w.transform.location.z, w.transform.rotation.yaw) for w in waypoints])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, nodes=self.__nodes, edge_src=self.__edge_src, edge_dst=self.__edge_dst, edge_cost=self.__edge_cost,
+                            edge_is_lane_change=self.__edge_is_lane_change, points=self.__points, yaws=self.__yaws, edge_offsets=self.__edge_offsets)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return RoutePlanner(data['nodes'], data['edge_src'], data['edge_dst'], data['edge_cost'], data['edge_is_lane_change'],
+                                data['points'], data['yaws'], data['edge_offsets'])
+
+    # ====================================== Planning ======================================
+    # Dense polyline (K, 3) from the start to the target location (None if the target can't be reached). If the start's yaw is given, the start is localized on a lane with that direction of travel.
+    def plan(self, start, target, start_yaw=None):
+        key = (round(start.x, 1), round(start.y, 1), round(start.z, 1), round(target.x, 1), round(target.y, 1), round(target.z, 1),
+               None if start_yaw is None else round(start_yaw))
+        if key in self.__routes:
+            return self.__routes[key]
+
+        route = self.__plan(start, target, start_yaw)
+        if len(self.__routes) >= ROUTE_CACHE_SIZE:
+            self.__routes.pop(next(iter(self.__routes)))
+        self.__routes[key] = route
+        return route
+
+    # The route from the scenario's initial position to its target position
+    def plan_scenario(self, scenario_dict):
+        start = carla.Location(**scenario_dict['initial_position'])
+        target = carla.Location(**scenario_dict['target_position'])
+        return self.plan(start, target, start_yaw=scenario_dict['initial_rotation']['yaw'])
+
+    def __plan(self, start, target, start_yaw):
+        start_point, start_edge = self.__localize(start, start_yaw)
+        target_point, target_edge = self.__localize(target)
+
+        # Both locations on the same segment, with the target ahead
+        if start_edge == target_edge and start_point <= target_point:
+            return self.__points[start_point:target_point + 1].copy()
+
+        edges = self.__a_star(self.__edge_dst[start_edge], self.__edge_src[target_edge])
+        if edges is None:
+            print(f"Warning: There is no route from {start} to {target}.")
+            return None
+
+        # Rest of the start's segment, the segments of the path (without their first point, it's the previous one's last) and the beginning of the target's segment
+        pieces = [self.__points[start_point:self.__edge_offsets[start_edge + 1]]]
+        for edge in edges:
+            pieces.append(self.__points[self.__edge_offsets[edge] + 1:self.__edge_offsets[edge + 1]])
+        pieces.append(self.__points[self.__edge_offsets[target_edge] + 1:target_point + 1])
+        return np.concatenate(pieces)
+
+    # Nearest lane point (and its edge) of a location. If a yaw is given, only points whose direction is within 90 degrees of it are considered.
+    def __localize(self, location, yaw=None):
+        candidates = self.__lane_points
+        if yaw is not None:
+            difference = np.abs((self.__yaws[candidates] - yaw + 180.0) % 360.0 - 180.0)
+            if np.any(difference < 90.0):
+                candidates = candidates[difference < 90.0]
+        distances = np.linalg.norm(self.__points[candidates] - np.array([location.x, location.y, location.z]), axis=1)
+        point = int(candidates[np.argmin(distances)])
+        return point, int(self.__point_edges[point])
+
+    # Edges of the cheapest path between two nodes (an empty list if they are the same node, None if there isn't a path)
+    def __a_star(self, source, goal):
+        if source == goal:
+            return []
+
+        goal_location = self.__nodes[goal]
+        costs = {source: 0.0}
+        came_from = {}
+        queue = [(np.linalg.norm(self.__nodes[source] - goal_location), source)]
+        closed = set()
+        while queue:
+            _, node = heapq.heappop(queue)
+            if node == goal:
+                path = []
+                while node != source:
+                    edge = came_from[node]
+                    path.append(edge)
+                    node = self.__edge_src[edge]
+                return path[::-1]
+            if node in closed:
+                continue
+            closed.add(node)
+
+            for edge in self.__adjacency[node]:
+                neighbour = self.__edge_dst[edge]
+                cost = costs[node] + self.__edge_cost[edge]
+                if cost < costs.get(neighbour, np.inf):
+                    costs[neighbour] = cost
+                    came_from[neighbour] = edge
+                    heapq.heappush(queue, (cost + np.linalg.norm(self.__nodes[neighbour] - goal_location), neighbour))
+
+        return None
+
+# ====================================== Route Tracker ======================================
+# Projects the vehicle's position on a route (polyline) every step. The search is windowed around the last matched segment, so a step costs O(window) instead of O(route).
+# If the vehicle is too far away from the window (e.g., it was teleported), the whole route is searched once.
+class RouteTracker:
+    def __init__(self, route, window=20, relocalization_distance=10.0):
+        route = np.asarray(route, dtype=np.float64)[:, :2]
+        self.__p0 = route[:-1]
+        self.__segments = route[1:] - route[:-1]
+        lengths = np.linalg.norm(self.__segments, axis=1)
+        self.__lengths_squared = np.maximum(lengths ** 2, 1e-12)
+        self.__directions = self.__segments / np.maximum(lengths, 1e-12)[:, None]
+        self.__cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+        self.__window = int(window)
+        self.__relocalization_distance = relocalization_distance
+        self.__last_segment = 0
+        self.__last_progress = None
+
+    def get_length(self):
+        return float(self.__cumulative[-1])
+
+    # Returns the progress along the route (in meters), the signed cross track error (in meters, positive to the right of the route) and the matched segment
+    def project(self, x, y):
+        point = np.array([x, y], dtype=np.float64)
+        start = max(0, self.__last_segment - 2)
+        end = min(len(self.__p0), self.__last_segment + self.__window + 1)
+        segment, distance, t = self.__search(point, start, end)
+        if distance > self.__relocalization_distance:
+            segment, distance, t = self.__search(point, 0, len(self.__p0))
+        self.__last_segment = segment
+
+        progress = self.__cumulative[segment] + t * np.sqrt(self.__lengths_squared[segment])
+        direction = self.__directions[segment]
+        offset = point - (self.__p0[segment] + t * self.__segments[segment])
+        cross_track = -direction[1] * offset[0] + direction[0] * offset[1]
+        return float(progress), float(cross_track), segment
+
+    # Progress made since the previous call (0 in the first call)
+    def progress_delta(self, x, y):
+        progress, cross_track, _ = self.project(x, y)
+        delta = 0.0 if self.__last_progress is None else progress - self.__last_progress
+        self.__last_progress = progress
+        return delta, cross_track
+
+    # Vectorized point to segment search in segments [start, end)
+    def __search(self, point, start, end):
+        p0 = self.__p0[start:end]
+        segments = self.__segments[start:end]
+        t = np.clip(np.einsum('ij,ij->i', point - p0, segments) / self.__lengths_squared[start:end], 0.0, 1.0)
+        distances = np.linalg.norm(point - (p0 + t[:, None] * segments), axis=1)
+        best = int(np.argmin(distances))
+        return start + best, float(distances[best]), float(t[best])
@@ -18,63 +18,129 @@ Sensors Module:
         - Lidar Semantic Segmentation
         - Obstacle Detection
         - Optical Flow Camera (AKA: Motion Camera)
+
+    Recording:
+        The camera, LiDAR and radar can save their data to disk through a background SensorRecorder (see src/recorder.py), configured by the "recording" entry of the sensor in the JSON file. When configuration.VERBOSE is on, they record PNG images by default.
+
+    Sensor Synchronization:
+        Every measurement is tagged with the CARLA frame it belongs to. The sensors that produce data every frame report it to a SensorSyncQueue, which allows the client to wait until all of them have delivered a given frame and collect their data in a SensorBundle.
 '''
 
 import carla
 import numpy as np
-from PIL import Image
-import cv2
+import time
+import threading
 import configuration
+from src.recorder import SensorRecorder
+
+# ====================================== Sensor Synchronization ======================================
+# Keeps track of the last frame delivered by each sensor and lets the client block until every sensor has delivered a given frame
+class SensorSyncQueue:
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__frames = {}
+
+    # Called from the sensors' callback threads
+    def put(self, sensor, frame):
+        with self.__condition:
+            self.__frames[sensor] = frame
+            self.__condition.notify_all()
+
+    # Blocks until every sensor delivered the frame (or a newer one) or the timeout expires. Returns the sensors that are still missing the frame.
+    def wait_for_frame(self, sensors, frame, timeout):
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while True:
+                missing = [s for s in sensors if self.__frames.get(s) is None or self.__frames[s] < frame]
+                remaining = deadline - time.monotonic()
+                if not missing or remaining <= 0:
+                    return missing
+                self.__condition.wait(remaining)
+    
+    def clear(self):
+        with self.__condition:
+            self.__frames = {}
+
+# Data of multiple sensors collected for the same frame
+class SensorBundle:
+    def __init__(self, frame, data, frames):
+        self.frame = frame      # Frame that was requested (None if the data wasn't synchronized)
+        self.data = data        # {sensor_name: data}
+        self.frames = frames    # {sensor_name: frame the data belongs to}
+
+    # True if every sensor delivered the requested frame
+    def is_complete(self):
+        return self.frame is None or all(f == self.frame for f in self.frames.values())
+
+# ====================================== Sensor Transform ======================================
+# This will place the sensor in the location (relative to the vehicle) stated in the JSON file
+def get_sensor_transform(sensor_dict):
+    return carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
 
 # ====================================== RGB Camera ======================================
 class RGB_Camera:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_rgb_camera(world, vehicle, sensor_dict)
+    def __init__(self, world, vehicle, sensor_dict, sync_queue=None, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_rgb_camera(world, vehicle, sensor_dict)
         self.__last_data = None
         self.__raw_data = None
+        self.__frame = None
         self.__sensor_ready = False
+        self.__sync_queue = sync_queue
+
+        # Preallocated ring of RGB frames. The callback decodes each frame into the next slot and hands out views, so no memory is allocated per frame.
+        # A view stays valid until the ring wraps around, consumers that need to hold a frame longer than that must copy it.
+        self.__ring_buffer_size = max(2, int(sensor_dict.get('ring_buffer_size', 4)))
+        self.__ring_buffer = np.empty((self.__ring_buffer_size, sensor_dict['image_size_y'], sensor_dict['image_size_x'], 3), dtype=np.uint8)
+        self.__ring_index = 0
+
+        self.__recorder = SensorRecorder.from_sensor_dict(sensor_dict, 'data/rgb_camera', force=configuration.VERBOSE)
+
         self.__sensor.listen(lambda data: self.callback(data))
 
     def attach_rgb_camera(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.camera.rgb')
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        camera_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
+
+        return camera_sensor
+
+    # RGB camera blueprint (resolution, fov and tick)
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.camera.rgb')
         # attributes
         sensor_bp.set_attribute('image_size_x', str(sensor_dict['image_size_x']))
         sensor_bp.set_attribute('image_size_y', str(sensor_dict['image_size_y']))
         sensor_bp.set_attribute('fov', str(sensor_dict['fov']))
         sensor_bp.set_attribute('sensor_tick', str(sensor_dict['sensor_tick']))
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        camera_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
 
-        return camera_sensor
+        return sensor_bp
     
     def callback(self, data):
         global configuration
 
-        # Get the image from the data
-        image = Image.frombytes('RGBA', (data.width, data.height), data.raw_data, 'raw', 'RGBA')
+        # Wrap CARLA's BGRA buffer without copying it
+        bgra = np.frombuffer(data.raw_data, dtype=np.uint8).reshape((data.height, data.width, 4))
 
-        # Convert the image to a NumPy array
-        image_array = np.array(image)
+        # Reallocate the ring only if the camera resolution doesn't match the one in the sensor's JSON
+        if self.__ring_buffer.shape[1:3] != (data.height, data.width):
+            self.__ring_buffer = np.empty((self.__ring_buffer_size, data.height, data.width, 3), dtype=np.uint8)
 
-        # Take out the alpha channel
-        image_array = image_array[:, :, :3]
+        # Swizzle BGRA into RGB (dropping the alpha channel) directly into the next slot of the ring
+        image_array = self.__ring_buffer[self.__ring_index]
+        np.copyto(image_array, bgra[:, :, 2::-1])
+        self.__ring_index = (self.__ring_index + 1) % self.__ring_buffer_size
 
         self.__raw_data = image_array
-        self.__sensor_ready = True
-
-        # Ensure the array is contiguous in memory
-        image_array = np.ascontiguousarray(image_array)
-
-        # Display the processed image using Pygame
         self.__last_data = image_array
+        self.__frame = data.frame
+        self.__sensor_ready = True
+        if self.__sync_queue is not None:
+            self.__sync_queue.put(self, data.frame)
 
-
-        # Save image in directory
-        if configuration.VERBOSE:
-            timestamp = data.timestamp
-            cv2.imwrite(f'data/rgb_camera/{timestamp}.png', image_array)
+        # Save image in directory (OpenCV expects BGR)
+        if self.__recorder is not None:
+            self.__recorder.record(data.frame, data.timestamp, bgra[:, :, :3] if self.__recorder.records_images() else image_array)
     
     def get_last_data(self):
         return self.__last_data
@@ -82,23 +148,54 @@ class RGB_Camera:
     def get_data(self):
         return self.__raw_data
     
+    def get_frame(self):
+        return self.__frame
+    
     def is_ready(self):
         return self.__sensor_ready
 
+    def get_recorder(self):
+        return self.__recorder
+
     def destroy(self):
         self.__sensor.destroy()
+        if self.__recorder is not None:
+            self.__recorder.close()
 
 # ====================================== LiDAR ======================================
 class Lidar:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_lidar(world, vehicle, sensor_dict)
-        self.__last_data = None
+    def __init__(self, world, vehicle, sensor_dict, sync_queue=None, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_lidar(world, vehicle, sensor_dict)
         self.__raw_data = None
+        self.__num_points = 0
+        self.__frame = None
         self.__sensor_ready = False
+        self.__sync_queue = sync_queue
+
+        # Two buffers big enough for a full rotation (they grow if a sweep doesn't fit)
+        capacity = int(np.ceil(float(sensor_dict['points_per_second']) / max(float(sensor_dict['rotation_frequency']), 1e-3)))
+        self.__buffers = [np.empty((capacity, 4), dtype=np.float32) for _ in range(2)]
+        self.__buffer_idx = 0
+
+        # The bird's-eye view image is only rasterized when requested (e.g., by the Display) and it's cached for the frame it was computed for
+        self.__bev_image = None
+        self.__bev_frame = None
+
+        self.__recorder = SensorRecorder.from_sensor_dict(sensor_dict, 'data/lidar', force=configuration.VERBOSE)
+
         self.__sensor.listen(lambda data: self.callback(data))
 
     def attach_lidar(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.lidar.ray_cast')
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        lidar_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
+
+        return lidar_sensor
+
+    # Ray cast lidar blueprint (channels, rate, range and vertical fov)
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.lidar.ray_cast')
         # attributes
         sensor_bp.set_attribute('channels', str(sensor_dict['channels']))
         sensor_bp.set_attribute('points_per_second', str(sensor_dict['points_per_second']))
@@ -107,35 +204,46 @@ class Lidar:
         sensor_bp.set_attribute('upper_fov', str(sensor_dict['upper_fov']))
         sensor_bp.set_attribute('lower_fov', str(sensor_dict['lower_fov']))
         sensor_bp.set_attribute('sensor_tick', str(sensor_dict['sensor_tick']))
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        lidar_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
 
-        return lidar_sensor
+        return sensor_bp
     
     def callback(self, data):
-        global configuration
-
-        # Assuming lidar_data is the raw Lidar data
-        lidar_data = data.raw_data
-        lidar_data = np.frombuffer(lidar_data, dtype=np.dtype('f4'))
-        lidar_data = np.reshape(lidar_data, (int(lidar_data.shape[0] / 4), 4))
-
-        # Ensure a fixed number of points (e.g., 400)
-        fixed_num_points = 500
-        if lidar_data.shape[0] < fixed_num_points:
-            # Pad with zeros if fewer points than expected
-            lidar_data = np.pad(lidar_data, ((0, fixed_num_points - lidar_data.shape[0]), (0, 0)), mode='constant')
-        elif lidar_data.shape[0] > fixed_num_points:
-            # Downsample if more points than expected
-            indices = np.linspace(0, lidar_data.shape[0] - 1, fixed_num_points, dtype=int)
-            lidar_data = lidar_data[indices]
-
-        # Update self.__raw_data with the modified Lidar data
+        # The whole sweep is kept (the pre-processing downsamples it, see env/pre_processing.py). It is copied into one of two reusable buffers, so the data of the previous frame stays valid while the new one is written.
+        points = np.frombuffer(data.raw_data, dtype=np.dtype('f4'))
+        num_points = points.shape[0] // 4
+        buffer = self.__buffers[self.__buffer_idx]
+        if buffer.shape[0] < num_points:
+            buffer = np.empty((int(num_points * 1.5), 4), dtype=np.float32)
+            self.__buffers[self.__buffer_idx] = buffer
+        buffer[:num_points] = points.reshape((num_points, 4))
+        self.__buffer_idx = 1 - self.__buffer_idx
+
+        lidar_data = buffer[:num_points]
         self.__raw_data = lidar_data
+        self.__num_points = num_points
+        self.__frame = data.frame
         self.__sensor_ready = True
+        if self.__sync_queue is not None:
+            self.__sync_queue.put(self, data.frame)
+
+        # Save the data in directory (the bird's-eye view image if recording images, the points otherwise)
+        if self.__recorder is not None:
+            self.__recorder.record(data.frame, data.timestamp, self.get_last_data() if self.__recorder.records_images() else lidar_data)
+    
+    # Returns the bird's-eye view image of the last sweep, rasterizing it only if it wasn't already computed for this frame
+    def get_last_data(self):
+        frame = self.__frame
+        lidar_data = self.__raw_data
+        if lidar_data is None:
+            return None
+
+        if self.__bev_frame != frame:
+            self.__bev_image = self.__rasterize(lidar_data)
+            self.__bev_frame = frame
 
+        return self.__bev_image
+    
+    def __rasterize(self, lidar_data):
         # Extract X, Y, Z coordinates and intensity values
         points_xyz = lidar_data[:, :3]
         intensity = lidar_data[:, 3]
@@ -163,51 +271,67 @@ class Lidar:
         lidar_image_array[y_indices, x_indices] = intensity * intensity_scale
 
         # Clip the intensity values to stay within the valid color range
-        lidar_image_array = np.clip(lidar_image_array, 0, 255)
-
-        # Display the processed image using Pygame
-        self.__last_data = lidar_image_array
+        np.clip(lidar_image_array, 0, 255, out=lidar_image_array)
 
-        # Save image in directory
-        if configuration.VERBOSE:
-            timestamp = data.timestamp
-            cv2.imwrite(f'data/lidar/{timestamp}.png', lidar_image_array)
-    
-    def get_last_data(self):
-        return self.__last_data
+        return lidar_image_array
     
+    # The (num_points, 4) points of the last sweep: x, y, z and intensity. It's a view of a reusable buffer that is overwritten two sweeps later, copy it to keep it longer.
     def get_data(self):
         return self.__raw_data
+
+    def get_num_points(self):
+        return self.__num_points
+    
+    def get_frame(self):
+        return self.__frame
     
     def is_ready(self):
         return self.__sensor_ready
     
+    def get_recorder(self):
+        return self.__recorder
+
     def destroy(self):
         self.__sensor.destroy()
+        if self.__recorder is not None:
+            self.__recorder.close()
 
 # ====================================== Radar ======================================
 class Radar:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_radar(world, vehicle, sensor_dict)
-        self.__last_data = None
+    def __init__(self, world, vehicle, sensor_dict, sync_queue=None, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_radar(world, vehicle, sensor_dict)
         self.__raw_data = None
+        self.__frame = None
         self.__sensor_ready = False
+        self.__sync_queue = sync_queue
+
+        # The bird's-eye view image is only rasterized when requested (e.g., by the Display) and it's cached for the frame it was computed for
+        self.__bev_image = None
+        self.__bev_frame = None
+
+        self.__recorder = SensorRecorder.from_sensor_dict(sensor_dict, 'data/radar', force=configuration.VERBOSE)
+
         self.__sensor.listen(lambda data: self.callback(data))
 
     def attach_radar(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.other.radar')
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        radar_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
+
+        return radar_sensor
+
+    # Radar blueprint (fov, rate and range)
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.other.radar')
         # attributes
         sensor_bp.set_attribute('horizontal_fov', str(sensor_dict['horizontal_fov']))
         sensor_bp.set_attribute('vertical_fov', str(sensor_dict['vertical_fov']))
         sensor_bp.set_attribute('points_per_second', str(sensor_dict['points_per_second']))
         sensor_bp.set_attribute('range', str(sensor_dict['range']))
         sensor_bp.set_attribute('sensor_tick', str(sensor_dict['sensor_tick']))
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        radar_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
 
-        return radar_sensor
+        return sensor_bp
     
     def callback(self, data):
         global configuration
@@ -217,8 +341,30 @@ class Radar:
 
         points = np.frombuffer(radar_data, dtype=np.dtype('f4'))
         self.__raw_data = points
+        self.__frame = data.frame
         self.__sensor_ready = True
-        points = np.reshape(points, (len(data), 4))
+        if self.__sync_queue is not None:
+            self.__sync_queue.put(self, data.frame)
+
+        # Save the data in directory (the bird's-eye view image if recording images, the points otherwise)
+        if self.__recorder is not None:
+            self.__recorder.record(data.frame, data.timestamp, self.get_last_data() if self.__recorder.records_images() else np.reshape(points, (-1, 4)))
+    
+    # Returns the bird's-eye view image of the last measurement, rasterizing it only if it wasn't already computed for this frame
+    def get_last_data(self):
+        frame = self.__frame
+        points = self.__raw_data
+        if points is None:
+            return None
+
+        if self.__bev_frame != frame:
+            self.__bev_image = self.__rasterize(points)
+            self.__bev_frame = frame
+
+        return self.__bev_image
+    
+    def __rasterize(self, points):
+        points = np.reshape(points, (-1, 4))
 
         # Extract information from radar points
         azimuths = points[:, 1]
@@ -245,48 +391,56 @@ class Radar:
         # Set a value (e.g., velocity) at each (azimuth, depth) coordinate in the histogram
         radar_image_array[depth_indices, azimuth_indices] = 255  # Set a constant value for visibility
 
-        self.__last_data = radar_image_array
-
-        # Save image in directory
-        if configuration.VERBOSE:
-            timestamp = data.timestamp
-            cv2.imwrite(f'data/radar/{timestamp}.png', radar_image_array)
-    
-    def get_last_data(self):
-        return self.__last_data
+        return radar_image_array
 
     def get_data(self):
         return self.__raw_data
     
+    def get_frame(self):
+        return self.__frame
+    
     def is_ready(self):
         return self.__sensor_ready
 
+    def get_recorder(self):
+        return self.__recorder
+
     def destroy(self):
         self.__sensor.destroy()
+        if self.__recorder is not None:
+            self.__recorder.close()
 
 # ====================================== GNSS ======================================
 class GNSS:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_gnss(world, vehicle, sensor_dict)
+    def __init__(self, world, vehicle, sensor_dict, sync_queue=None, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_gnss(world, vehicle, sensor_dict)
         self.__last_data = None
         self.__sensor_ready = False
+        self.__sync_queue = sync_queue
         self.__sensor.listen(lambda data: self.callback(data))
 
     def attach_gnss(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.other.gnss')
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        gnss_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
+
+        return gnss_sensor
+
+    # GNSS blueprint
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.other.gnss')
         # attributes
         sensor_bp.set_attribute('sensor_tick', str(sensor_dict['sensor_tick']))
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        gnss_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
 
-        return gnss_sensor
+        return sensor_bp
     
     def callback(self, data):
         global configuration
         self.__last_data = data
         self.__sensor_ready = True
+        if self.__sync_queue is not None:
+            self.__sync_queue.put(self, data.frame)
 
     def get_last_data(self):
         return self.__last_data
@@ -294,6 +448,9 @@ class GNSS:
     def get_data(self):
         return np.array([self.__last_data.latitude, self.__last_data.longitude, self.__last_data.altitude])
     
+    def get_frame(self):
+        return self.__last_data.frame if self.__last_data is not None else None
+    
     def is_ready(self):
         return self.__sensor_ready
 
@@ -303,30 +460,42 @@ class GNSS:
 
 # ====================================== IMU ======================================
 class IMU:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_imu(world, vehicle, sensor_dict)
-        self.__sensor.listen(lambda data: self.callback(data))
+    def __init__(self, world, vehicle, sensor_dict, sync_queue=None, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_imu(world, vehicle, sensor_dict)
+        self.__last_data = None
         self.__sensor_ready = False
+        self.__sync_queue = sync_queue
+        self.__sensor.listen(lambda data: self.callback(data))
 
     def attach_imu(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.other.imu')
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        imu_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
+
+        return imu_sensor
+
+    # IMU blueprint
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.other.imu')
         # attributes
         sensor_bp.set_attribute('sensor_tick', str(sensor_dict['sensor_tick']))
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        imu_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
 
-        return imu_sensor
+        return sensor_bp
     
     def callback(self, data):
         global configuration
         self.__last_data = data
         self.__sensor_ready = True
+        if self.__sync_queue is not None:
+            self.__sync_queue.put(self, data.frame)
 
     def get_last_data(self):
         return self.__last_data
     
+    def get_frame(self):
+        return self.__last_data.frame if self.__last_data is not None else None
+    
     def is_ready(self):
         return self.__sensor_ready
 
@@ -335,20 +504,25 @@ class IMU:
 
 # ====================================== Collision ======================================
 class Collision:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_collision(world, vehicle, sensor_dict)
+    def __init__(self, world, vehicle, sensor_dict, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_collision(world, vehicle, sensor_dict)
         self.__sensor.listen(lambda data: self.callback(data))
         self.__sensor_ready = True
         self.critical_collision = False
 
     def attach_collision(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.other.collision')
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        collision_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        collision_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
 
         return collision_sensor
+
+    # Collision detector blueprint (no attributes)
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.other.collision')
+
+        return sensor_bp
     
     def callback(self, data):
         if configuration.VERBOSE:
@@ -358,6 +532,10 @@ class Collision:
     def collision_occurred(self):
         return self.critical_collision
     
+    # Clears the collision latch (e.g., when the vehicle is reused in a new episode)
+    def reset(self):
+        self.critical_collision = False
+    
     def is_ready(self):
         return self.__sensor_ready
 
@@ -366,20 +544,25 @@ class Collision:
 
 # ====================================== Lane Invasion ======================================
 class Lane_Invasion:
-    def __init__(self, world, vehicle, sensor_dict):
-        self.__sensor = self.attach_lane_invasion(world, vehicle, sensor_dict)
+    def __init__(self, world, vehicle, sensor_dict, sensor_actor=None):
+        # The sensor is spawned here unless an already spawned actor is given (e.g., by the vehicle's batched spawn)
+        self.__sensor = sensor_actor if sensor_actor is not None else self.attach_lane_invasion(world, vehicle, sensor_dict)
         self.__sensor.listen(lambda data: self.callback(data))
         self.__sensor_ready = True
         self.lane_transgression = False
 
     def attach_lane_invasion(self, world, vehicle, sensor_dict):
-        sensor_bp = world.get_blueprint_library().find('sensor.other.lane_invasion')
-        
-        # This will place the camera in the front bumper of the car
-        transform = carla.Transform(carla.Location(x=sensor_dict['location_x'], y=sensor_dict['location_y'] , z=sensor_dict['location_z']))
-        lane_invasion_sensor = world.spawn_actor(sensor_bp, transform, attach_to=vehicle)
+        sensor_bp = self.get_blueprint(world.get_blueprint_library(), sensor_dict)
+        lane_invasion_sensor = world.spawn_actor(sensor_bp, get_sensor_transform(sensor_dict), attach_to=vehicle)
 
         return lane_invasion_sensor
+
+    # Lane invasion detector blueprint (no attributes)
+    @staticmethod
+    def get_blueprint(blueprint_library, sensor_dict):
+        sensor_bp = blueprint_library.find('sensor.other.lane_invasion')
+
+        return sensor_bp
     
     def callback(self, data):
         self.lane_transgression = True
@@ -391,6 +574,22 @@ class Lane_Invasion:
     
     def lane_invasion_occurred(self):
         return self.lane_transgression
+    
+    # Clears the lane invasion latch (e.g., when the vehicle is reused in a new episode)
+    def reset(self):
+        self.lane_transgression = False
 
     def destroy(self):
         self.__sensor.destroy()
+
+# Sensor classes by the name used in the sensors' JSON file
+# Each class' get_blueprint creates the sensor's blueprint with the attributes of the JSON file, the vehicle also uses it to spawn every sensor in a single batch
+SENSOR_CLASSES = {
+    'rgb_camera': RGB_Camera,
+    'lidar': Lidar,
+    'radar': Radar,
+    'gnss': GNSS,
+    'imu': IMU,
+    'collision': Collision,
+    'lane_invasion': Lane_Invasion,
+}
@@ -1,6 +1,8 @@
 import os
 import subprocess
-import time
+
+import configuration as config
+from src.readiness import Readiness
 
 '''
 Server Module
@@ -13,7 +15,7 @@ Requirements:
 
 class CarlaServer:
     @staticmethod
-    def initialize_server(low_quality = False, offscreen_rendering = False, silent = False, sleep_time = 10):
+    def initialize_server(low_quality = False, offscreen_rendering = False, silent = False, timeout = config.SIM_SERVER_TIMEOUT):
         # Get environment variable CARLA_SERVER that contains the path to the Carla server directory
         carla_server = os.getenv('CARLA_SERVER')
 
@@ -30,10 +32,10 @@ class CarlaServer:
             print('Starting Carla server, please wait...')
         process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     
-        # Wait for the server to start
-        time.sleep(sleep_time)
+        # Wait until the server answers RPC calls
+        wait_time = Readiness.wait_for_server(config.SIM_HOST, config.SIM_PORT, timeout)
         if not silent:
-            print('Carla server started')
+            print(f'Carla server started in {wait_time:.1f} seconds')
 
         return process
     
@@ -19,9 +19,11 @@ class TrafficControl:
         self.__active_ai_controllers = []
         self.__world = world
         self.__map = None
+        self.__waypoint_index = None
         
-    def update_map(self, map):
+    def update_map(self, map, waypoint_index=None):
         self.__map = map
+        self.__waypoint_index = waypoint_index
 
     # ============ Vehicle Control ============
     def spawn_vehicles(self, num_vehicles = 10, autopilot_on = False):
@@ -147,30 +149,45 @@ class TrafficControl:
         if config.VERBOSE:
             print("Spawned", num_walkers, "walkers on random sidewalks.")
     
-    def spawn_pedestrians_around_ego(self, vehicle_location, num_walkers=10, radius=25.0):
+    def spawn_pedestrians_around_ego(self, vehicle_location, num_walkers=10, radius=25.0, max_attempts=20):
         if num_walkers < 1:
             print("You need to spawn at least 1 pedestrian.")
             return
         
         walker_controller_bp = self.__world.get_blueprint_library().find('controller.ai.walker')
+
+        # With the waypoint index, the sidewalk waypoints within the radius are found with a single local query
+        sidewalk_indices = None
+        if self.__waypoint_index is not None:
+            sidewalk_indices = self.__waypoint_index.within_radius(vehicle_location, radius, lane_type=carla.LaneType.Sidewalk)
+            if len(sidewalk_indices) == 0:
+                print(f"Warning: There are no sidewalks within {radius} meters of the vehicle.")
+                return
         
         for _ in range(num_walkers):
 
             # Find a sidewalk waypoint within a radius of the vehicle location.
-            sidewalk_waypoint = None
-            while sidewalk_waypoint is None:
-                random_offset = carla.Location(
-                    x=random.uniform(-radius, radius),
-                    y=random.uniform(-radius, radius))
-                potential_location = vehicle_location + random_offset
-                waypoint = self.__map.get_waypoint(potential_location, project_to_road=True, lane_type=(carla.LaneType.Sidewalk))
-                if waypoint:
-                    sidewalk_waypoint = waypoint
+            spawn_transform = None
+            if sidewalk_indices is not None:
+                spawn_transform = self.__waypoint_index.get_transform(random.choice(sidewalk_indices))
+            else:
+                for _ in range(max_attempts):
+                    random_offset = carla.Location(
+                        x=random.uniform(-radius, radius),
+                        y=random.uniform(-radius, radius))
+                    potential_location = vehicle_location + random_offset
+                    waypoint = self.__map.get_waypoint(potential_location, project_to_road=True, lane_type=(carla.LaneType.Sidewalk))
+                    if waypoint:
+                        spawn_transform = waypoint.transform
+                        break
+            if spawn_transform is None:
+                print(f"Warning: Failed to find a sidewalk after {max_attempts} attempts.")
+                continue
 
             # Spawn walker and controller at the sidewalk waypoint.
             walker_bp = random.choice(self.__world.get_blueprint_library().filter('walker.pedestrian.*'))
             try:
-                walker = self.__world.spawn_actor(walker_bp, sidewalk_waypoint.transform)
+                walker = self.__world.spawn_actor(walker_bp, spawn_transform)
             except RuntimeError:
                 continue
             self.__active_pedestrians.append(walker)
@@ -3,21 +3,51 @@ Vehicle Module:
     It provides the functionality to create and destroy the vehicle and attach the sensors present in a JSON file to it.
 
     It also provides the functionlity to control the vehicle based on the action space provided by the environment.
+
+    If a client is given, the ego vehicle and then all of its sensors are spawned in two batches (client.apply_batch_sync) and the blueprints are only resolved once per world, which makes resetting an episode much faster.
+
+    The vehicle's kinematic state can be cached once per tick (update_state) from the world's snapshot, so the reward and the observation read it locally instead of making one RPC per query.
 '''
 
 import carla
 import random
 import json
-import os
 
 import configuration
 import src.sensors as sensors
 
+# ====================================== Vehicle State ======================================
+# Kinematic state of the vehicle in a single frame, read from the world's snapshot (no RPCs)
+class VehicleState:
+    def __init__(self, frame, timestamp, transform, velocity):
+        self.frame = frame              # Frame of the snapshot
+        self.timestamp = timestamp      # Simulation time of the snapshot in seconds
+        self.transform = transform
+        self.location = transform.location
+        self.rotation = transform.rotation
+        self.velocity = velocity        # In m/s
+        self.speed = 3.6 * velocity.length() # In Km/h
+
+    @staticmethod
+    def from_snapshot(snapshot, actor_id):
+        actor_snapshot = snapshot.find(actor_id)
+        if actor_snapshot is None:
+            return None
+        return VehicleState(snapshot.frame, snapshot.timestamp.elapsed_seconds, actor_snapshot.get_transform(), actor_snapshot.get_velocity())
+
 class Vehicle:
-    def __init__(self, world):
+    def __init__(self, world, client=None):
         self.__vehicle = None
+        self.__state = None
         self.__sensor_dict = {}
         self.__world = world
+        self.__client = client
+        self.__sync_queue = sensors.SensorSyncQueue()
+
+        # Caches for the spawn pipeline (JSON files read once and blueprints resolved once per world)
+        self.__file_cache = {}
+        self.__blueprints = None
+        self.__blueprints_world_id = None
 
         self.__control = carla.VehicleControl()
         self.__ackermann_control = carla.VehicleAckermannControl()
@@ -31,9 +61,31 @@ class Vehicle:
     def get_vehicle(self):
         return self.__vehicle
 
+    # The location, transform and speed getters read the cached state (see update_state) and only make an RPC if there is none
     def get_location(self):
+        if self.__state is not None:
+            return self.__state.location
         return self.__vehicle.get_location()
 
+    def get_transform(self):
+        if self.__state is not None:
+            return self.__state.transform
+        return self.__vehicle.get_transform()
+
+    # Caches the vehicle's state of the given snapshot (or of the world's latest snapshot). It should be called once per tick.
+    def update_state(self, snapshot=None):
+        if self.__vehicle is None:
+            self.__state = None
+            return None
+
+        if snapshot is None:
+            snapshot = self.__world.get_snapshot()
+        self.__state = VehicleState.from_snapshot(snapshot, self.__vehicle.id)
+        return self.__state
+
+    def get_state(self):
+        return self.__state
+
     def set_autopilot(self, boolean):
         if self.__vehicle:
             self.__vehicle.set_autopilot(boolean)
@@ -54,9 +106,10 @@ class Vehicle:
             
             self.destroy_vehicle()
 
-        vehicle_id = self.__read_vehicle_file(configuration.VEHICLE_PHYSICS_FILE)["id"]
-
-        vehicle_bp = self.__world.get_blueprint_library().filter(vehicle_id)
+        self.__state = None
+        vehicle_bp, sensor_blueprints = self.__get_blueprints()
+        vehicle_data = self.__read_vehicle_file(configuration.VEHICLE_SENSORS_FILE)
+        sensor_actors = {}
         
         # If location is not provided, spawn the vehicle in a random location
         if location is None:
@@ -68,7 +121,7 @@ class Vehicle:
                     spawn_point.rotation
                 )
                 try:
-                    self.__vehicle = self.__world.try_spawn_actor(random.choice(vehicle_bp), transform)
+                    self.__vehicle, sensor_actors = self.__spawn_actors(random.choice(vehicle_bp), transform, sensor_blueprints)
                 except:
                     # try again if failed to spawn vehicle
                     pass
@@ -84,23 +137,132 @@ class Vehicle:
             if configuration.VERBOSE:
                 print("Spawning ego vehicle at location: ", carla_location, " and rotation: ", carla_rotation, " Transform: ", transform)
             try:
-                self.__vehicle = self.__world.try_spawn_actor(random.choice(vehicle_bp), transform)
+                self.__vehicle, sensor_actors = self.__spawn_actors(random.choice(vehicle_bp), transform, sensor_blueprints)
             except:
                 print("Error: Failed to spawn vehicle. Check the location and rotation provided.")
                 return
+            if self.__vehicle is None:
+                print("Error: Failed to spawn vehicle. Check the location and rotation provided.")
+                return
         
-        # Attach sensors
-        vehicle_data = self.__read_vehicle_file(configuration.VEHICLE_SENSORS_FILE)
-        self.__attach_sensors(vehicle_data, self.__world)
+        # Attach sensors (the ones that weren't spawned in the batch are spawned one by one) and start listening to them
+        self.__attach_sensors(vehicle_data, self.__world, sensor_actors)
+
+    # ====================================== Spawn Pipeline ======================================
+    # Resolves the vehicle and sensor blueprints once per world (they are reused in every episode)
+    def __get_blueprints(self):
+        world_id = self.__world.id
+        if self.__blueprints is None or self.__blueprints_world_id != world_id:
+            blueprint_library = self.__world.get_blueprint_library()
+            vehicle_id = self.__read_vehicle_file(configuration.VEHICLE_PHYSICS_FILE)["id"]
+            vehicle_bp = blueprint_library.filter(vehicle_id)
+
+            vehicle_data = self.__read_vehicle_file(configuration.VEHICLE_SENSORS_FILE)
+            sensor_blueprints = {}
+            for sensor in vehicle_data:
+                if sensor in sensors.SENSOR_CLASSES:
+                    sensor_bp = sensors.SENSOR_CLASSES[sensor].get_blueprint(blueprint_library, vehicle_data[sensor])
+                    sensor_blueprints[sensor] = (sensor_bp, sensors.get_sensor_transform(vehicle_data[sensor]))
+
+            self.__blueprints = (vehicle_bp, sensor_blueprints)
+            self.__blueprints_world_id = world_id
+
+        return self.__blueprints
+
+    # Spawns the vehicle and its sensors. Returns the vehicle (None if it couldn't be spawned) and a dictionary with the sensors' actors.
+    def __spawn_actors(self, vehicle_bp, transform, sensor_blueprints):
+        # Without a client the vehicle is spawned alone and the sensors are spawned afterwards one by one
+        if self.__client is None:
+            return self.__world.try_spawn_actor(vehicle_bp, transform), {}
+
+        # Two round trips: the vehicle is spawned first and then all of its sensors are spawned attached to it, so every actor's id comes from the responses
+        SpawnActor = carla.command.SpawnActor
+        response = self.__client.apply_batch_sync([SpawnActor(vehicle_bp, transform)], False)[0]
+        if response.error:
+            if configuration.VERBOSE:
+                print(f"Error: Failed to spawn the ego vehicle: {response.error}")
+            return None, {}
+
+        vehicle_id = response.actor_id
+        sensor_names = list(sensor_blueprints.keys())
+        commands = [SpawnActor(sensor_bp, sensor_transform, vehicle_id) for sensor_bp, sensor_transform in sensor_blueprints.values()]
+        responses = self.__client.apply_batch_sync(commands, False) if commands else []
+
+        sensor_ids = {}
+        for sensor, response in zip(sensor_names, responses):
+            if response.error:
+                print(f"Warning: Couldn't spawn the {sensor} in the batch ({response.error}), it will be spawned on its own.")
+            else:
+                sensor_ids[sensor] = response.actor_id
+
+        # The actors are looked up by id (only the ones that were just spawned)
+        actors = {actor.id: actor for actor in self.__world.get_actors([vehicle_id] + list(sensor_ids.values()))}
+        vehicle = actors.get(vehicle_id)
+        if vehicle is None:
+            print("Warning: Couldn't find the ego vehicle spawned in the batch, it will be spawned again.")
+            self.__client.apply_batch([carla.command.DestroyActor(actor_id) for actor_id in [vehicle_id] + list(sensor_ids.values())])
+            return None, {}
+
+        sensor_actors = {}
+        unresolved = []
+        for sensor, actor_id in sensor_ids.items():
+            actor = actors.get(actor_id)
+            if actor is not None and actor.type_id == sensor_blueprints[sensor][0].id:
+                sensor_actors[sensor] = actor
+            else:
+                print(f"Warning: Couldn't find the {sensor} spawned in the batch, it will be spawned on its own.")
+                unresolved.append(actor_id)
+
+        # A sensor that couldn't be resolved would keep streaming attached to the vehicle without anyone listening, so it's destroyed
+        if unresolved:
+            self.__client.apply_batch([carla.command.DestroyActor(actor_id) for actor_id in unresolved])
+
+        return vehicle, sensor_actors
+
+    # ====================================== Soft Reset ======================================
+    # Moves the already spawned vehicle (and its sensors) to a new pose instead of destroying and respawning it. The new pose only takes effect on the next tick.
+    def teleport(self, location, rotation):
+        if self.__vehicle is None:
+            print("Error: No vehicle to teleport. Try spawning the vehicle first.")
+            return
+
+        transform = carla.Transform(
+            carla.Location(x=location[0], y=location[1], z=location[2]),
+            carla.Rotation(pitch=rotation[0], yaw=rotation[1], roll=rotation[2])
+        )
+        self.__state = None
+        self.__vehicle.set_transform(transform)
+        self.__vehicle.set_target_velocity(carla.Vector3D(0.0, 0.0, 0.0))
+        self.__vehicle.set_target_angular_velocity(carla.Vector3D(0.0, 0.0, 0.0))
+
+        # Release the controls and reset the discrete controller's state
+        self.__control = carla.VehicleControl()
+        self.__ackermann_control = carla.VehicleAckermannControl()
+        self.__throttle = 0.0
+        self.__brake = 0.0
+        self.__steering_angle = 0.0
+        self.__speed = 0.0
+        self.__vehicle.apply_control(self.__control)
+
+        if configuration.VERBOSE:
+            print("Teleported ego vehicle to location: ", transform.location, " and rotation: ", transform.rotation)
+
+    # Clears the collision and lane invasion latches, it should be called after the teleport took effect
+    def reset_sensor_latches(self):
+        for sensor in ['collision', 'lane_invasion']:
+            if sensor in self.__sensor_dict:
+                self.__sensor_dict[sensor].reset()
 
     def get_sensor_dict(self):
         return self.__sensor_dict
 
+    # The files are only read once
     def __read_vehicle_file(self, filename):
-        with open(filename) as f:
-            vehicle_data = json.load(f)
+        if filename not in self.__file_cache:
+            with open(filename) as f:
+                self.__file_cache[filename] = json.load(f)
         
-        return vehicle_data
+        return self.__file_cache[filename]
     
     def destroy_vehicle(self):
         if self.__vehicle is None:
@@ -109,43 +271,57 @@ class Vehicle:
         # Destroy sensors
         for sensor in self.__sensor_dict:
             self.__sensor_dict[sensor].destroy()
+        self.__sensor_dict = {}
+        self.__sync_queue.clear()
         self.__vehicle.destroy()
         if configuration.VERBOSE:
             print("Successfully destroyed the ego vehicle and its sensors.")
         self.__vehicle = None
+        self.__state = None
 
     # ====================================== Vehicle Sensors ======================================
-    def __attach_sensors(self, vehicle_data, world):
+    # Sensors whose actor is in sensor_actors (already spawned) are only wrapped, the others are spawned here
+    def __attach_sensors(self, vehicle_data, world, sensor_actors=None):
+        sensor_actors = sensor_actors if sensor_actors is not None else {}
         for sensor in vehicle_data:
             if sensor == 'rgb_camera':
-                self.__sensor_dict[sensor]    = sensors.RGB_Camera(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['rgb_camera'])
-                os.makedirs('data/rgb_camera', exist_ok=True)
+                self.__sensor_dict[sensor]    = sensors.RGB_Camera(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['rgb_camera'], sync_queue=self.__sync_queue, sensor_actor=sensor_actors.get('rgb_camera'))
             elif sensor == 'lidar':
-                self.__sensor_dict[sensor]    = sensors.Lidar(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['lidar'])
-                os.makedirs('data/lidar', exist_ok=True)
+                self.__sensor_dict[sensor]    = sensors.Lidar(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['lidar'], sync_queue=self.__sync_queue, sensor_actor=sensor_actors.get('lidar'))
             elif sensor == 'radar':
-                self.__sensor_dict[sensor]    = sensors.Radar(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['radar'])
-                os.makedirs('data/radar', exist_ok=True)
+                self.__sensor_dict[sensor]    = sensors.Radar(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['radar'], sync_queue=self.__sync_queue, sensor_actor=sensor_actors.get('radar'))
             elif sensor == 'gnss':
-                self.__sensor_dict[sensor]    = sensors.GNSS(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['gnss'])
+                self.__sensor_dict[sensor]    = sensors.GNSS(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['gnss'], sync_queue=self.__sync_queue, sensor_actor=sensor_actors.get('gnss'))
             elif sensor == 'imu':
-                self.__sensor_dict[sensor]    = sensors.IMU(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['imu'])
+                self.__sensor_dict[sensor]    = sensors.IMU(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['imu'], sync_queue=self.__sync_queue, sensor_actor=sensor_actors.get('imu'))
             elif sensor == 'collision':
-                self.__sensor_dict[sensor]    = sensors.Collision(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['collision'])
+                self.__sensor_dict[sensor]    = sensors.Collision(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['collision'], sensor_actor=sensor_actors.get('collision'))
             elif sensor == 'lane_invasion':
-                self.__sensor_dict[sensor]    = sensors.Lane_Invasion(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['lane_invasion'])
+                self.__sensor_dict[sensor]    = sensors.Lane_Invasion(world=world, vehicle=self.__vehicle, sensor_dict=vehicle_data['lane_invasion'], sensor_actor=sensor_actors.get('lane_invasion'))
             else:
                 print('Error: Unknown sensor ', sensor)
     
     # This method returns the observation data from the used sensors in the environment (it excludes the collision and lane invasion sensors, which are used for the reward function only). If you're using a different environment, you should change this method to return the observation data that you need.
     # TODO: Make it dynamic to each model.
     # In this case [RGB image, LiDAR point cloud, Current position], the target position and the current situation are added in the environment module.
-    def get_observation_data(self):
-        rgb_data = self.__sensor_dict['rgb_camera'].get_data()
-        lidar_data = self.__sensor_dict['lidar'].get_data()
-        gnss_data = self.__sensor_dict['gnss'].get_data()
+    # If a frame is given, it blocks until every sensor delivered the data of that frame (or the timeout expires), so the observation is never stale.
+    def get_observation_data(self, frame=None, timeout=configuration.SENSOR_SYNC_TIMEOUT):
+        bundle = self.get_sensor_bundle(['rgb_camera', 'lidar', 'gnss'], frame, timeout)
+
+        return [bundle.data['rgb_camera'], bundle.data['lidar'], bundle.data['gnss']]
+
+    # Collects the data of the given sensors for the given frame. If frame is None it simply returns the last data of each sensor.
+    def get_sensor_bundle(self, sensor_names, frame=None, timeout=configuration.SENSOR_SYNC_TIMEOUT):
+        if frame is not None:
+            missing = self.__sync_queue.wait_for_frame([self.__sensor_dict[name] for name in sensor_names], frame, timeout)
+            if missing:
+                missing_names = [name for name in sensor_names if self.__sensor_dict[name] in missing]
+                print(f"Warning: Sensors {missing_names} did not deliver frame {frame} within {timeout} seconds. Using their last data.")
+
+        data = {name: self.__sensor_dict[name].get_data() for name in sensor_names}
+        frames = {name: self.__sensor_dict[name].get_frame() for name in sensor_names}
 
-        return [rgb_data, lidar_data, gnss_data]
+        return sensors.SensorBundle(frame, data, frames)
 
     def sensors_ready(self):
         for sensor in self.__sensor_dict:
@@ -254,5 +430,7 @@ class Vehicle:
     
     # In Km/h
     def get_speed(self):
+        if self.__state is not None:
+            return self.__state.speed
         return 3.6 * self.__vehicle.get_velocity().length()
 
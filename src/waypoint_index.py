@@ -0,0 +1,210 @@
+'''
+Waypoint Index Module:
+    It answers nearest-lane queries locally (with numpy) instead of calling map.get_waypoint in the hot loop.
+
+    The map's lanes are sampled once with map.generate_waypoints (driving lanes) plus the sidewalks found by walking to the right of each driving lane.
+    The samples are cached to disk as a .npz file (one per map and sampling distance), so the next runs only load them.
+
+    The samples are bucketed in a uniform 2D grid of cells. A query only looks at the 3x3 cells around each point, which is exact whenever the nearest sample is closer than a cell's size.
+    Otherwise (points far away from any lane), it falls back to a brute force search.
+
+    Every query can be done for a batch of points at once and can be restricted to a lane type (carla.LaneType flags, e.g., carla.LaneType.Driving | carla.LaneType.Sidewalk).
+'''
+
+import os
+import hashlib
+import numpy as np
+
+import configuration as config
+
+FIELDS = ['x', 'y', 'z', 'yaw', 'road_id', 'section_id', 'lane_id', 's', 'lane_type', 'lane_width', 'is_junction']
+CACHE_VERSION = 1
+# carla.LaneType.Driving. The carla module is only imported to build the index, so a loaded index can be queried without it (e.g., by env/offline_reward.py)
+DRIVING_LANE_TYPE = 2
+
+# Identifies a map in the cache's file names. It contains a hash of the map's OpenDRIVE, so a changed map is never served from an old cache.
+def map_cache_key(carla_map):
+    map_name = carla_map.name.split('/')[-1]
+    map_hash = hashlib.md5(carla_map.to_opendrive().encode()).hexdigest()[:12]
+    return f'{map_name}_{map_hash}'
+
+class WaypointIndex:
+    def __init__(self, data, cell_size=5.0):
+        self.__data = {field: np.asarray(data[field]) for field in FIELDS}
+        self.__xyz = np.stack([self.__data['x'], self.__data['y'], self.__data['z']], axis=1).astype(np.float64)
+        self.__yaw = np.radians(self.__data['yaw'].astype(np.float64))
+        self.__lane_type = self.__data['lane_type'].astype(np.int64)
+        self.__cell_size = float(cell_size)
+        self.__grids = {} # One grid per lane type filter, built on demand
+
+    # ====================================== Construction ======================================
+    # Loads the index of the map from the cache directory, or builds (and caches) it if it doesn't exist
+    @staticmethod
+    def load_or_build(carla_map, distance=config.WAYPOINT_INDEX_DISTANCE, cache_dir=config.CACHE_DIR):
+        path = os.path.join(cache_dir, WaypointIndex.cache_filename(carla_map, distance))
+        if os.path.exists(path):
+            try:
+                return WaypointIndex.load(path)
+            except Exception as e:
+                print(f"Warning: Failed to load the waypoint index {path} ({e}). Building it again.")
+
+        index = WaypointIndex.build(carla_map, distance)
+        try:
+            index.save(path)
+        except OSError as e:
+            print(f"Warning: Failed to cache the waypoint index in {path}: {e}")
+        return index
+
+    @staticmethod
+    def cache_filename(carla_map, distance):
+        return f'waypoints_{map_cache_key(carla_map)}_{distance:g}m_v{CACHE_VERSION}.npz'
+
+    @staticmethod
+    def build(carla_map, distance=config.WAYPOINT_INDEX_DISTANCE):
+        import carla
+        rows = []
+        seen_sidewalks = set()
+        for waypoint in carla_map.generate_waypoints(distance):
+            rows.append(WaypointIndex.__waypoint_row(waypoint))
+
+            # Walk to the right until the sidewalk (if any) of the lane's side of the road
+            lane = waypoint.get_right_lane()
+            for _ in range(4):
+                if lane is None:
+                    break
+                if lane.lane_type == carla.LaneType.Sidewalk:
+                    key = (lane.road_id, lane.section_id, lane.lane_id, round(lane.s / distance))
+                    if key not in seen_sidewalks:
+                        seen_sidewalks.add(key)
+                        rows.append(WaypointIndex.__waypoint_row(lane))
+                    break
+                lane = lane.get_right_lane()
+
+        data = {field: np.array([row[idx] for row in rows]) for idx, field in enumerate(FIELDS)}
+        if config.VERBOSE:
+            print(f"Built the waypoint index of {carla_map.name} with {len(rows)} waypoints ({len(seen_sidewalks)} on sidewalks)")
+        return WaypointIndex(data)
+
+    @staticmethod
+    def __waypoint_row(waypoint):
+        location = waypoint.transform.location
+        return (location.x, location.y, location.z, waypoint.transform.rotation.yaw, waypoint.road_id, waypoint.section_id,
+                waypoint.lane_id, waypoint.s, int(waypoint.lane_type), waypoint.lane_width, waypoint.is_junction)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez_compressed(path, **self.__data)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return WaypointIndex({field: data[field] for field in FIELDS})
+
+    # ====================================== Queries ======================================
+    def __len__(self):
+        return len(self.__xyz)
+
+    # Returns the array of a field (see FIELDS), optionally only for the given indices
+    def get(self, field, indices=None):
+        return self.__data[field] if indices is None else self.__data[field][indices]
+
+    # Nearest waypoint of a single point. Returns (index, distance), or (-1, inf) if there is no waypoint of the lane type.
+    def nearest(self, location, lane_type=DRIVING_LANE_TYPE):
+        point = np.array([[location.x, location.y, location.z]])
+        indices, distances = self.query(point, lane_type)
+        return int(indices[0]), float(distances[0])
+
+    # Nearest waypoints of a batch of points with shape (N, 2) or (N, 3). If z is given, the distance is 3D (so stacked roads are told apart).
+    # Returns the indices (-1 if there is no waypoint of the lane type) and the distances.
+    def query(self, points, lane_type=DRIVING_LANE_TYPE):
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        dims = min(points.shape[1], 3)
+        grid = self.__get_grid(lane_type)
+        indices = np.full(len(points), -1, dtype=np.int64)
+        distances = np.full(len(points), np.inf)
+        if grid is None or len(points) == 0:
+            return indices, distances
+
+        # Candidates: the padded rows of the 3x3 cells around each point
+        cells = np.floor(points[:, :2] / self.__cell_size).astype(np.int64)
+        offsets = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+        neighbours = cells[:, None, :] + offsets[None, :, :]
+        rows = self.__find_cells(grid, neighbours.reshape(-1, 2)).reshape(len(points), 9)
+        candidates = np.where(rows[:, :, None] >= 0, grid['cells'][np.maximum(rows, 0)], -1).reshape(len(points), -1)
+
+        valid = candidates >= 0
+        deltas = self.__xyz[np.maximum(candidates, 0), :dims] - points[:, None, :dims]
+        candidate_distances = np.where(valid, np.linalg.norm(deltas, axis=2), np.inf)
+        best = np.argmin(candidate_distances, axis=1)
+        indices = np.where(valid.any(axis=1), candidates[np.arange(len(points)), best], -1)
+        distances = candidate_distances[np.arange(len(points)), best]
+
+        # The 3x3 cells only guarantee the nearest waypoint if it is closer than a cell's size
+        far = distances > self.__cell_size
+        if far.any():
+            members = grid['members']
+            deltas = self.__xyz[members, :dims][None, :, :] - points[far, None, :dims]
+            far_distances = np.linalg.norm(deltas, axis=2)
+            best = np.argmin(far_distances, axis=1)
+            indices[far] = members[best]
+            distances[far] = far_distances[np.arange(len(best)), best]
+
+        return indices, distances
+
+    # Indices of the waypoints of the lane type within a radius (2D) of a location
+    def within_radius(self, location, radius, lane_type=DRIVING_LANE_TYPE):
+        grid = self.__get_grid(lane_type)
+        if grid is None:
+            return np.empty(0, dtype=np.int64)
+        members = grid['members']
+        deltas = self.__xyz[members, :2] - np.array([location.x, location.y])
+        return members[np.einsum('ij,ij->i', deltas, deltas) <= radius ** 2]
+
+    # Signed lateral offset (positive to the right of the lane's direction) and heading error (in degrees, in [-180, 180]) of points relative to the given waypoints
+    def lane_offsets(self, points, indices, yaws=None):
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        yaw = self.__yaw[indices]
+        deltas = points[:, :2] - self.__xyz[indices, :2]
+        lateral = -deltas[:, 0] * np.sin(yaw) + deltas[:, 1] * np.cos(yaw)
+        if yaws is None:
+            return lateral, None
+        heading_error = (np.asarray(yaws, dtype=np.float64) - np.degrees(yaw) + 180.0) % 360.0 - 180.0
+        return lateral, heading_error
+
+    # Returns the carla.Transform of a waypoint of the index
+    def get_transform(self, index):
+        import carla
+        x, y, z = self.__xyz[index]
+        return carla.Transform(carla.Location(x=float(x), y=float(y), z=float(z)), carla.Rotation(yaw=float(self.__data['yaw'][index])))
+
+    # ====================================== Grid ======================================
+    # The grid is stored as the sorted keys of its non empty cells and a padded array with the waypoints of each cell (-1 is padding)
+    def __get_grid(self, lane_type):
+        key = int(lane_type)
+        if key not in self.__grids:
+            members = np.nonzero((self.__lane_type & key) != 0)[0]
+            if len(members) == 0:
+                self.__grids[key] = None
+            else:
+                cells = np.floor(self.__xyz[members, :2] / self.__cell_size).astype(np.int64)
+                cell_keys = self.__cell_keys(cells)
+                order = np.argsort(cell_keys, kind='stable')
+                sorted_keys = cell_keys[order]
+                unique_keys, starts, counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+                padded = np.full((len(unique_keys), counts.max()), -1, dtype=np.int64)
+                positions = np.arange(len(sorted_keys)) - np.repeat(starts, counts)
+                padded[np.repeat(np.arange(len(unique_keys)), counts), positions] = members[order]
+                self.__grids[key] = {'keys': unique_keys, 'cells': padded, 'members': members}
+        return self.__grids[key]
+
+    # Row of each cell in the grid (-1 if the cell is empty)
+    def __find_cells(self, grid, cells):
+        keys = self.__cell_keys(cells)
+        rows = np.searchsorted(grid['keys'], keys)
+        rows = np.minimum(rows, len(grid['keys']) - 1)
+        return np.where(grid['keys'][rows] == keys, rows, -1)
+
+    # Packs the 2D cell coordinates in a single integer (the maps are far smaller than 2^31 cells per axis)
+    @staticmethod
+    def __cell_keys(cells):
+        return (cells[:, 0] << 32) + (cells[:, 1] & 0xFFFFFFFF)
@@ -6,6 +6,9 @@ World:
         - WeatherControl
         - Map
         - SpectatorControl (This one isn't in a different module because it's just two simple functions)
+        - WaypointIndex (Local nearest-lane queries, built once per map)
+        - InfractionIndex (Stop sign and traffic light stop lines, built once per loaded world)
+        - RoutePlanner (A* routes over the map's topology, built once per map)
 '''
 
 import carla
@@ -14,6 +17,9 @@ from src.weather_control import WeatherControl
 from src.traffic_control import TrafficControl
 from src.weather_control import WeatherControl
 from src.map_control     import MapControl
+from src.waypoint_index  import WaypointIndex
+from src.infraction_index import InfractionIndex
+from src.route_planner   import RoutePlanner
 import configuration as config
 import time
 
@@ -28,6 +34,11 @@ class World:
         self.__traffic_control = TrafficControl(self.__world)
         self.__map_control     = MapControl(self.__world, self.__client)
         self.__map = self.__map_control.get_map()
+        self.__waypoint_index = None
+        self.__waypoint_index_map = None
+        self.__infraction_index = None
+        self.__route_planner = None
+        self.__route_planner_map = None
         
         self.__synchronous_mode = synchronous_mode
         if self.__synchronous_mode:
@@ -48,8 +59,13 @@ class World:
         self.destroy_pedestrians()
         self.destroy_vehicles()
     
+    # Returns the frame of the new tick
     def tick(self):
-        self.__world.tick()
+        return self.__world.tick()
+    
+    # Asynchronous mode only: waits for the next server tick and returns its frame
+    def wait_for_tick(self):
+        return self.__world.wait_for_tick().frame
 
     # ============ Weather Control ============
     # The output is a tuple (carla.WeatherPreset, Str: name of the weather preset)
@@ -82,7 +98,8 @@ class World:
         self.__map_control.print_available_maps()
 
     def set_active_map(self, map_name, reload_map=False):
-        self.__map_control.set_active_map(map_name=map_name, reload_map=reload_map)
+        if self.__map_control.set_active_map(map_name=map_name, reload_map=reload_map):
+            self.__infraction_index = None
         self.__map = self.__map_control.get_map()
     
     def change_map(self):
@@ -90,6 +107,7 @@ class World:
     
     def reload_map(self):
         self.__map_control.reload_map()
+        self.__infraction_index = None
     
     # ============ Traffic Control ============
     def spawn_vehicles(self, num_vehicles = 10, autopilot_on = False):
@@ -117,8 +135,33 @@ class World:
         self.__traffic_control.toggle_lights(lights_on)
     
     def update_traffic_map(self):
-        self.__traffic_control.update_map(self.__map)
+        self.__traffic_control.update_map(self.__map, self.get_waypoint_index())
         return self.__map
+
+    # ============ Waypoint Index ============
+    # The index is loaded from the cache (or built) the first time it is requested on each map
+    def get_waypoint_index(self):
+        carla_map = self.get_map()
+        if self.__waypoint_index is None or self.__waypoint_index_map != carla_map.name:
+            self.__waypoint_index = WaypointIndex.load_or_build(carla_map)
+            self.__waypoint_index_map = carla_map.name
+        return self.__waypoint_index
+
+    # ============ Route Planner ============
+    # The planner's graph is loaded from the cache (or built) the first time it is requested on each map
+    def get_route_planner(self):
+        carla_map = self.get_map()
+        if self.__route_planner is None or self.__route_planner_map != carla_map.name:
+            self.__route_planner = RoutePlanner.load_or_build(carla_map)
+            self.__route_planner_map = carla_map.name
+        return self.__route_planner
+
+    # ============ Infraction Index ============
+    # The traffic lights are actors, so the index is built again after every world (re)load
+    def get_infraction_index(self):
+        if self.__infraction_index is None:
+            self.__infraction_index = InfractionIndex(self.__world, self.get_map())
+        return self.__infraction_index
     
     # ============ Weather Control ===============
     def get_weather_presets(self):